@@ -0,0 +1,289 @@
+"""Client for the local HTTP API of a Bond home automation hub.
+
+All requests share one keep-alive session, so switching several fans doesn't
+open a connection per command. Device state read back from the hub is cached
+for a short while, and commands that wouldn't change a device's state are
+skipped. See http://docs-local.appbond.com/ for the API itself.
+
+BondPushListener subscribes to the hub's local UDP push protocol (BPUP), so
+state changes made from a remote or the Bond app land in the same cache as
+soon as they happen.
+"""
+
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+STATE_URL = "http://{}/v2/devices/{}/state"
+ACTION_URL = "http://{}/v2/devices/{}/actions/{}"
+BPUP_PORT = 30007
+# The hub drops push subscribers it hasn't heard from in about two minutes.
+BPUP_KEEPALIVE_S = 60
+
+
+def expected_state(action, argument=None):
+    """Return the state fields an action produces, or None if unknown."""
+    if action == "TurnOff":
+        return {"power": 0}
+    if action == "TurnOn":
+        return {"power": 1}
+    if action == "SetSpeed":
+        return {"power": 1, "speed": argument}
+    return None
+
+
+class BondClient:
+    """Sends actions to Bond devices and caches their state."""
+
+    def __init__(
+        self, host, token, timeout=5, retries=2, state_max_age=60, max_workers=8
+    ):
+        """Create a client for the hub at `host`.
+
+        `timeout` applies to each HTTP request, and failed connections or 5xx
+        responses are retried `retries` times. Cached device state is reused
+        for `state_max_age` seconds.
+        """
+        self.host = host
+        self.timeout = timeout
+        self.state_max_age = state_max_age
+        self.session = requests.Session()
+        self.session.headers["BOND-Token"] = token
+        adapter = HTTPAdapter(
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.1,
+                status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="bond"
+        )
+        self._lock = threading.Lock()
+        self._states = {}
+        # Devices whose cached state is kept current by a push listener, and
+        # until when that listener is known to be alive.
+        self._pushed = set()
+        self._push_alive_until = 0
+        # The state each device should be in after our last command, and the
+        # devices that were changed by something else since then.
+        self._expected = {}
+        self._overridden = set()
+
+    def get_state(self, device_id, max_age=None):
+        """Return the state of a device, from the cache if it is fresh."""
+        if max_age is None:
+            max_age = self.state_max_age
+        now = time.monotonic()
+        with self._lock:
+            cached = self._states.get(device_id)
+            pushed = device_id in self._pushed and now < self._push_alive_until
+        if cached is not None and (pushed or now - cached[0] < max_age):
+            return dict(cached[1])
+        response = self.session.get(
+            STATE_URL.format(self.host, device_id), timeout=self.timeout
+        )
+        response.raise_for_status()
+        state = response.json()
+        self._cache_state(device_id, state)
+        return dict(state)
+
+    def _cache_state(self, device_id, state):
+        with self._lock:
+            self._states[device_id] = (time.monotonic(), state)
+
+    def update_state(self, device_id, changes):
+        """Merge pushed state changes for a device into the cache.
+
+        Changes that contradict the device's state after our last command
+        mark it as overridden.
+        """
+        with self._lock:
+            cached = self._states.get(device_id)
+            state = dict(cached[1]) if cached is not None else {}
+            state.update(changes)
+            self._states[device_id] = (time.monotonic(), state)
+            self._pushed.add(device_id)
+            expected = self._expected.get(device_id)
+            if expected and any(
+                key in changes and changes[key] != value
+                for key, value in expected.items()
+            ):
+                self._overridden.add(device_id)
+
+    def push_alive(self, seconds):
+        """Trust pushed state for the next `seconds` seconds."""
+        with self._lock:
+            self._push_alive_until = time.monotonic() + seconds
+
+    def push_connected(self):
+        """Return True if a push listener has heard from the hub recently."""
+        with self._lock:
+            return time.monotonic() < self._push_alive_until
+
+    def overridden(self, device_id):
+        """Return True if the device was changed by hand since our last command."""
+        with self._lock:
+            return device_id in self._overridden
+
+    def forget_state(self, device_id=None):
+        """Drop cached state for one device, or for all of them."""
+        with self._lock:
+            if device_id is None:
+                self._states.clear()
+                self._pushed.clear()
+            else:
+                self._states.pop(device_id, None)
+                self._pushed.discard(device_id)
+
+    def action(self, device_id, action, argument=None):
+        """Send an action to a device, e.g. action("id", "SetSpeed", 1)."""
+        body = {} if argument is None else {"argument": argument}
+        response = self.session.put(
+            ACTION_URL.format(self.host, device_id, action),
+            json=body,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response
+
+    def set_state(self, device_id, action, argument=None, expected=None):
+        """Send an action unless the device is already in the `expected` state.
+
+        `expected` is a dict of state fields the action would produce, e.g.
+        {"power": 0} for TurnOff. Returns True if the action was sent. If the
+        state can't be read, the action is sent anyway.
+        """
+        with self._lock:
+            self._expected[device_id] = expected
+            self._overridden.discard(device_id)
+        if expected:
+            try:
+                state = self.get_state(device_id)
+            except (requests.exceptions.RequestException, ValueError):
+                state = None
+            if state is not None and all(
+                state.get(key) == value for key, value in expected.items()
+            ):
+                return False
+        try:
+            self.action(device_id, action, argument)
+        except requests.exceptions.RequestException:
+            self.forget_state(device_id)
+            raise
+        if expected:
+            with self._lock:
+                cached = self._states.get(device_id)
+                state = dict(cached[1]) if cached is not None else {}
+            state.update(expected)
+            self._cache_state(device_id, state)
+        else:
+            self.forget_state(device_id)
+        return True
+
+    def submit(self, device_ids, action, argument=None, expected=None):
+        """Start set_state() for several devices at once.
+
+        Returns a dict of future -> device ID.
+        """
+        return {
+            self._executor.submit(
+                self.set_state, device_id, action, argument, expected
+            ): device_id
+            for device_id in device_ids
+        }
+
+    def close(self):
+        """Close the session and stop the dispatch threads."""
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+
+class BondPushListener:
+    """Feeds BPUP state pushes from the hub into a BondClient's cache."""
+
+    def __init__(
+        self, client, device_ids=None, port=BPUP_PORT, keepalive=BPUP_KEEPALIVE_S
+    ):
+        """Listen for pushes about `device_ids` (all devices if None)."""
+        self.client = client
+        self.device_ids = set(device_ids) if device_ids is not None else None
+        self.address = (client.host.split(":")[0], port)
+        self.keepalive = keepalive
+        self._socket = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def handle_datagram(self, data):
+        """Apply one message from the hub."""
+        try:
+            message = json.loads(data.decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            return
+        if not isinstance(message, dict):
+            return
+        # Anything from the hub, including keep-alive replies, shows the
+        # subscription is live.
+        self.client.push_alive(2 * self.keepalive)
+        topic = message.get("t", "")
+        parts = topic.split("/")
+        if len(parts) != 3 or parts[0] != "devices" or parts[2] != "state":
+            return
+        if message.get("s", 200) != 200 or not isinstance(message.get("b"), dict):
+            return
+        device_id = parts[1]
+        if self.device_ids is None or device_id in self.device_ids:
+            self.client.update_state(device_id, message["b"])
+
+    def run(self):
+        next_keepalive = 0
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            if now >= next_keepalive:
+                try:
+                    self._socket.sendto(b"\n", self.address)
+                except OSError:
+                    pass
+                next_keepalive = now + self.keepalive
+            self._socket.settimeout(max(next_keepalive - now, 0.1))
+            try:
+                data, _ = self._socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stopping.is_set():
+                    break
+                time.sleep(1)
+                continue
+            self.handle_datagram(data)
+
+    def start(self):
+        """Subscribe to the hub and start listening in the background."""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(("", 0))
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run, name="BPUP", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop listening. Cached state goes back to expiring normally."""
+        self._stopping.set()
+        self.client.push_alive(0)
+        if self._socket is not None:
+            # Shutting down wakes the listener thread from recvfrom().
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
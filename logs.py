@@ -0,0 +1,192 @@
+"""Non-blocking, structured logging for the wenestmo daemon.
+
+Log calls only put the record on an in-memory queue; a background thread
+writes it to the console and to a size-rotated file of JSON lines. If the
+writer falls behind (a slow SD card or serial console) and the queue fills up,
+records are dropped and counted rather than stalling the control loop.
+
+Repeated warnings and exceptions, such as the same unreachable plug failing
+every iteration, are logged once and then suppressed for a while. The next copy
+logged after that carries the number that were suppressed.
+
+Each line of the file is one JSON object with time, level, logger, thread and
+message, plus exception (the formatted traceback) and any extra fields passed
+to the log call.
+"""
+
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_BACKUPS = 3
+DEFAULT_REPEAT_INTERVAL_S = 300
+DEFAULT_QUEUE_SIZE = 10000
+
+# LogRecord attributes that aren't extra fields.
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON."""
+
+    def format(self, record):
+        """Return the record as a JSON object string."""
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created)
+            .astimezone()
+            .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and name not in entry:
+                entry[name] = value
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Formats a record as its message, noting suppressed repeats."""
+
+    def format(self, record):
+        """Return the message, followed by the traceback if there is one."""
+        text = super().format(record)
+        repeated = getattr(record, "repeated", None)
+        if repeated:
+            first, _, rest = text.partition("\n")
+            text = "{} ({} more since last logged){}".format(
+                first, repeated, "\n" + rest if rest else ""
+            )
+        return text
+
+
+class RepeatFilter(logging.Filter):
+    """Suppresses repeats of a warning or exception for `interval_s` seconds.
+
+    Records are the same if they have the same logger, level, message and
+    exception type. Records below WARNING are never suppressed.
+    """
+
+    def __init__(self, interval_s=DEFAULT_REPEAT_INTERVAL_S, clock=time.monotonic):
+        """Create a filter with no history."""
+        super().__init__()
+        self.interval_s = interval_s
+        self.clock = clock
+        self._lock = threading.Lock()
+        # key -> (time last logged, number suppressed since)
+        self._seen = {}
+
+    def filter(self, record):
+        """Return False to drop a repeat; adds a `repeated` count otherwise."""
+        if record.levelno < logging.WARNING:
+            return True
+        exc_type = record.exc_info[0].__name__ if record.exc_info else None
+        key = (record.name, record.levelno, record.getMessage(), exc_type)
+        now = self.clock()
+        with self._lock:
+            logged_at, suppressed = self._seen.get(key, (None, 0))
+            if logged_at is not None and now - logged_at < self.interval_s:
+                self._seen[key] = (logged_at, suppressed + 1)
+                return False
+            self._seen[key] = (now, 0)
+            # Forget keys that have gone quiet, so the table doesn't grow.
+            if len(self._seen) > 1000:
+                self._seen = {
+                    seen_key: value
+                    for seen_key, value in self._seen.items()
+                    if now - value[0] < self.interval_s
+                }
+        if suppressed:
+            record.repeated = suppressed
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Puts records on a bounded queue, dropping them if it is full."""
+
+    def __init__(self, log_queue):
+        """Feed `log_queue`."""
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Records stay in this process, so only the message and traceback
+        # are rendered now, before their arguments can change. The exception
+        # is kept as text so the console and the JSON file can show it.
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """Routes the root logger through a queue to a console and a JSON file."""
+
+    def __init__(
+        self,
+        path=None,
+        max_bytes=DEFAULT_MAX_BYTES,
+        backups=DEFAULT_BACKUPS,
+        console=sys.stdout,
+        level=logging.INFO,
+        repeat_interval_s=DEFAULT_REPEAT_INTERVAL_S,
+        queue_size=DEFAULT_QUEUE_SIZE,
+    ):
+        """Configure the pipeline. `path` None or empty means no log file."""
+        self.level = level
+        self.handler = QueueHandler(queue.Queue(queue_size))
+        self.handler.addFilter(RepeatFilter(repeat_interval_s))
+        outputs = []
+        if console is not None:
+            console_handler = logging.StreamHandler(console)
+            console_handler.setFormatter(ConsoleFormatter("%(message)s"))
+            outputs.append(console_handler)
+        if path:
+            file_handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+            )
+            file_handler.setFormatter(JsonFormatter())
+            outputs.append(file_handler)
+        self.outputs = outputs
+        self.listener = logging.handlers.QueueListener(
+            self.handler.queue, *outputs, respect_handler_level=True
+        )
+
+    @property
+    def dropped(self):
+        """The number of records dropped because the queue was full."""
+        return self.handler.dropped
+
+    def start(self):
+        """Start the writer thread and attach to the root logger."""
+        self.listener.start()
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+
+    def stop(self):
+        """Detach, write out everything queued, and close the outputs."""
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        for output in self.outputs:
+            output.close()
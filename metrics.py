@@ -0,0 +1,368 @@
+"""Prometheus metrics and a health check, served over HTTP.
+
+Metrics holds counters, gauges and histograms, each optionally split by
+labels, and renders them in the Prometheus text exposition format. Values that
+are cheaper to read at scrape time than to keep up to date are filled in by
+collector callbacks.
+
+PhaseTimer times the phases of one control iteration, and PhaseStats keeps a
+rolling window of those timings to report percentiles per phase.
+
+MetricsServer serves /metrics and /healthz from a background thread. /healthz
+returns the JSON from a health callback, with status 200 when it reports
+healthy and 503 otherwise, so it can be used directly by uptime checks.
+"""
+
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import math
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DEFAULT_WINDOW = 500
+PERCENTILES = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+
+
+def format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of `values`, or 0 if it is empty."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for name, value in labels
+        )
+    )
+
+
+class Metric:
+    """A named metric with one value per label set."""
+
+    kind = "untyped"
+
+    def __init__(self, name, help, lock):
+        """Create an empty metric."""
+        self.name = name
+        self.help = help
+        self._lock = lock
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def clear(self):
+        """Drop every label set, e.g. before a collector refills the metric."""
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """Return a list of (suffix, labels, value) for rendering."""
+        with self._lock:
+            return [("", key, value) for key, value in sorted(self._values.items())]
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Add `amount` to the counter for `labels`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Return the current value for `labels`."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        """Set the gauge for `labels`."""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, lock, buckets=DEFAULT_BUCKETS):
+        """Create a histogram with the given upper bounds."""
+        super().__init__(name, help, lock)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        """Record one observation."""
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        """Return the number of observations for `labels`."""
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def samples(self):
+        """Return cumulative _bucket, _sum and _count samples."""
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(
+                        ("_bucket", key + (("le", format_value(bound)),), cumulative)
+                    )
+                samples.append(("_sum", key, total))
+                samples.append(("_count", key, cumulative))
+        return samples
+
+
+class Metrics:
+    """A registry of metrics."""
+
+    def __init__(self):
+        """Create an empty registry."""
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, cls, name, help, **kwargs):
+        if name in self._metrics:
+            return self._metrics[name]
+        metric = cls(name, help, threading.Lock(), **kwargs)
+        with self._lock:
+            self._metrics[name] = metric
+        return metric
+
+    def counter(self, name, help):
+        """Return the counter called `name`, creating it if needed."""
+        return self._add(Counter, name, help)
+
+    def gauge(self, name, help):
+        """Return the gauge called `name`, creating it if needed."""
+        return self._add(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        """Return the histogram called `name`, creating it if needed."""
+        return self._add(Histogram, name, help, buckets=buckets)
+
+    def collector(self, callback):
+        """Call `callback()` before every render, to refresh gauges."""
+        with self._lock:
+            self._collectors.append(callback)
+        return callback
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+        with self._lock:
+            collectors = list(self._collectors)
+        for callback in collectors:
+            try:
+                callback()
+            except Exception:
+                LOG.exception("Metrics collector failed:")
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append(
+                    "{}{}{} {}".format(
+                        metric.name, suffix, format_labels(labels), format_value(value)
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+
+class PhaseTimer:
+    """Accumulates the time spent in each phase of one iteration.
+
+    Phases may be timed from several threads; time spent in the same phase is
+    added up.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """Start timing an iteration."""
+        self.clock = clock
+        self.started = clock()
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as phase `name`."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, self.clock() - start)
+
+    def add(self, name, seconds):
+        """Add `seconds` to phase `name`."""
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def total(self):
+        """Return the seconds since the timer was created."""
+        return self.clock() - self.started
+
+
+class PhaseStats:
+    """Keeps the last `window` timings of each phase."""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        """Create an empty window."""
+        self._lock = threading.Lock()
+        self._window = window
+        self._samples = {}
+
+    def add(self, durations):
+        """Add one iteration's dict of phase -> seconds."""
+        with self._lock:
+            for name, seconds in durations.items():
+                samples = self._samples.get(name)
+                if samples is None:
+                    samples = self._samples[name] = collections.deque(
+                        maxlen=self._window
+                    )
+                samples.append(seconds)
+
+    def summary(self):
+        """Return {phase: {"count", "p50", "p95", "p99", "max"}} in seconds."""
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+        summary = {}
+        for name, values in samples.items():
+            summary[name] = {"count": len(values), "max": max(values)}
+            for label, fraction in PERCENTILES:
+                summary[name][label] = percentile(values, fraction)
+        return summary
+
+    def format(self):
+        """Return the summary as a table, in milliseconds."""
+        lines = [
+            "{:<14}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+                "phase", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"
+            )
+        ]
+        for name, stats in sorted(self.summary().items()):
+            lines.append(
+                "{:<14}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                    name,
+                    stats["count"],
+                    *(1000 * stats[key] for key in ("p50", "p95", "p99", "max"))
+                )
+            )
+        return "\n".join(lines)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer only exists from Python 3.7.
+    daemon_threads = True
+
+
+class MetricsServer:
+    """Serves /metrics and /healthz on a background thread."""
+
+    def __init__(self, metrics, health, port, host="127.0.0.1"):
+        """Serve `metrics`; `health()` returns (healthy, JSON-able details).
+
+        Only local clients can connect unless `host` is another address, or
+        "" for all interfaces.
+        """
+        self.metrics = metrics
+        self.health = health
+        self._server = _ThreadingHTTPServer((host, port), self._handler())
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, content_type, body):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/metrics":
+                    self.reply(
+                        200,
+                        "text/plain; version=0.0.4; charset=utf-8",
+                        server.metrics.render(),
+                    )
+                elif path == "/healthz":
+                    healthy, details = server.health()
+                    self.reply(
+                        200 if healthy else 503,
+                        "application/json",
+                        json.dumps(details, indent=1, sort_keys=True),
+                    )
+                else:
+                    self.reply(404, "text/plain", "Not found\n")
+
+        return Handler
+
+    def start(self):
+        """Start serving."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="Metrics", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self._server.shutdown()
+        self._server.server_close()
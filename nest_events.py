@@ -0,0 +1,103 @@
+"""Event-driven thermostat updates from the Google Device Access Pub/Sub feed.
+
+Device Access publishes trait changes (HVAC status, temperature, humidity, ...)
+to a Cloud Pub/Sub topic. ThermostatEvents merges those changes into the last
+known copy of each device, so the control loop can react without polling.
+
+Pub/Sub support needs the optional google-cloud-pubsub package. To test against
+the local emulator, set PUBSUB_EMULATOR_HOST before starting; the client
+library picks it up automatically. handle_message() also accepts any object
+with .data and .ack(), so tests can feed messages in directly.
+"""
+
+import copy
+import json
+import logging
+import threading
+
+try:
+    from google.cloud import pubsub_v1
+except ImportError:
+    pubsub_v1 = None
+
+LOG = logging.getLogger(__name__)
+
+
+class ThermostatEvents:
+    """Keeps thermostats up to date from SDM Pub/Sub events."""
+
+    def __init__(self, subscription):
+        """Create a listener for "projects/<project>/subscriptions/<name>"."""
+        self.subscription = subscription
+        # Set whenever an event changes a device. The control loop waits on it.
+        self.changed = threading.Event()
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._timestamps = {}
+        self._subscriber = None
+        self._future = None
+
+    def seed(self, device):
+        """Store a full device resource, e.g. from a poll.
+
+        Later events are merged into it.
+        """
+        with self._lock:
+            self._devices[device["name"]] = copy.deepcopy(device)
+
+    def get(self, name):
+        """Return a copy of the latest state of a device, or None if unseeded."""
+        with self._lock:
+            device = self._devices.get(name)
+            return copy.deepcopy(device) if device is not None else None
+
+    def handle_message(self, message):
+        """Apply and acknowledge one Pub/Sub message."""
+        try:
+            event = json.loads(message.data.decode("utf-8"))
+            self.apply_event(event)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            LOG.exception("Unable to parse Nest event:")
+        message.ack()
+
+    def apply_event(self, event):
+        """Merge an SDM event into its device. Return True if it was known."""
+        update = event.get("resourceUpdate")
+        if not update or "traits" not in update:
+            return False
+        name = update["name"]
+        timestamp = event.get("timestamp", "")
+        with self._lock:
+            device = self._devices.get(name)
+            if device is None:
+                return False
+            traits = device.setdefault("traits", {})
+            for trait, values in update["traits"].items():
+                # Pub/Sub doesn't guarantee ordering. ISO timestamps in the same
+                # format compare correctly as strings.
+                if timestamp < self._timestamps.get((name, trait), ""):
+                    continue
+                self._timestamps[(name, trait)] = timestamp
+                traits.setdefault(trait, {}).update(values)
+        self.changed.set()
+        return True
+
+    def start(self):
+        """Start receiving messages on the Pub/Sub client's threads."""
+        if pubsub_v1 is None:
+            raise RuntimeError(
+                "Install google-cloud-pubsub to receive Nest events over Pub/Sub."
+            )
+        self._subscriber = pubsub_v1.SubscriberClient()
+        self._future = self._subscriber.subscribe(
+            self.subscription, callback=self.handle_message
+        )
+
+    def stop(self):
+        """Stop receiving messages."""
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+        if self._subscriber is not None:
+            self._subscriber.close()
+            self._subscriber = None
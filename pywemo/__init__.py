@@ -12,4 +12,6 @@ from .ouimeaux_device.bridge import Bridge  # noqa F401
 from .ouimeaux_device.humidifier import Humidifier  # noqa F401
 
 from .discovery import discover_devices  # noqa F401
+from .discovery import DeviceRegistry  # noqa F401
 from .subscribe import SubscriptionRegistry  # noqa F401
+from .state_engine import StateEngine  # noqa F401
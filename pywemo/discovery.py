@@ -1,5 +1,8 @@
 """Module to discover WeMo devices."""
 import logging
+import threading
+import time
+
 import requests
 
 from . import ssdp
@@ -91,3 +94,115 @@ def device_from_uuid_and_location(uuid, mac, location,
                           rediscovery_enabled=rediscovery_enabled)
 
     return None
+
+
+class DeviceRegistry:
+    """
+    Remember discovered devices, keyed by MAC address or serial number.
+
+    Each device is stored once, however many discovery results it shows up
+    in. When a known device reappears at a new host or port, or with a new
+    name, the existing object is updated in place so references to it stay
+    valid. Devices that haven't been seen for `max_age` seconds are expired.
+
+    `generation` is incremented whenever a device is added, moves, is renamed
+    or expires, so callers can cheaply tell when derived data needs
+    rebuilding.
+    """
+
+    def __init__(self, max_age=None):
+        """Create an empty device registry."""
+        self.max_age = max_age
+        self.generation = 0
+        self._devices = {}
+        self._last_seen = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(device):
+        return device.mac or device.serialnumber
+
+    def update(self, devices, now=None):
+        """
+        Merge a list of discovered devices into the registry.
+
+        Returns the devices that weren't in the registry before.
+        """
+        now = now or time.time()
+        added = []
+        with self._lock:
+            for device in devices:
+                key = self._key(device)
+                known = self._devices.get(key)
+                if known is None:
+                    self._devices[key] = device
+                    added.append(device)
+                    self.generation += 1
+                elif known is not device and (
+                        (known.host, known.port, known.name) !=
+                        (device.host, device.port, device.name)):
+                    if (known.host, known.port) != (device.host, device.port):
+                        LOG.info("%s moved from %s:%s to %s:%s", device.name,
+                                 known.host, known.port, device.host,
+                                 device.port)
+                    if known.name != device.name:
+                        LOG.info("%s was renamed to %s", known.name,
+                                 device.name)
+                    # pylint: disable=attribute-defined-outside-init
+                    known.__dict__ = device.__dict__
+                    self.generation += 1
+                self._last_seen[key] = now
+        return added
+
+    def expire(self, max_age=None, now=None):
+        """
+        Forget devices that haven't been seen for `max_age` seconds.
+
+        Returns the expired devices.
+        """
+        max_age = max_age or self.max_age
+        if max_age is None:
+            return []
+        now = now or time.time()
+        with self._lock:
+            keys = [key for key, last_seen in self._last_seen.items()
+                    if now - last_seen > max_age]
+            expired = [self._devices.pop(key) for key in keys]
+            for key in keys:
+                del self._last_seen[key]
+            if expired:
+                self.generation += 1
+        for device in expired:
+            LOG.info("Forgetting %s, not seen for %is", device.name, max_age)
+        return expired
+
+    def discover(self, **kwargs):
+        """
+        Run discovery and merge the results into the registry.
+
+        Keyword arguments are passed to discover_devices. Returns the
+        devices that weren't in the registry before.
+        """
+        added = self.update(discover_devices(**kwargs))
+        self.expire()
+        return added
+
+    def devices(self):
+        """Return a list of all known devices."""
+        with self._lock:
+            return list(self._devices.values())
+
+    def get(self, key):
+        """Return the device with a MAC address or serial number, or None."""
+        with self._lock:
+            return self._devices.get(key)
+
+    def last_seen(self, device):
+        """Return when the device was last discovered, or None."""
+        with self._lock:
+            return self._last_seen.get(self._key(device))
+
+    def __len__(self):
+        """Return the number of known devices."""
+        with self._lock:
+            return len(self._devices)
@@ -73,6 +73,9 @@ class UnknownService(Exception):
 class Device(object):
     """Base object for WeMo devices."""
 
+    # Services that the SubscriptionRegistry subscribes to for events.
+    EVENT_SERVICES = ('basicevent',)
+
     def __init__(self, url, mac, rediscovery_enabled=True):
         """Create a WeMo device."""
         self._state = None
@@ -37,6 +37,8 @@ def limit(value, min_val, max_val):
 class Bridge(Device):
     """Representation of a WeMo Bridge (Link) device."""
 
+    EVENT_SERVICES = ('basicevent', 'bridge')
+
     Lights = {}
     Groups = {}
 
@@ -109,6 +111,19 @@ class Bridge(Device):
         # pylint: disable=maybe-no-member
         return self.bridge.SetDeviceStatus(DeviceStatusList=send_state)
 
+    def subscription_update(self, _type, _params):
+        """Update light and group state due to a subscription update event."""
+        if _type == "StatusChange" and _params:
+            state_event = et.fromstring(_params.encode('utf-8'))
+            key = state_event.findtext('DeviceID')
+            if key in self.Lights:
+                return self.Lights[key].subscription_update(state_event)
+            if key in self.Groups:
+                return self.Groups[key].subscription_update(state_event)
+            return False
+
+        return super(Bridge, self).subscription_update(_type, _params)
+
     @property
     def device_type(self):
         """Return what kind of WeMo this device is."""
@@ -137,6 +152,21 @@ class LinkedDevice:
             self.bridge.bridge_update()
         return self.state
 
+    def subscription_update(self, state_event):
+        """Update the device state from a bridge StatusChange event."""
+        capability = CAPABILITY_ID2NAME.get(
+            state_event.findtext('CapabilityId'))
+        value = state_event.findtext('Value')
+        if capability not in self.capabilities or value is None:
+            return False
+
+        index = self.capabilities.index(capability)
+        self._values = list(self._values)
+        self._values.extend([''] * (index + 1 - len(self._values)))
+        self._values[index] = value
+        self.update_state(state_event)
+        return True
+
     def update_state(self, status):
         """
         Set the device state based on capabilities and values.
@@ -67,6 +67,8 @@ def attribute_xml_to_dict(xml_blob):
 class CoffeeMaker(Switch):
     """Representation of a WeMo CofeeMaker device."""
 
+    EVENT_SERVICES = ('basicevent', 'deviceevent')
+
     def __init__(self, *args, **kwargs):
         """Create a WeMo CoffeeMaker device."""
         Switch.__init__(self, *args, **kwargs)
@@ -134,6 +134,8 @@ def attribute_xml_to_dict(xml_blob):
 class Humidifier(Switch):
     """Representation of a WeMo Humidifier device."""
 
+    EVENT_SERVICES = ('basicevent', 'deviceevent')
+
     def __init__(self, *args, **kwargs):
         """Create a WeMo Humidifier device."""
         Switch.__init__(self, *args, **kwargs)
@@ -9,6 +9,8 @@ LOG = logging.getLogger(__name__)
 class Insight(Switch):
     """Representation of a WeMo Insight device."""
 
+    EVENT_SERVICES = ('basicevent', 'insight')
+
     def __init__(self, *args, **kwargs):
         """Create a WeMo Switch device."""
         Switch.__init__(self, *args, **kwargs)
@@ -3,9 +3,21 @@ from xml.etree import cElementTree as et
 from .switch import Switch
 
 
+def attribute_xml_to_dict(xml_blob):
+    """Return attribute values as a dict of name to text value."""
+    xml_blob = "<attributes>" + xml_blob + "</attributes>"
+    xml_blob = xml_blob.replace("&gt;", ">")
+    xml_blob = xml_blob.replace("&lt;", "<")
+    attributes = et.fromstring(xml_blob)
+    return {attribute[0].text: attribute[1].text
+            for attribute in attributes if len(attribute) >= 2}
+
+
 class Maker(Switch):
     """Representation of a WeMo Maker device."""
 
+    EVENT_SERVICES = ('basicevent', 'deviceevent')
+
     def __repr__(self):
         """Return a string representation of the device."""
         return '<WeMo Maker "{name}">'.format(name=self.name)
@@ -15,24 +27,22 @@ class Maker(Switch):
         """Get and parse the device attributes."""
         # pylint: disable=maybe-no-member
         makerresp = self.deviceevent.GetAttributes().get('attributeList')
-        makerresp = "<attributes>" + makerresp + "</attributes>"
-        makerresp = makerresp.replace("&gt;", ">")
-        makerresp = makerresp.replace("&lt;", "<")
-        attributes = et.fromstring(makerresp)
-        for attribute in attributes:
-            if attribute[0].text == "Switch":
-                switchstate = attribute[1].text
-            elif attribute[0].text == "Sensor":
-                sensorstate = attribute[1].text
-            elif attribute[0].text == "SwitchMode":
-                switchmode = attribute[1].text
-            elif attribute[0].text == "SensorPresent":
-                hassensor = attribute[1].text
+        attributes = attribute_xml_to_dict(makerresp)
         return {
-            'switchstate': int(switchstate),
-            'sensorstate': int(sensorstate),
-            'switchmode': int(switchmode),
-            'hassensor': int(hassensor)}
+            'switchstate': int(attributes['Switch']),
+            'sensorstate': int(attributes['Sensor']),
+            'switchmode': int(attributes['SwitchMode']),
+            'hassensor': int(attributes['SensorPresent'])}
+
+    def subscription_update(self, _type, _params):
+        """Update the switch state due to a subscription update event."""
+        if _type == "attributeList":
+            switchstate = attribute_xml_to_dict(_params).get('Switch')
+            if switchstate is not None:
+                self._state = int(switchstate)
+            return True
+
+        return Switch.subscription_update(self, _type, _params)
 
     def get_state(self, force_update=False):
         """Return 0 if off and 1 if on."""
@@ -0,0 +1,215 @@
+"""Keep device state fresh by combining subscription events and polling."""
+import collections
+import logging
+import threading
+import time
+
+import requests
+
+from .ouimeaux_device.api.service import ActionException
+
+LOG = logging.getLogger(__name__)
+
+# A device that hasn't sent an event for this long is polled instead.
+QUIET_PERIOD = 600
+MIN_POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 300
+
+
+class StateEngine:
+    """
+    Track device state from push events, falling back to polling.
+
+    Devices are registered with a SubscriptionRegistry and are in push mode
+    while events keep arriving. A device whose subscription has lapsed, or
+    that hasn't sent an event within `quiet_period` seconds, is polled
+    instead. The poll interval starts at `min_poll_interval` and doubles up
+    to `max_poll_interval` while the state is unchanged. If a poll finds a
+    change that was never pushed, the device is resubscribed. The device
+    goes back to push mode as soon as it sends an event again.
+    """
+
+    def __init__(self, registry, quiet_period=QUIET_PERIOD,
+                 min_poll_interval=MIN_POLL_INTERVAL,
+                 max_poll_interval=MAX_POLL_INTERVAL):
+        """Create a state engine on top of a subscription registry."""
+        self._registry = registry
+        self.quiet_period = quiet_period
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+
+        self._devices = {}
+        self._callbacks = collections.defaultdict(list)
+        self._last_event = {}
+        self._next_poll = {}
+        self._poll_interval = {}
+
+        self._cond = threading.Condition()
+        self._exiting = False
+        self._thread = None
+
+    def register(self, device):
+        """Subscribe to a device and start tracking its state."""
+        serial = device.serialnumber
+        with self._cond:
+            new = serial not in self._devices
+            self._devices[serial] = device
+            # Give the new subscription a full quiet period to prove itself.
+            self._last_event[serial] = time.time()
+            self._next_poll.pop(serial, None)
+            self._poll_interval[serial] = self.min_poll_interval
+            self._cond.notify()
+        self._registry.register(device)
+        if new:
+            self._registry.on(device, None, self._event)
+
+    def unregister(self, device):
+        """Stop tracking a device and unsubscribe from it."""
+        serial = device.serialnumber
+        with self._cond:
+            self._devices.pop(serial, None)
+            self._callbacks.pop(serial, None)
+            self._last_event.pop(serial, None)
+            self._next_poll.pop(serial, None)
+            self._poll_interval.pop(serial, None)
+        self._registry.unregister(device)
+
+    # pylint: disable=invalid-name
+    def on(self, device, type_filter, callback):
+        """
+        Add a state change callback for a device.
+
+        The callback gets pushed events, and a `BinaryState` event for
+        changes that were only found by polling.
+        """
+        self._callbacks[device.serialnumber].append((type_filter, callback))
+
+    def _event(self, device, type_, value):
+        serial = device.serialnumber
+        with self._cond:
+            if serial not in self._devices:
+                return
+            if serial in self._next_poll:
+                LOG.info("Events resumed from %s, stopping polling", device)
+            self._last_event[serial] = time.time()
+            self._next_poll.pop(serial, None)
+            self._poll_interval[serial] = self.min_poll_interval
+        self._notify(device, type_, value)
+
+    def _notify(self, device, type_, value):
+        for type_filter, callback in self._callbacks.get(
+                device.serialnumber, ()):
+            if type_filter is None or type_ == type_filter:
+                callback(device, type_, value)
+
+    def is_polling(self, device, now=None):
+        """Return True if the device is being polled instead of pushed."""
+        with self._cond:
+            last_event = self._last_event.get(device.serialnumber)
+        return self._is_polling(device, last_event, now or time.time())
+
+    def _is_polling(self, device, last_event, now):
+        if last_event is None:
+            return False
+        return (now - last_event > self.quiet_period or
+                not self._registry.is_subscribed(device))
+
+    def last_event_age(self, device):
+        """Return seconds since the last event from the device, or None."""
+        with self._cond:
+            last_event = self._last_event.get(device.serialnumber)
+        if last_event is None:
+            return None
+        return time.time() - last_event
+
+    def poll(self, now=None):
+        """
+        Poll every device that is due.
+
+        Returns the number of seconds until the next poll is due.
+        """
+        now = now or time.time()
+        # Events and unregister() change these from other threads, so work
+        # from a snapshot. The registry isn't called with the lock held.
+        with self._cond:
+            snapshot = [(device, self._last_event.get(serial))
+                        for serial, device in self._devices.items()]
+        next_due = now + self.max_poll_interval
+        for device, last_event in snapshot:
+            serial = device.serialnumber
+            if last_event is None:
+                continue
+            if not self._is_polling(device, last_event, now):
+                next_due = min(next_due, last_event + self.quiet_period)
+                continue
+            with self._cond:
+                if self._last_event.get(serial) != last_event:
+                    # An event arrived, or the device was unregistered.
+                    continue
+                if serial not in self._next_poll:
+                    LOG.info("No recent events from %s, falling back to "
+                             "polling", device)
+                    self._next_poll[serial] = now
+                next_poll = self._next_poll[serial]
+            if next_poll <= now:
+                self._poll_device(device, now)
+                with self._cond:
+                    next_poll = self._next_poll.get(serial)
+                if next_poll is None:
+                    continue
+            next_due = min(next_due, next_poll)
+        return max(next_due - now, 0)
+
+    def _poll_device(self, device, now):
+        serial = device.serialnumber
+        with self._cond:
+            interval = self._poll_interval.get(serial, self.min_poll_interval)
+        try:
+            before = device.get_state()
+            after = device.get_state(force_update=True)
+        except (ActionException, requests.exceptions.RequestException) as ex:
+            LOG.warning("Unable to poll %s (%s)", device, ex)
+            after = before = None
+
+        if before != after:
+            interval = self.min_poll_interval
+            if self._registry.is_subscribed(device):
+                LOG.warning("Missed an event from %s, resubscribing", device)
+                self._registry.register(device)
+            self._notify(device, 'BinaryState', str(after))
+        else:
+            interval = min(interval * 2, self.max_poll_interval)
+
+        with self._cond:
+            if serial in self._devices:
+                self._poll_interval[serial] = interval
+                self._next_poll[serial] = now + interval
+
+    def start(self):
+        """Start the polling thread."""
+        self._exiting = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='Wemo State Engine Thread')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the polling thread."""
+        with self._cond:
+            self._exiting = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        """Run the polling loop."""
+        while not self._exiting:
+            try:
+                delay = self.poll()
+            except Exception:  # pylint: disable=broad-except
+                # Keep polling the other devices if a device or a callback
+                # fails in an unexpected way.
+                LOG.exception("Polling failed")
+                delay = self.min_poll_interval
+            with self._cond:
+                if not self._exiting:
+                    self._cond.wait(delay)
@@ -1,12 +1,15 @@
 """Module to listen for wemo events."""
 import collections
+import json
 import logging
+import os
 import sched
 import socket
 import time
 import threading
 
 from xml.etree import cElementTree
+from xml.sax.saxutils import escape
 
 try:
     import BaseHTTPServer
@@ -19,6 +22,12 @@ LOG = logging.getLogger(__name__)
 NS = "{urn:schemas-upnp-org:event-1-0}"
 SUCCESS = '<html><body><h1>200 OK</h1></body></html>'
 SUBSCRIPTION_RETRY = 60
+UNSUBSCRIBE_TIMEOUT = 5
+# Saved subscriptions that no registered device has claimed after this many
+# seconds are unsubscribed.
+UNCLAIMED_SUBSCRIPTION_GRACE = 300
+# Events that are delivered immediately even when coalescing is enabled.
+COALESCE_BYPASS = ('BinaryState',)
 
 
 class SubscriptionRegistryFailed(Exception):
@@ -39,6 +48,36 @@ def get_ip_address(host='1.2.3.4'):
         del sock
 
 
+def event_services(device):
+    """Return the names of the services to subscribe to for a device."""
+    return [name for name in getattr(device, 'EVENT_SERVICES', ('basicevent',))
+            if name in device.services]
+
+
+def merge_attribute_lists(old, new):
+    """
+    Merge two `attributeList` event values.
+
+    The result contains one attribute per name, holding the most recent
+    value. If either value can't be parsed the newer one is returned as-is.
+    """
+    merged = collections.OrderedDict()
+    for blob in (old, new):
+        blob = "<attributes>" + blob + "</attributes>"
+        blob = blob.replace("&gt;", ">").replace("&lt;", "<")
+        try:
+            attributes = cElementTree.fromstring(blob)
+        except cElementTree.ParseError:
+            return new
+        for attribute in attributes:
+            if len(attribute) >= 2:
+                merged[attribute[0].text] = attribute[1].text
+    return ''.join(
+        '<attribute><name>%s</name><value>%s</value></attribute>' % (
+            escape(name or ''), escape(value or ''))
+        for name, value in merged.items())
+
+
 class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """Handles subscription responses received from devices."""
 
@@ -47,7 +86,7 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         """Handle subscription responses received from devices."""
         sender_ip, _ = self.client_address
         outer = self.server.outer
-        device = outer.devices.get(sender_ip)
+        device = outer.device_for_event(self.headers.get('SID'), sender_ip)
         content_len = int(self.headers.get('content-length', 0))
         data = self.rfile.read(content_len)
         if device is None:
@@ -57,7 +96,7 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             data = data.decode("UTF-8").split("\n\n")[0]
             doc = cElementTree.fromstring(data)
             for propnode in doc.findall('./{0}property'.format(NS)):
-                for property_ in propnode.getchildren():
+                for property_ in list(propnode):
                     text = property_.text
                     outer.event(device, property_.tag, text)
 
@@ -77,15 +116,31 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 class SubscriptionRegistry:
     """Class for subscribing to wemo events."""
 
-    def __init__(self):
-        """Create the subscription registry object."""
+    def __init__(self, state_file=None):
+        """
+        Create the subscription registry object.
+
+        If `state_file` is given, active subscriptions are saved to it so
+        that a restarted registry can renew them instead of subscribing
+        from scratch.
+        """
         self.devices = {}
+        self._state_file = state_file
+        self._subscriptions = {}
+        self._saved_subscriptions = {}
+        self._sid_index = {}
         self._callbacks = collections.defaultdict(list)
+        self._coalesce = collections.defaultdict(dict)
+        self._coalesce_bypass = {}
+        self._pending = {}
+        self._last_delivery = {}
         self._exiting = False
 
         self._event_thread = None
         self._event_thread_cond = threading.Condition()
         self._events = {}
+        self._flush_events = {}
+        self._unclaimed_event = None
 
         def sleep(secs):
             with self._event_thread_cond:
@@ -103,11 +158,33 @@ class SubscriptionRegistry:
             return
 
         LOG.info("Subscribing to events from %r", device)
-        self.devices[device.host] = device
 
         with self._event_thread_cond:
-            self._events[device.serialnumber] = (
-                self._sched.enter(0, 0, self._resubscribe, [device]))
+            # Drop the entry for the device's previous address, if it moved.
+            for host, known in list(self.devices.items()):
+                if known.serialnumber == device.serialnumber:
+                    del self.devices[host]
+            self.devices[device.host] = device
+            for service in event_services(device):
+                key = (device.serialnumber, service)
+                sid = None
+                saved = self._saved_subscriptions.pop(key, None)
+                if saved is not None:
+                    if (saved['url'] == device.services[service].eventSubURL
+                            and saved['callback'] ==
+                            self._callback_url(device)):
+                        LOG.info("Renewing saved %s subscription for %r",
+                                 service, device)
+                        sid = saved['sid']
+                        self._sid_index[sid] = device
+                        # A renewal sends no CALLBACK, so keep the saved one.
+                        self._subscriptions[key] = saved
+                    else:
+                        self._sched.enter(
+                            0, 1, self._unsubscribe_stale, [[saved]])
+                self._cancel_event(key)
+                self._events[key] = self._sched.enter(
+                    0, 0, self._resubscribe, [device, service, sid])
             self._event_thread_cond.notify()
 
     def unregister(self, device):
@@ -120,39 +197,89 @@ class SubscriptionRegistry:
 
         with self._event_thread_cond:
             # Remove any events, callbacks, and the device itself
-            if self._callbacks[device.serialnumber] is not None:
-                del self._callbacks[device.serialnumber]
-            if self._events[device.serialnumber] is not None:
-                del self._events[device.serialnumber]
-            if self.devices[device.host] is not None:
+            self._callbacks.pop(device.serialnumber, None)
+            for key in [key for key in self._events
+                        if key[0] == device.serialnumber]:
+                self._cancel_event(key)
+            if self.devices.get(device.host) is device:
                 del self.devices[device.host]
+            self._coalesce.pop(device.serialnumber, None)
+            self._coalesce_bypass.pop(device.serialnumber, None)
+            for key in [key for key in self._flush_events
+                        if key[0] == device.serialnumber]:
+                try:
+                    self._sched.cancel(self._flush_events.pop(key))
+                except ValueError:
+                    pass
+                self._pending.pop(key, None)
+            keys = [key for key in self._subscriptions
+                    if key[0] == device.serialnumber]
+            for key in keys:
+                self._sid_index.pop(self._subscriptions.pop(key)['sid'], None)
+            if keys:
+                self._save_state()
 
             self._event_thread_cond.notify()
 
-    def _resubscribe(self, device, sid=None, retry=0):
-        LOG.info("Resubscribe for %s", device)
+    def _cancel_event(self, key):
+        """Cancel the scheduled (re)subscription for a device service."""
+        event = self._events.pop(key, None)
+        if event is not None:
+            try:
+                self._sched.cancel(event)
+            except ValueError:
+                # event might execute and be removed from queue
+                # concurrently.  Safe to ignore
+                pass
+
+    def device_for_event(self, sid, host):
+        """
+        Return the registered device that sent an event.
+
+        Devices are looked up by subscription ID first, so events are routed
+        correctly when a device changes address or several devices share
+        one. The sender's address is only used for events without a known
+        SID.
+        """
+        with self._event_thread_cond:
+            device = self._sid_index.get(sid) if sid else None
+            if device is None:
+                return self.devices.get(host)
+        if device.host != host:
+            LOG.debug("Event for %r came from %s, expected %s",
+                      device, host, device.host)
+        return device
+
+    def is_subscribed(self, device):
+        """Return True if all of the device's event subscriptions are live."""
+        now = time.time()
+        with self._event_thread_cond:
+            records = [self._subscriptions.get((device.serialnumber, service))
+                       for service in event_services(device)]
+        return all(record is not None and record['expiry'] > now
+                   for record in records)
+
+    def _callback_url(self, device):
+        host = get_ip_address(host=device.host)
+        return '<http://%s:%d>' % (host, self._port)
+
+    def _resubscribe(self, device, service, sid=None, retry=0):
+        LOG.info("Resubscribe %s for %s", service, device)
         headers = {'TIMEOUT': '300'}
         if sid is not None:
             headers['SID'] = sid
         else:
-            host = get_ip_address(host=device.host)
             headers.update({
-                "CALLBACK": '<http://%s:%d>' % (host, self._port),
+                "CALLBACK": self._callback_url(device),
                 "NT": "upnp:event"
             })
         try:
-            # Basic events
-            self._url_resubscribe(device, headers, sid,
-                                  device.basicevent.eventSubURL)
-            # Insight events
-            # if hasattr(device, 'insight'):
-            #     self._url_resubscribe(
-            #         device, headers, sid, device.insight.eventSubURL)
-
+            self._url_resubscribe(device, service, headers, sid,
+                                  device.services[service].eventSubURL)
         except requests.exceptions.RequestException as ex:
             LOG.warning(
-                "Resubscribe error for %s (%s), will retry in %ss",
-                device, ex, SUBSCRIPTION_RETRY)
+                "Resubscribe error for %s %s (%s), will retry in %ss",
+                device, service, ex, SUBSCRIPTION_RETRY)
             retry += 1
             if retry > 1:
                 # If this wasn't a one-off, try rediscovery
@@ -160,12 +287,12 @@ class SubscriptionRegistry:
                 if device.rediscovery_enabled:
                     device.reconnect_with_device()
             with self._event_thread_cond:
-                self._events[device.serialnumber] = (
+                self._events[(device.serialnumber, service)] = (
                     self._sched.enter(SUBSCRIPTION_RETRY,
                                       0, self._resubscribe,
-                                      [device, sid, retry]))
+                                      [device, service, sid, retry]))
 
-    def _url_resubscribe(self, device, headers, sid, url):
+    def _url_resubscribe(self, device, service, headers, sid, url):
         request_headers = headers.copy()
         response = requests.request(method="SUBSCRIBE", url=url,
                                     headers=request_headers)
@@ -174,24 +301,176 @@ class SubscriptionRegistry:
             # start over.
             requests.request(
                 method='UNSUBSCRIBE', url=url, headers={'SID': sid})
-            return self._resubscribe(device)
+            with self._event_thread_cond:
+                self._sid_index.pop(sid, None)
+            return self._resubscribe(device, service)
         timeout = int(response.headers.get('timeout', '1801').replace(
             'Second-', ''))
-        sid = response.headers.get('sid', sid)
+        old_sid, sid = sid, response.headers.get('sid', sid)
+        key = (device.serialnumber, service)
         with self._event_thread_cond:
-            self._events[device.serialnumber] = (
+            if old_sid != sid:
+                self._sid_index.pop(old_sid, None)
+            self._sid_index[sid] = device
+            self._events[key] = (
                 self._sched.enter(int(timeout * 0.75),
-                                  0, self._resubscribe, [device, sid]))
+                                  0, self._resubscribe,
+                                  [device, service, sid]))
+            self._subscriptions[key] = {
+                'serial': device.serialnumber,
+                'service': service,
+                'host': device.host,
+                'sid': sid,
+                'expiry': time.time() + timeout,
+                'port': self._port,
+                'callback': headers.get('CALLBACK', self._subscriptions.get(
+                    key, {}).get('callback')),
+                'url': url,
+            }
+            self._save_state()
+
+    def _load_state(self):
+        """Read subscriptions saved by a previous run."""
+        if not self._state_file or not os.path.exists(self._state_file):
+            return {}
+        try:
+            with open(self._state_file) as state_file:
+                records = json.load(state_file)
+            return {(record['serial'], record.get('service', 'basicevent')):
+                    record for record in records}
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            LOG.warning("Ignoring unreadable subscription state %s (%s)",
+                        self._state_file, ex)
+            return {}
+
+    def _save_state(self):
+        """Write active subscriptions to the state file, if enabled."""
+        if not self._state_file:
+            return
+        now = time.time()
+        records = dict(self._saved_subscriptions)
+        records.update(self._subscriptions)
+        records = [record for record in records.values()
+                   if record['expiry'] > now]
+        tmp_file = self._state_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as state_file:
+                json.dump(records, state_file, indent=1)
+            os.replace(tmp_file, self._state_file)
+        except OSError as ex:
+            LOG.warning("Unable to save subscription state %s (%s)",
+                        self._state_file, ex)
+
+    def _unsubscribe_stale(self, records):
+        """Cancel saved subscriptions that can't be renewed."""
+        for record in records:
+            LOG.info("Unsubscribing stale subscription %s for %s",
+                     record['sid'], record['serial'])
+            try:
+                requests.request(
+                    method='UNSUBSCRIBE', url=record['url'],
+                    headers={'SID': record['sid']},
+                    timeout=UNSUBSCRIBE_TIMEOUT)
+            except requests.exceptions.RequestException as ex:
+                LOG.debug("Unsubscribe failed for %s (%s)",
+                          record['serial'], ex)
+
+    def _unsubscribe_unclaimed(self):
+        """Cancel saved subscriptions that no device has claimed."""
+        with self._event_thread_cond:
+            self._unclaimed_event = None
+            records = list(self._saved_subscriptions.values())
+            self._saved_subscriptions.clear()
+            if records:
+                self._save_state()
+        self._unsubscribe_stale(records)
 
     def event(self, device, type_, value):
         """Execute the callback for a received event."""
         LOG.info("Received event from %s(%s) - %s %s",
                  device, device.host, type_, value)
+        try:
+            device.subscription_update(type_, value)
+        except (ValueError, TypeError, cElementTree.ParseError) as ex:
+            LOG.warning("Unable to parse %s event from %s (%s)",
+                        type_, device, ex)
+        window = self._coalesce_window(device, type_)
+        if window:
+            with self._event_thread_cond:
+                value = self._coalesce_event(device, type_, value, window)
+            if value is None:
+                return
+        self._deliver(device, type_, value)
+
+    def _deliver(self, device, type_, value):
         for type_filter, callback in self._callbacks.get(
                 device.serialnumber, ()):
             if type_filter is None or type_ == type_filter:
                 callback(device, type_, value)
 
+    def _coalesce_window(self, device, type_):
+        windows = self._coalesce.get(device.serialnumber)
+        if not windows:
+            return None
+        if type_ in self._coalesce_bypass.get(device.serialnumber, ()):
+            return None
+        return windows.get(type_, windows.get(None))
+
+    def _coalesce_event(self, device, type_, value, window):
+        """
+        Hold back an event that arrives within the coalescing window.
+
+        Returns the value to deliver now, or None if the event was queued
+        for a later flush.
+        """
+        key = (device.serialnumber, type_)
+        if key in self._pending:
+            if type_ == 'attributeList':
+                value = merge_attribute_lists(self._pending[key], value)
+            self._pending[key] = value
+            return None
+
+        now = time.time()
+        last = self._last_delivery.get(key)
+        if last is None or now - last >= window:
+            self._last_delivery[key] = now
+            return value
+
+        self._pending[key] = value
+        self._flush_events[key] = self._sched.enter(
+            last + window - now, 0, self._flush_event, [device, type_])
+        self._event_thread_cond.notify()
+        return None
+
+    def _flush_event(self, device, type_):
+        key = (device.serialnumber, type_)
+        with self._event_thread_cond:
+            self._flush_events.pop(key, None)
+            if key not in self._pending:
+                return
+            value = self._pending.pop(key)
+            self._last_delivery[key] = time.time()
+        self._deliver(device, type_, value)
+
+    def coalesce(self, device, window, type_filter=None,
+                 bypass=COALESCE_BYPASS):
+        """
+        Deliver events from a device at most once per `window` seconds.
+
+        The first event in a window is delivered right away. Later events
+        are held back and only the newest value is delivered when the window
+        ends; `attributeList` values are merged instead. `type_filter`
+        limits coalescing to one property, and event types in `bypass` are
+        never held back. A window of 0 or None disables coalescing.
+        """
+        with self._event_thread_cond:
+            if window:
+                self._coalesce[device.serialnumber][type_filter] = window
+            else:
+                self._coalesce[device.serialnumber].pop(type_filter, None)
+            self._coalesce_bypass[device.serialnumber] = frozenset(
+                bypass or ())
+
     # pylint: disable=invalid-name
     def on(self, device, type_filter, callback):
         """Add an event callback for a device."""
@@ -199,8 +478,12 @@ class SubscriptionRegistry:
 
     def _find_port(self):
         """Find a valid open port to run the HTTP server on."""
-        for i in range(0, 128):
-            port = 8989 + i
+        # Prefer the port used by saved subscriptions so they stay valid.
+        saved_ports = [record['port']
+                       for record in self._saved_subscriptions.values()]
+        ports = [port for port, _ in
+                 collections.Counter(saved_ports).most_common()]
+        for port in ports + list(range(8989, 8989 + 128)):
             try:
                 self._httpd = BaseHTTPServer.HTTPServer(
                     ('', port), RequestHandler)
@@ -209,13 +492,32 @@ class SubscriptionRegistry:
             except (OSError, socket.error):
                 continue
 
-    def start(self):
-        """Start the subscription registry."""
+    def start(self, unclaimed_grace=UNCLAIMED_SUBSCRIPTION_GRACE):
+        """
+        Start the subscription registry.
+
+        Saved subscriptions that no device has been registered for within
+        `unclaimed_grace` seconds are unsubscribed. None keeps them until
+        they expire.
+        """
+        now = time.time()
+        self._saved_subscriptions = {
+            serial: record for serial, record in self._load_state().items()
+            if record['expiry'] > now}
         self._port = None
         self._find_port()
         if self._port is None:
             raise SubscriptionRegistryFailed(
                 'Unable to bind a port for listening')
+        stale = [key for key, record in self._saved_subscriptions.items()
+                 if record['port'] != self._port]
+        stale = [self._saved_subscriptions.pop(key) for key in stale]
+        with self._event_thread_cond:
+            if stale:
+                self._sched.enter(0, 1, self._unsubscribe_stale, [stale])
+            if self._saved_subscriptions and unclaimed_grace is not None:
+                self._unclaimed_event = self._sched.enter(
+                    unclaimed_grace, 1, self._unsubscribe_unclaimed)
         self._http_thread = threading.Thread(target=self._run_http_server,
                                              name='Wemo HTTP Thread')
         self._http_thread.deamon = True
@@ -234,7 +536,11 @@ class SubscriptionRegistry:
             self._exiting = True
 
             # Remove any pending events
-            for event in self._events.values():
+            events = (list(self._events.values()) +
+                      list(self._flush_events.values()))
+            if self._unclaimed_event is not None:
+                events.append(self._unclaimed_event)
+            for event in events:
                 try:
                     self._sched.cancel(event)
                 except ValueError:
@@ -0,0 +1,231 @@
+"""Compact on-disk history of controller telemetry.
+
+Samples (temperature, humidity, HVAC status, ...) and events (device switched
+on or off) are appended to a fixed-size ring buffer in a memory-mapped file.
+Once the file is full the oldest records are overwritten, so it never grows,
+and writes land in the page cache instead of rewriting a text log line by line.
+
+File layout: a header holding the ring position and a table of series names,
+followed by `capacity` fixed-size records of (timestamp, series, kind, value).
+Records are expected to be appended in time order; queries binary search on
+the timestamp.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b"WNMREC1\0"
+# magic, record size, capacity, next record index, record count
+HEADER = struct.Struct("<8sIIQQ")
+MAX_SERIES = 256
+SERIES_NAME_SIZE = 48
+# timestamp, series index, kind, value
+RECORD = struct.Struct("<dHHxxxxd")
+DATA_OFFSET = HEADER.size + MAX_SERIES * SERIES_NAME_SIZE
+DEFAULT_CAPACITY = 500000
+
+SAMPLE = 0
+EVENT = 1
+
+
+class Recorder:
+    """A ring buffer of (timestamp, series, kind, value) records in a file."""
+
+    def __init__(self, path, capacity=None):
+        """Open the recorder at `path`, creating it if needed.
+
+        An existing file keeps the capacity it was created with; opening it
+        with a different capacity raises ValueError. A capacity of None opens
+        an existing file as it is, or creates one with DEFAULT_CAPACITY.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, "r+b" if exists else "w+b")
+        try:
+            if not exists:
+                capacity = capacity or DEFAULT_CAPACITY
+                self._file.truncate(DATA_OFFSET + capacity * RECORD.size)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            if exists:
+                capacity = self._check_header(capacity)
+            else:
+                HEADER.pack_into(self._map, 0, MAGIC, RECORD.size, capacity, 0, 0)
+        except Exception:
+            self._file.close()
+            raise
+        self.capacity = capacity
+        self._series = {}
+        for index in range(MAX_SERIES):
+            offset = HEADER.size + index * SERIES_NAME_SIZE
+            name = self._map[offset : offset + SERIES_NAME_SIZE].rstrip(b"\0")
+            if not name:
+                break
+            self._series[name.decode("utf-8")] = index
+        self._names = {index: name for name, index in self._series.items()}
+
+    def _check_header(self, capacity):
+        # Returns the capacity of an existing file.
+        magic, record_size, file_capacity, _, _ = HEADER.unpack_from(self._map, 0)
+        if (
+            magic != MAGIC
+            or record_size != RECORD.size
+            or len(self._map) != DATA_OFFSET + file_capacity * RECORD.size
+        ):
+            raise ValueError("{} is not a recorder file".format(self.path))
+        if capacity is not None and capacity != file_capacity:
+            raise ValueError(
+                "{} was created with capacity {}, not {}".format(
+                    self.path, file_capacity, capacity
+                )
+            )
+        return file_capacity
+
+    def _position(self):
+        _, _, _, head, count = HEADER.unpack_from(self._map, 0)
+        return head, count
+
+    def _series_index(self, name):
+        index = self._series.get(name)
+        if index is not None:
+            return index
+        encoded = name.encode("utf-8")
+        if len(encoded) > SERIES_NAME_SIZE:
+            raise ValueError("Series name is too long: {!r}".format(name))
+        index = len(self._series)
+        if index >= MAX_SERIES:
+            raise ValueError("Too many series, can't add {!r}".format(name))
+        offset = HEADER.size + index * SERIES_NAME_SIZE
+        self._map[offset : offset + SERIES_NAME_SIZE] = encoded.ljust(
+            SERIES_NAME_SIZE, b"\0"
+        )
+        self._series[name] = index
+        self._names[index] = name
+        return index
+
+    def record(self, series, value, kind=SAMPLE, timestamp=None):
+        """Append one record. `timestamp` defaults to now."""
+        with self._lock:
+            # Stamped under the lock so records from several threads stay in
+            # time order.
+            if timestamp is None:
+                timestamp = time.time()
+            index = self._series_index(series)
+            head, count = self._position()
+            RECORD.pack_into(
+                self._map,
+                DATA_OFFSET + head * RECORD.size,
+                timestamp,
+                index,
+                kind,
+                float(value),
+            )
+            HEADER.pack_into(
+                self._map,
+                0,
+                MAGIC,
+                RECORD.size,
+                self.capacity,
+                (head + 1) % self.capacity,
+                min(count + 1, self.capacity),
+            )
+
+    def event(self, series, value, timestamp=None):
+        """Append an event record, e.g. a device being switched."""
+        self.record(series, value, EVENT, timestamp)
+
+    def __len__(self):
+        with self._lock:
+            return self._position()[1]
+
+    def series(self):
+        """Return the names of all recorded series."""
+        with self._lock:
+            return list(self._series)
+
+    def _read(self, head, count, position):
+        # Reads the record at a logical position, oldest first.
+        slot = (head - count + position) % self.capacity
+        return RECORD.unpack_from(self._map, DATA_OFFSET + slot * RECORD.size)
+
+    def _first_at_or_after(self, head, count, timestamp):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._read(head, count, middle)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, series=None, start=None, end=None, kind=None):
+        """Return (timestamp, series, kind, value) records, oldest first.
+
+        Records are filtered to one series name (or a collection of names), a
+        kind, and the time range start <= timestamp < end. None means no
+        filter.
+        """
+        if isinstance(series, str):
+            series = {series}
+        with self._lock:
+            if series is not None:
+                indexes = {
+                    self._series[name] for name in series if name in self._series
+                }
+                if not indexes:
+                    return []
+            head, count = self._position()
+            position = 0
+            if start is not None:
+                position = self._first_at_or_after(head, count, start)
+            records = []
+            for position in range(position, count):
+                timestamp, index, record_kind, value = self._read(head, count, position)
+                if end is not None and timestamp >= end:
+                    break
+                if series is not None and index not in indexes:
+                    continue
+                if kind is not None and record_kind != kind:
+                    continue
+                records.append((timestamp, self._names[index], record_kind, value))
+            return records
+
+    def downsample(self, series, interval, start=None, end=None):
+        """Aggregate one series into buckets of `interval` seconds.
+
+        Returns a list of (bucket start, count, min, max, mean) for each bucket
+        with at least one record, oldest first.
+        """
+        buckets = []
+        for timestamp, _, _, value in self.query(series, start, end):
+            bucket = timestamp - timestamp % interval
+            if buckets and buckets[-1][0] == bucket:
+                _, count, low, high, total = buckets[-1]
+                buckets[-1] = (
+                    bucket,
+                    count + 1,
+                    min(low, value),
+                    max(high, value),
+                    total + value,
+                )
+            else:
+                buckets.append((bucket, 1, value, value, value))
+        return [
+            (bucket, count, low, high, total / count)
+            for bucket, count, low, high, total in buckets
+        ]
+
+    def flush(self):
+        """Write dirty pages to disk now rather than when the kernel chooses."""
+        with self._lock:
+            self._map.flush()
+
+    def close(self):
+        """Flush and close the file."""
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
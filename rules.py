@@ -0,0 +1,383 @@
+"""Declarative device rules, compiled from [rule <name>] sections in config.ini.
+
+A rule turns devices on while a condition holds:
+
+    [rule Dry air]
+    When = humidity < 38
+    Until = humidity > 42
+    Wemo = ["Humidifier"]
+    Cooldown = 600
+
+Conditions compare inputs with values, joined with and, or, not and
+parentheses. Inputs are a zone's thermostat readings (see thermostat_inputs),
+raw SDM traits such as sdm.devices.traits.Humidity.ambientHumidityPercent, and
+WeMo device states written wemo[Device name], compared with on or off.
+
+A rule activates when When is true. It is released when Until is true, or when
+When turns false if there is no Until; a separate Until gives the rule
+hysteresis. Cooldown is the minimum number of seconds between a rule's changes.
+While active, a rule keeps its Wemo devices on and sends FanAction (default
+"SetSpeed 1") to its Bond FanIds; on release the devices are turned off and
+ReleaseAction (default "TurnOff") is sent. Zone limits a rule to one zone.
+
+Rules are indexed by the inputs their conditions read, so each cycle only
+re-evaluates the rules whose inputs changed, plus any waiting out a cooldown.
+"""
+
+import json
+import operator
+import re
+
+RULE_PREFIX = "rule "
+
+COMPARISONS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<paren>[()])
+        |(?P<op><=|>=|==|!=|<|>)
+        |(?P<string>"[^"]*"|'[^']*')
+        |(?P<number>[-+]?\d+(?:\.\d+)?)
+        |(?P<device>wemo\[[^\]]+\])
+        |(?P<word>[A-Za-z_][\w.]*)
+    )""",
+    re.VERBOSE,
+)
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if not match or match.end() == position:
+            raise ValueError("Unexpected {!r}".format(text[position:]))
+        position = match.end()
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+    return tokens
+
+
+class Condition:
+    """A compiled condition: call it with a dict of inputs."""
+
+    def __init__(self, text):
+        """Compile `text`. Raises ValueError on a syntax error."""
+        self.text = text
+        self.inputs = set()
+        self._tokens = tokenize(text)
+        self._position = 0
+        if not self._tokens:
+            raise ValueError("Empty condition")
+        self._evaluate = self._parse_or()
+        if self._position != len(self._tokens):
+            raise ValueError(
+                "Unexpected {!r} in {!r}".format(self._tokens[self._position][1], text)
+            )
+        del self._tokens
+
+    def __call__(self, inputs):
+        """Return True if the condition holds for `inputs`."""
+        return self._evaluate(inputs)
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError("Incomplete condition {!r}".format(self.text))
+        self._position += 1
+        return token
+
+    def _parse_or(self):
+        terms = [self._parse_and()]
+        while self._peek() == ("word", "or"):
+            self._next()
+            terms.append(self._parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda inputs: any(term(inputs) for term in terms)
+
+    def _parse_and(self):
+        terms = [self._parse_not()]
+        while self._peek() == ("word", "and"):
+            self._next()
+            terms.append(self._parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda inputs: all(term(inputs) for term in terms)
+
+    def _parse_not(self):
+        if self._peek() == ("word", "not"):
+            self._next()
+            term = self._parse_not()
+            return lambda inputs: not term(inputs)
+        if self._peek() == ("paren", "("):
+            self._next()
+            term = self._parse_or()
+            if self._next() != ("paren", ")"):
+                raise ValueError("Missing ) in {!r}".format(self.text))
+            return term
+        return self._parse_comparison()
+
+    def _parse_comparison(self):
+        kind, name = self._next()
+        if kind not in ("word", "device") or name in ("and", "or", "not"):
+            raise ValueError("Expected an input, got {!r}".format(name))
+        kind, op = self._next()
+        if kind != "op":
+            raise ValueError(
+                "Expected a comparison after {}, got {!r}".format(name, op)
+            )
+        compare = COMPARISONS[op]
+        value = self._parse_value(name)
+        self.inputs.add(name)
+
+        def comparison(inputs):
+            current = inputs.get(name)
+            if current is None:
+                return False
+            try:
+                return compare(current, value)
+            except TypeError:
+                return False
+
+        return comparison
+
+    def _parse_value(self, name):
+        kind, value = self._next()
+        if kind == "number":
+            return float(value)
+        if kind == "string":
+            value = value[1:-1]
+        elif kind != "word":
+            raise ValueError("Expected a value, got {!r}".format(value))
+        if name.startswith("wemo["):
+            if value.lower() not in ("on", "off"):
+                raise ValueError("{} can only be on or off".format(name))
+            return int(value.lower() == "on")
+        return value.upper()
+
+
+def parse_action(text):
+    # "SetSpeed 2" -> ("SetSpeed", 2). "TurnOff" -> ("TurnOff", None).
+    parts = text.split()
+    if not parts or len(parts) > 2:
+        raise ValueError("Bad Bond action {!r}".format(text))
+    argument = None
+    if len(parts) == 2:
+        argument = json.loads(parts[1])
+    return parts[0], argument
+
+
+class Rule:
+    """One compiled rule."""
+
+    def __init__(
+        self,
+        name,
+        when,
+        until=None,
+        wemo=(),
+        fan_ids=(),
+        fan_action="SetSpeed 1",
+        release_action="TurnOff",
+        cooldown=0,
+        zone=None,
+    ):
+        """Compile a rule. Raises ValueError naming the rule if it is invalid."""
+        self.name = name
+        try:
+            self.when = Condition(when)
+            self.until = Condition(until) if until else None
+            self.fan_action = parse_action(fan_action)
+            self.release_action = parse_action(release_action)
+        except ValueError as e:
+            raise ValueError("Rule {!r}: {}".format(name, e))
+        self.wemo = set(wemo)
+        self.fan_ids = set(fan_ids)
+        self.cooldown = cooldown
+        self.zone = zone or None
+        self.inputs = set(self.when.inputs)
+        if self.until is not None:
+            self.inputs |= self.until.inputs
+
+    def wants_active(self, inputs, active):
+        if not active:
+            return self.when(inputs)
+        if self.until is not None:
+            return not self.until(inputs)
+        return self.when(inputs)
+
+
+def load_rules(config):
+    """Compile every [rule <name>] section of a ConfigParser."""
+    rules = []
+    for section in config.sections():
+        if not section.startswith(RULE_PREFIX):
+            continue
+        options = config[section]
+        name = section[len(RULE_PREFIX) :].strip()
+        try:
+            wemo = json.loads(options.get("Wemo", "[]"))
+            fan_ids = json.loads(options.get("FanIds", "[]"))
+            cooldown = float(options.get("Cooldown", "0"))
+        except ValueError as e:
+            raise ValueError("Rule {!r}: {}".format(name, e))
+        try:
+            rule = Rule(
+                name,
+                options["When"],
+                until=options.get("Until"),
+                wemo=wemo,
+                fan_ids=fan_ids,
+                fan_action=options.get("FanAction", "SetSpeed 1"),
+                release_action=options.get("ReleaseAction", "TurnOff"),
+                cooldown=cooldown,
+                zone=options.get("Zone"),
+            )
+        except KeyError:
+            raise ValueError("Rule {!r} has no When condition".format(section))
+        rules.append(rule)
+    return rules
+
+
+class RuleEngine:
+    """Evaluates a set of rules against successive input snapshots."""
+
+    def __init__(self, rules):
+        """Build the evaluation plan: which rules read which inputs."""
+        self.rules = list(rules)
+        self.active = set()
+        self.evaluated = 0
+        self._order = {rule: index for index, rule in enumerate(self.rules)}
+        self._by_input = {}
+        for rule in self.rules:
+            for name in rule.inputs:
+                self._by_input.setdefault(name, []).append(rule)
+        # wemo[...] inputs the caller needs to look up.
+        self.device_inputs = {
+            name for name in self._by_input if name.startswith("wemo[")
+        }
+        self._inputs = None
+        self._changed_at = {}
+        # Rules that wanted to change during their cooldown.
+        self._deferred = set()
+
+    def take_over(self, previous):
+        """Carry over which rules are active from an engine being replaced.
+
+        Rules are matched by name. Returns the active rules of `previous` that
+        have no match here, so the caller can release them.
+        """
+        by_name = {rule.name: rule for rule in self.rules}
+        removed = []
+        for rule in previous.active:
+            current = by_name.get(rule.name)
+            if current is None:
+                removed.append(rule)
+                continue
+            self.active.add(current)
+            if rule in previous._changed_at:
+                self._changed_at[current] = previous._changed_at[rule]
+        return removed
+
+    def retry(self, rule):
+        """Undo a change the caller couldn't carry out.
+
+        The rule goes back to its previous state, without a cooldown, and is
+        evaluated again next time even if its inputs don't change.
+        """
+        if rule in self.active:
+            self.active.discard(rule)
+        else:
+            self.active.add(rule)
+        self._changed_at.pop(rule, None)
+        self._deferred.add(rule)
+
+    def evaluate(self, inputs, now):
+        """Return the (rule, active) changes for a new input snapshot."""
+        if self._inputs is None:
+            candidates = set(self.rules)
+        else:
+            candidates = set(self._deferred)
+            for name in set(inputs) | set(self._inputs):
+                if inputs.get(name) != self._inputs.get(name):
+                    candidates.update(self._by_input.get(name, ()))
+        self._inputs = dict(inputs)
+        changes = []
+        for rule in sorted(candidates, key=self._order.get):
+            self.evaluated += 1
+            active = rule in self.active
+            if rule.wants_active(inputs, active) == active:
+                self._deferred.discard(rule)
+                continue
+            changed_at = self._changed_at.get(rule)
+            if changed_at is not None and now - changed_at < rule.cooldown:
+                self._deferred.add(rule)
+                continue
+            self._deferred.discard(rule)
+            self._changed_at[rule] = now
+            if active:
+                self.active.discard(rule)
+            else:
+                self.active.add(rule)
+            changes.append((rule, not active))
+        return changes
+
+
+def thermostat_inputs(thermostat, fahrenheit=False):
+    """Return the named inputs for a thermostat resource.
+
+    temperature, heat_setpoint, cool_setpoint and heat_gap (heat setpoint
+    minus temperature) are in degrees F or C to match the config; the _c
+    versions are always Celsius. hvac_status is OFF, HEATING or COOLING.
+    Every trait field is also available by its full name.
+    """
+    traits = thermostat["traits"]
+    inputs = {}
+    for trait, fields in traits.items():
+        if isinstance(fields, dict):
+            for field, value in fields.items():
+                if isinstance(value, str):
+                    value = value.upper()
+                inputs[trait + "." + field] = value
+
+    def degrees(celsius):
+        return celsius * 9 / 5.0 + 32 if fahrenheit else celsius
+
+    temperature_c = traits.get("sdm.devices.traits.Temperature", {}).get(
+        "ambientTemperatureCelsius"
+    )
+    setpoints = traits.get("sdm.devices.traits.ThermostatTemperatureSetpoint", {})
+    inputs["humidity"] = traits.get("sdm.devices.traits.Humidity", {}).get(
+        "ambientHumidityPercent"
+    )
+    inputs["hvac_status"] = traits.get("sdm.devices.traits.ThermostatHvac", {}).get(
+        "status"
+    )
+    if temperature_c is not None:
+        inputs["temperature_c"] = temperature_c
+        inputs["temperature"] = degrees(temperature_c)
+    for key, name in (
+        ("heatCelsius", "heat_setpoint"),
+        ("coolCelsius", "cool_setpoint"),
+    ):
+        if key in setpoints:
+            inputs[name + "_c"] = setpoints[key]
+            inputs[name] = degrees(setpoints[key])
+    if temperature_c is not None and "heatCelsius" in setpoints:
+        gap_c = setpoints["heatCelsius"] - temperature_c
+        inputs["heat_gap_c"] = gap_c
+        inputs["heat_gap"] = gap_c * 9 / 5.0 if fahrenheit else gap_c
+    return {name: value for name, value in inputs.items() if value is not None}
@@ -0,0 +1,428 @@
+"""Replay a recorded thermostat trace through the wenestmo control loop.
+
+The trace is either a history file written by wenestmo (see HistoryFile in
+config.ini) or a CSV file with the columns
+
+    timestamp,zone,temperature_c,humidity,hvac_status[,heat_setpoint_c,cool_setpoint_c]
+
+Zones and device names come from config.ini, as for a live run, but the WeMo
+plugs and Bond fans are simulated and time runs on a simulated clock. By
+default the replay is paced at 1000x real time; --speed 0 runs it as fast as
+possible. The report shows how often each device switched, how long it was on,
+how long the controller took to react to HVAC changes, and what each control
+iteration cost in wall-clock time.
+
+Example:
+
+    python simulate.py wenestmo_history.rec --aux-heat-threshold 5
+"""
+
+import argparse
+import bisect
+import csv
+import logging
+import sys
+import time
+from concurrent.futures import Future
+
+import pywemo
+import wenestmo
+from metrics import percentile
+from recorder import SAMPLE, Recorder
+
+HVAC_STATUS_NAMES = {code: name for name, code in wenestmo.HVAC_STATUS_CODES.items()}
+FIELDS = (
+    "temperature_c",
+    "humidity",
+    "heat_setpoint_c",
+    "cool_setpoint_c",
+    "hvac_status",
+)
+
+
+class SimClock:
+    """A clock that only moves when the simulation advances it."""
+
+    def __init__(self, now):
+        """Start the clock at `now`."""
+        self.now = now
+
+    def __call__(self):
+        """Return the current simulated time."""
+        return self.now
+
+
+class DeviceLog:
+    """Counts the switches and on-time of one simulated device."""
+
+    def __init__(self, clock):
+        """Track a device that starts off."""
+        self.clock = clock
+        self.on = False
+        self.switches = 0
+        self.on_s = 0.0
+        self._on_since = None
+
+    def set(self, on):
+        """Record the device being switched on or off."""
+        if on == self.on:
+            return
+        self.switches += 1
+        self.on = on
+        if on:
+            self._on_since = self.clock()
+        else:
+            self.on_s += self.clock() - self._on_since
+
+    def total_on_s(self):
+        """Return the on-time so far, including a device that is still on."""
+        if self.on:
+            return self.on_s + self.clock() - self._on_since
+        return self.on_s
+
+
+class SimWemo:
+    """A WeMo plug that switches instantly."""
+
+    def __init__(self, name, mac, clock):
+        """Create a plug that starts off."""
+        self.name = name
+        self.mac = mac
+        self.serialnumber = mac
+        self.host = "sim"
+        self.port = 0
+        self.log = DeviceLog(clock)
+
+    def on(self):
+        """Turn the plug on."""
+        self.log.set(True)
+
+    def off(self):
+        """Turn the plug off."""
+        self.log.set(False)
+
+    def get_state(self, force_update=False):
+        """Return 0 if off and 1 if on."""
+        return int(self.log.on)
+
+    def is_off(self):
+        """Return True if the plug is off."""
+        return not self.log.on
+
+
+class SimBond:
+    """Stands in for bond.BondClient, with fans that switch instantly."""
+
+    def __init__(self, clock):
+        """Create a hub whose fans start off."""
+        self.clock = clock
+        self.fans = {}
+
+    def fan(self, fan_id):
+        """Return the DeviceLog for a fan."""
+        if fan_id not in self.fans:
+            self.fans[fan_id] = DeviceLog(self.clock)
+        return self.fans[fan_id]
+
+    def overridden(self, device_id):
+        """Nobody touches the simulated fans by hand."""
+        return False
+
+    def submit(self, device_ids, action, argument=None, expected=None):
+        """Switch fans and return completed futures, like BondClient.submit."""
+        futures = {}
+        for device_id in device_ids:
+            self.fan(device_id).set(action != "TurnOff")
+            future = Future()
+            future.set_result(True)
+            futures[future] = device_id
+        return futures
+
+
+def load_history(path):
+    """Read a trace from a wenestmo history file.
+
+    Returns a dict of zone name -> list of (timestamp, sample dict).
+    """
+    history = Recorder(path)
+    try:
+        records = history.query(kind=SAMPLE)
+    finally:
+        history.close()
+    trace = {}
+    current = {}
+    for timestamp, series, _, value in records:
+        zone, _, field = series.rpartition("/")
+        if not zone or field not in FIELDS:
+            continue
+        sample = current.setdefault(zone, {})
+        if field == "hvac_status":
+            # Recorded last for each poll, so the sample is complete.
+            sample[field] = HVAC_STATUS_NAMES.get(int(value), "OFF")
+            trace.setdefault(zone, []).append((timestamp, dict(sample)))
+            current[zone] = {}
+        else:
+            sample[field] = value
+    return trace
+
+
+def load_csv(path):
+    """Read a trace from a CSV file (see the module docstring)."""
+    trace = {}
+    with open(path, newline="") as trace_file:
+        for row in csv.DictReader(trace_file):
+            sample = {"hvac_status": row["hvac_status"].strip().upper()}
+            for field in FIELDS[:-1]:
+                if row.get(field):
+                    sample[field] = float(row[field])
+            trace.setdefault(row["zone"], []).append((float(row["timestamp"]), sample))
+    for samples in trace.values():
+        samples.sort(key=lambda item: item[0])
+    return trace
+
+
+def to_thermostat(zone_name, sample):
+    """Build an SDM thermostat resource from a trace sample."""
+    setpoints = {}
+    if "heat_setpoint_c" in sample:
+        setpoints["heatCelsius"] = sample["heat_setpoint_c"]
+    if "cool_setpoint_c" in sample:
+        setpoints["coolCelsius"] = sample["cool_setpoint_c"]
+    return {
+        "name": "enterprises/simulated/devices/" + zone_name,
+        "type": "sdm.devices.types.THERMOSTAT",
+        "traits": {
+            "sdm.devices.traits.Temperature": {
+                "ambientTemperatureCelsius": sample["temperature_c"]
+            },
+            "sdm.devices.traits.Humidity": {
+                "ambientHumidityPercent": sample["humidity"]
+            },
+            "sdm.devices.traits.ThermostatHvac": {"status": sample["hvac_status"]},
+            "sdm.devices.traits.ThermostatTemperatureSetpoint": setpoints,
+        },
+    }
+
+
+# wenestmo globals that a simulation replaces with simulated ones.
+SWAPPED_GLOBALS = (
+    "settings",
+    "zones",
+    "wemo_registry",
+    "bond_client",
+    "clock",
+    "last_iteration_at",
+)
+
+
+def simulate(trace, speed=1000, verbose=False):
+    """Replay `trace` through the controller and return a report dict.
+
+    wenestmo's zones, WeMo registry, Bond client and clock are replaced while
+    it runs, and put back afterwards.
+    """
+    saved = {name: getattr(wenestmo, name) for name in SWAPPED_GLOBALS}
+    try:
+        return replay(trace, speed, verbose)
+    finally:
+        for name, value in saved.items():
+            setattr(wenestmo, name, value)
+
+
+def replay(trace, speed, verbose):
+    # Start every run from fresh zones, as if wenestmo had just launched.
+    wenestmo.zones = wenestmo.read_zones(wenestmo.config, wenestmo.settings)
+    zones = [zone for zone in wenestmo.zones if zone.name in trace]
+    for name in set(trace) - {zone.name for zone in wenestmo.zones}:
+        print("Trace zone {!r} isn't in config.ini, skipping it.".format(name))
+    if not zones:
+        raise ValueError("No zone in the trace matches config.ini")
+    times = {zone: [timestamp for timestamp, _ in trace[zone.name]] for zone in zones}
+    start = min(samples[0] for samples in times.values())
+    end = max(samples[-1] for samples in times.values())
+    clock = SimClock(start)
+
+    # Simulated devices, one per configured name.
+    names = set()
+    for zone in zones:
+        for role_names in zone.role_names.values():
+            names.update(role_names)
+    for rule in wenestmo.settings.rules:
+        names.update(rule.wemo)
+        names.update(
+            name[len("wemo[") : -1] for name in rule.inputs if name.startswith("wemo[")
+        )
+    wemos = {
+        name: SimWemo(name, "SIM{:04d}".format(index), clock)
+        for index, name in enumerate(sorted(names))
+    }
+    wenestmo.wemo_registry = pywemo.DeviceRegistry()
+    wenestmo.wemo_registry.update(wemos.values())
+    bond = SimBond(clock)
+    wenestmo.bond_client = bond
+    wenestmo.clock = clock
+
+    scheduler = wenestmo.PollScheduler(
+        wenestmo.settings.min_polling_period_s,
+        wenestmo.settings.max_polling_period_s,
+        wenestmo.settings.nest_requests_per_hour,
+        clock=clock,
+    )
+    # The trace's HVAC changes that the controller hasn't reacted to yet, and
+    # changes that ended before it polled.
+    pending = {}
+    trace_status = {}
+    missed = [0]
+
+    def read_thermostats(woke_for_event):
+        scheduler.spend()
+        thermostats = {}
+        for zone in wenestmo.zones:
+            if zone not in times:
+                thermostats[zone] = None
+                continue
+            index = bisect.bisect_right(times[zone], clock.now) - 1
+            timestamp, sample = trace[zone.name][max(index, 0)]
+            status = sample["hvac_status"]
+            if zone in trace_status and status != trace_status[zone]:
+                if zone in pending:
+                    missed[0] += 1
+                pending[zone] = (timestamp, status)
+            trace_status[zone] = status
+            thermostats[zone] = to_thermostat(zone.name, sample)
+        return thermostats
+
+    latencies = []
+    costs = []
+    controller = wenestmo.Controller(read_thermostats, scheduler, persist=False)
+    wall_start = time.perf_counter()
+    # The controller's progress is logged at INFO, which is only shown if
+    # verbose. Warnings and errors always are.
+    output = logging.StreamHandler(sys.stdout)
+    level = wenestmo.LOG.level
+    if verbose:
+        wenestmo.LOG.addHandler(output)
+    wenestmo.LOG.setLevel(logging.INFO if verbose else logging.WARNING)
+    try:
+        while clock.now <= end:
+            started = time.perf_counter()
+            controller.run_once()
+            cost = time.perf_counter() - started
+            costs.append(cost)
+            for zone, (timestamp, status) in list(pending.items()):
+                if zone.prev_hvac_status == status:
+                    latencies.append(clock.now - timestamp)
+                    del pending[zone]
+            delay = max(scheduler.next_delay(), 5)
+            if speed:
+                time.sleep(max(delay / speed - cost, 0))
+            clock.now += delay
+    finally:
+        wenestmo.LOG.removeHandler(output)
+        wenestmo.LOG.setLevel(level)
+    clock.now = end
+
+    devices = {name: wemo.log for name, wemo in wemos.items()}
+    devices.update(("fan " + fan, log) for fan, log in bond.fans.items())
+    return {
+        "simulated_s": end - start,
+        "wall_s": time.perf_counter() - wall_start,
+        "iterations": len(costs),
+        "iteration_ms": {
+            "mean": 1000 * sum(costs) / len(costs),
+            "p95": 1000 * percentile(costs, 0.95),
+            "max": 1000 * max(costs),
+        },
+        "latency_s": {
+            "count": len(latencies),
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "max": max(latencies, default=0.0),
+        },
+        "missed_transitions": missed[0],
+        "devices": {
+            name: {"switches": log.switches, "on_s": log.total_on_s()}
+            for name, log in sorted(devices.items())
+        },
+    }
+
+
+def print_report(report):
+    print(
+        "Simulated {:.1f} hours in {:.1f} s, {} iterations.".format(
+            report["simulated_s"] / 3600, report["wall_s"], report["iterations"]
+        )
+    )
+    print(
+        "Iteration cost: mean {mean:.2f} ms, p95 {p95:.2f} ms, "
+        "max {max:.2f} ms".format(**report["iteration_ms"])
+    )
+    print(
+        "Reaction latency over {count} HVAC changes: mean {mean:.0f} s, "
+        "max {max:.0f} s".format(**report["latency_s"])
+    )
+    if report["missed_transitions"]:
+        print(
+            "{} HVAC changes were over before the controller saw them.".format(
+                report["missed_transitions"]
+            )
+        )
+    for name, device in report["devices"].items():
+        share = device["on_s"] / report["simulated_s"] if report["simulated_s"] else 0
+        print(
+            "  {}: {} switches, on {:.1f} h ({:.0%})".format(
+                name, device["switches"], device["on_s"] / 3600, share
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("trace", help="wenestmo history file, or a .csv trace")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1000,
+        help="multiple of real time to replay at; 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--aux-heat-threshold",
+        type=float,
+        help="override AuxHeatThreshold (in the config's units)",
+    )
+    parser.add_argument(
+        "--humidity-target", type=float, help="override HumidityPercentTarget"
+    )
+    parser.add_argument(
+        "--humidity-threshold", type=float, help="override HumidityPercentThreshold"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the controller's output"
+    )
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    if args.aux_heat_threshold is not None:
+        overrides["aux_heat_threshold_c"] = (
+            args.aux_heat_threshold * 5 / 9.0
+            if wenestmo.settings.fahrenheit
+            else args.aux_heat_threshold
+        )
+    if args.humidity_target is not None:
+        overrides["humidity_percent_target"] = args.humidity_target
+    if args.humidity_threshold is not None:
+        overrides["humidity_percent_threshold"] = args.humidity_threshold
+    wenestmo.settings = wenestmo.settings._replace(**overrides)
+
+    if args.trace.endswith(".csv"):
+        trace = load_csv(args.trace)
+    else:
+        trace = load_history(args.trace)
+    if not trace:
+        print("No thermostat samples in {}".format(args.trace))
+        return 1
+    print_report(simulate(trace, args.speed, args.verbose))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
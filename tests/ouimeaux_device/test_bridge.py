@@ -0,0 +1,113 @@
+"""Tests for pywemo.ouimeaux_device.bridge."""
+
+import unittest.mock as mock
+from xml.etree import ElementTree
+
+import pytest
+
+import pywemo.ouimeaux_device as ouimeaux_device
+import pywemo.ouimeaux_device.bridge as bridge_module
+from pywemo.ouimeaux_device.bridge import Bridge, Group, Light
+
+ouimeaux_device.LOG = mock.Mock()
+
+LIGHT_ID = "F0D1B8000001420C"
+GROUP_ID = "1537896420"
+
+# From a bridge's GetEndDevices response.
+LIGHT_INFO = """
+<DeviceInfo>
+  <DeviceIndex>0</DeviceIndex>
+  <DeviceID>F0D1B8000001420C</DeviceID>
+  <FriendlyName>Lamp</FriendlyName>
+  <IconVersion>1</IconVersion>
+  <FirmwareVersion>83</FirmwareVersion>
+  <CapabilityIDs>10006,10008,30008,30009,3000A</CapabilityIDs>
+  <CurrentState>0,255:0,,,</CurrentState>
+  <Manufacturer>MRVL</Manufacturer>
+  <ModelCode>MZ100</ModelCode>
+  <productName>Lighting</productName>
+  <WeMoCertified>YES</WeMoCertified>
+</DeviceInfo>
+"""
+GROUP_INFO = """
+<GroupInfo>
+  <GroupID>1537896420</GroupID>
+  <GroupName>Living room</GroupName>
+  <GroupCapabilityIDs>10006,10008,30008,30009,3000A</GroupCapabilityIDs>
+  <GroupCapabilityValues>1,128:0,,,</GroupCapabilityValues>
+</GroupInfo>
+"""
+
+
+def status_change(device_id, capability_id, value):
+    # A StatusChange event from the bridge service.
+    return (
+        '<?xml version="1.0" encoding="utf-8"?><StateEvent>'
+        '<DeviceID available="YES">{}</DeviceID>'
+        "<CapabilityId>{}</CapabilityId><Value>{}</Value>"
+        "</StateEvent>".format(device_id, capability_id, value)
+    )
+
+
+@pytest.fixture
+def bridge(monkeypatch):
+    # test_service replaces cElementTree.fromstring, which bridge parses with.
+    monkeypatch.setattr(bridge_module.et, "fromstring", ElementTree.fromstring)
+    device = Bridge.__new__(Bridge)
+    device._config = mock.Mock()
+    device._config.get_friendlyName.return_value = "Bridge"
+    device._config.get_serialNumber.return_value = "SERIAL"
+    device.host = "192.168.1.100"
+    device.port = 49153
+    device.mac = "AA"
+    device._state = 0
+    device.Lights = {}
+    device.Groups = {}
+    device.Lights[LIGHT_ID] = Light(device, ElementTree.fromstring(LIGHT_INFO))
+    device.Groups[GROUP_ID] = Group(device, ElementTree.fromstring(GROUP_INFO))
+    return device
+
+
+class TestSubscriptionUpdate:
+    def test_light_is_switched_on(self, bridge):
+        light = bridge.Lights[LIGHT_ID]
+        assert light.state["onoff"] == 0
+
+        assert bridge.subscription_update(
+            "StatusChange", status_change(LIGHT_ID, "10006", "1")
+        )
+        assert light.state["onoff"] == 1
+        assert light.state["level"] == 255
+
+    def test_light_level_changes(self, bridge):
+        assert bridge.subscription_update(
+            "StatusChange", status_change(LIGHT_ID, "10008", "64:0")
+        )
+        assert bridge.Lights[LIGHT_ID].state["level"] == 64
+
+    def test_group_is_switched_off(self, bridge):
+        group = bridge.Groups[GROUP_ID]
+        assert group.state["onoff"] == 1
+
+        assert bridge.subscription_update(
+            "StatusChange", status_change(GROUP_ID, "10006", "0")
+        )
+        assert group.state["onoff"] == 0
+        assert group.state["level"] == 128
+
+    def test_unknown_device_is_ignored(self, bridge):
+        assert not bridge.subscription_update(
+            "StatusChange", status_change("F0D1B80000000000", "10006", "1")
+        )
+
+    def test_unsupported_capability_is_ignored(self, bridge):
+        light = bridge.Lights[LIGHT_ID]
+        assert not light.subscription_update(
+            ElementTree.fromstring(status_change(LIGHT_ID, "10300", "1:1"))
+        )
+        assert light.state["onoff"] == 0
+
+    def test_binary_state_is_handled_by_device(self, bridge):
+        assert bridge.subscription_update("BinaryState", "1")
+        assert bridge._state == 1
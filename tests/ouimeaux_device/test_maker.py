@@ -0,0 +1,61 @@
+"""Tests for pywemo.ouimeaux_device.maker."""
+
+import unittest.mock as mock
+from xml.etree import ElementTree
+
+import pytest
+
+import pywemo.ouimeaux_device as ouimeaux_device
+import pywemo.ouimeaux_device.maker as maker_module
+from pywemo.ouimeaux_device.maker import Maker
+
+ouimeaux_device.LOG = mock.Mock()
+
+# attributeList payloads as sent by a Maker on its deviceevent service.
+SWITCH_ON = (
+    "<attribute><name>Switch</name><value>1</value>"
+    "<prevalue>0</prevalue><ts>1605905427</ts></attribute>"
+)
+SWITCH_OFF_ESCAPED = (
+    "&lt;attribute&gt;&lt;name&gt;Switch&lt;/name&gt;&lt;value&gt;0"
+    "&lt;/value&gt;&lt;prevalue&gt;1&lt;/prevalue&gt;&lt;ts&gt;1605905430"
+    "&lt;/ts&gt;&lt;/attribute&gt;"
+)
+SENSOR_ONLY = (
+    "<attribute><name>Sensor</name><value>1</value>"
+    "<prevalue>0</prevalue><ts>1605905431</ts></attribute>"
+)
+
+
+@pytest.fixture
+def maker(monkeypatch):
+    # test_service replaces cElementTree.fromstring, which maker parses with.
+    monkeypatch.setattr(maker_module.et, "fromstring", ElementTree.fromstring)
+    device = Maker.__new__(Maker)
+    device._config = mock.Mock()
+    device._config.get_friendlyName.return_value = "Maker"
+    device._state = 0
+    return device
+
+
+class TestSubscriptionUpdate:
+    def test_switch_attribute_sets_state(self, maker):
+        assert maker.subscription_update("attributeList", SWITCH_ON)
+        assert maker.get_state() == 1
+
+    def test_escaped_attribute_list(self, maker):
+        maker._state = 1
+        assert maker.subscription_update("attributeList", SWITCH_OFF_ESCAPED)
+        assert maker.get_state() == 0
+
+    def test_other_attributes_leave_state_alone(self, maker):
+        assert maker.subscription_update("attributeList", SENSOR_ONLY)
+        assert maker.get_state() == 0
+
+    def test_binary_state_is_handled_by_switch(self, maker):
+        assert maker.subscription_update("BinaryState", "1")
+        assert maker.get_state() == 1
+
+    def test_unknown_type_is_not_handled(self, maker):
+        assert not maker.subscription_update("SleepModeState", "1")
+        assert maker.get_state() == 0
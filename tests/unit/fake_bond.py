@@ -0,0 +1,123 @@
+"""A local stand-in for a Bond hub's HTTP and BPUP push APIs, for tests."""
+
+import json
+import re
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN = "token"
+
+ACTIONS = {
+    "TurnOn": lambda state, argument: {"power": 1},
+    "TurnOff": lambda state, argument: {"power": 0},
+    "SetSpeed": lambda state, argument: {"power": 1, "speed": argument},
+}
+
+
+class FakeBondHub:
+    """Serves /v2/devices/{id}/state and /v2/devices/{id}/actions/{action}.
+
+    Clients that send a datagram to push_port are subscribed to BPUP pushes,
+    which are sent whenever an action or push() changes a device.
+    """
+
+    def __init__(self, devices):
+        """Start serving `devices`, a dict of device ID -> state dict."""
+        self.states = devices
+        self.requests = []
+        # Status codes to answer the next requests with, instead of handling
+        # them.
+        self.failures = []
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.host = "127.0.0.1:{}".format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self.subscribers = set()
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind(("127.0.0.1", 0))
+        self.push_port = self._udp.getsockname()[1]
+        self._udp_thread = threading.Thread(target=self._serve_udp, daemon=True)
+        self._udp_thread.start()
+
+    def _serve_udp(self):
+        while True:
+            try:
+                _, address = self._udp.recvfrom(1024)
+            except OSError:
+                return
+            self.subscribers.add(address)
+            self._send({"B": "FAKEHUB", "d": 0, "v": "fake"}, address)
+
+    def _send(self, message, address):
+        self._udp.sendto(json.dumps(message).encode("utf-8"), address)
+
+    def push(self, device_id, changes):
+        """Change a device as if from a remote, and push the change."""
+        self.states[device_id].update(changes)
+        message = {
+            "B": "FAKEHUB",
+            "t": "devices/{}/state".format(device_id),
+            "s": 200,
+            "m": 0,
+            "b": dict(self.states[device_id]),
+        }
+        for address in list(self.subscribers):
+            self._send(message, address)
+
+    def count(self, method):
+        return sum(1 for request in self.requests if request[0] == method)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._udp.close()
+
+    def _handler(self):
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=None):
+                data = json.dumps(body or {}).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def handle_request(self, method):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                hub.requests.append((method, self.path, body))
+                if hub.failures:
+                    self.reply(hub.failures.pop(0))
+                    return
+                if self.headers.get("BOND-Token") != TOKEN:
+                    self.reply(401)
+                    return
+                match = re.match(
+                    r"^/v2/devices/(\w+)/(state|actions/(\w+))$", self.path
+                )
+                if not match or match.group(1) not in hub.states:
+                    self.reply(404)
+                    return
+                device_id, action = match.group(1), match.group(3)
+                state = hub.states[device_id]
+                if method == "GET" and action is None:
+                    self.reply(200, state)
+                elif method == "PUT" and action in ACTIONS:
+                    hub.push(device_id, ACTIONS[action](state, body.get("argument")))
+                    self.reply(200)
+                else:
+                    self.reply(400)
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_PUT(self):
+                self.handle_request("PUT")
+
+        return Handler
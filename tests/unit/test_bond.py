@@ -0,0 +1,167 @@
+"""Tests for bond."""
+
+import json
+import time
+from concurrent.futures import wait
+
+import pytest
+import requests
+
+import bond
+from tests.unit.fake_bond import TOKEN, FakeBondHub
+
+
+@pytest.fixture
+def hub():
+    hub = FakeBondHub({"fan1": {"power": 0}, "fan2": {"power": 0}})
+    yield hub
+    hub.stop()
+
+
+@pytest.fixture
+def client(hub):
+    client = bond.BondClient(hub.host, TOKEN, timeout=2, retries=1)
+    yield client
+    client.close()
+
+
+class TestBondClient:
+    def test_get_state_is_cached(self, hub, client):
+        assert client.get_state("fan1") == {"power": 0}
+        assert client.get_state("fan1") == {"power": 0}
+        assert hub.count("GET") == 1
+
+    def test_get_state_refreshes_after_max_age(self, hub, client):
+        client.get_state("fan1")
+        client.get_state("fan1", max_age=0)
+        assert hub.count("GET") == 2
+
+    def test_set_state_sends_action(self, hub, client):
+        assert client.set_state("fan1", "SetSpeed", 1, {"power": 1, "speed": 1})
+        assert hub.states["fan1"] == {"power": 1, "speed": 1}
+        assert hub.requests[-1] == (
+            "PUT",
+            "/v2/devices/fan1/actions/SetSpeed",
+            {"argument": 1},
+        )
+
+    def test_set_state_skips_redundant_action(self, hub, client):
+        assert not client.set_state("fan1", "TurnOff", expected={"power": 0})
+        assert hub.count("PUT") == 0
+
+    def test_set_state_caches_expected_state(self, hub, client):
+        client.set_state("fan1", "SetSpeed", 1, {"power": 1, "speed": 1})
+        assert not client.set_state("fan1", "SetSpeed", 1, {"power": 1, "speed": 1})
+        assert hub.count("GET") == 1
+        assert hub.count("PUT") == 1
+
+    def test_set_state_without_expected_always_sends(self, hub, client):
+        assert client.set_state("fan1", "TurnOff")
+        assert client.set_state("fan1", "TurnOff")
+        assert hub.count("PUT") == 2
+        assert hub.count("GET") == 0
+
+    def test_server_error_is_retried(self, hub, client):
+        hub.failures.append(503)
+        client.action("fan1", "TurnOn")
+        assert hub.states["fan1"] == {"power": 1}
+        assert hub.count("PUT") == 2
+
+    def test_failed_action_raises_and_forgets_state(self, hub, client):
+        client.get_state("fan1")
+        hub.failures.extend([404])
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.set_state("fan1", "TurnOn", expected={"power": 1})
+        client.get_state("fan1")
+        assert hub.count("GET") == 2
+
+    def test_bad_token_is_rejected(self, hub):
+        client = bond.BondClient(hub.host, "wrong", timeout=2)
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.action("fan1", "TurnOn")
+        client.close()
+
+    def test_submit_sets_devices_concurrently(self, hub, client):
+        futures = client.submit(
+            ["fan1", "fan2"], "SetSpeed", 1, {"power": 1, "speed": 1}
+        )
+        done, not_done = wait(futures, timeout=5)
+        assert not not_done
+        assert sorted(futures.values()) == ["fan1", "fan2"]
+        assert all(future.result() for future in done)
+        assert hub.states["fan2"] == {"power": 1, "speed": 1}
+
+
+def wait_for_push(client, device_id, **state):
+    def pushed():
+        with client._lock:
+            cached = client._states.get(device_id)
+        return cached is not None and all(
+            cached[1].get(key) == value for key, value in state.items()
+        )
+
+    return wait_for(pushed)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def listener(hub, client):
+    listener = bond.BondPushListener(client, ["fan1"], port=hub.push_port)
+    listener.start()
+    assert wait_for(lambda: hub.subscribers)
+    yield listener
+    listener.stop()
+
+
+class TestBondPushListener:
+    def test_pushed_state_is_cached(self, hub, client, listener):
+        hub.push("fan1", {"power": 1, "speed": 3})
+        assert wait_for_push(client, "fan1", power=1, speed=3)
+        assert client.get_state("fan1") == {"power": 1, "speed": 3}
+        assert hub.count("GET") == 0
+
+    def test_pushed_state_does_not_expire_while_alive(self, hub, client, listener):
+        hub.push("fan1", {"power": 1})
+        assert wait_for_push(client, "fan1", power=1)
+        assert client.get_state("fan1", max_age=0)["power"] == 1
+        assert hub.count("GET") == 0
+
+    def test_other_devices_are_ignored(self, hub, client, listener):
+        hub.push("fan2", {"power": 1})
+        hub.push("fan1", {"power": 1})
+        assert wait_for_push(client, "fan1", power=1)
+        assert client.get_state("fan2") == {"power": 1}
+        assert hub.count("GET") == 1
+
+    def test_user_change_marks_override(self, hub, client, listener):
+        client.set_state("fan1", "SetSpeed", 1, {"power": 1, "speed": 1})
+        time.sleep(0.1)
+        assert not client.overridden("fan1")
+        hub.push("fan1", {"power": 0})
+        assert wait_for(lambda: client.overridden("fan1"))
+        assert not client.set_state("fan1", "TurnOff", expected={"power": 0})
+        assert not client.overridden("fan1")
+
+    def test_handle_datagram_ignores_garbage(self, client):
+        listener = bond.BondPushListener(client)
+        listener.handle_datagram(b"not json")
+        listener.handle_datagram(b"[]")
+        listener.handle_datagram(
+            json.dumps({"t": "devices/fan1/state", "s": 404, "b": {}}).encode()
+        )
+        assert client._states == {}
+
+    def test_stop_lets_cache_expire(self, hub, client, listener):
+        hub.push("fan1", {"power": 1})
+        assert wait_for_push(client, "fan1", power=1)
+        listener.stop()
+        client.get_state("fan1", max_age=0)
+        assert hub.count("GET") == 1
@@ -0,0 +1,104 @@
+"""Tests for pywemo.discovery."""
+
+import unittest.mock as mock
+
+import pywemo.discovery as discovery
+
+discovery.LOG = mock.Mock()
+
+
+class MockDevice:
+    def __init__(self, mac, host="192.168.1.100", port=49153, name="Wemo"):
+        self.mac = mac
+        self.serialnumber = "SERIAL-" + str(mac)
+        self.host = host
+        self.port = port
+        self.name = name
+
+
+class TestDeviceRegistry:
+    def test_duplicate_devices_are_stored_once(self):
+        registry = discovery.DeviceRegistry()
+        first = MockDevice("AA")
+
+        assert registry.update([first], now=1) == [first]
+        assert registry.update([MockDevice("AA")], now=2) == []
+
+        assert registry.devices() == [first]
+        assert registry.last_seen(first) == 2
+
+    def test_device_without_mac_is_keyed_by_serial(self):
+        registry = discovery.DeviceRegistry()
+        device = MockDevice(None)
+
+        registry.update([device])
+
+        assert registry.get("SERIAL-None") is device
+
+    def test_moved_device_is_updated_in_place(self):
+        registry = discovery.DeviceRegistry()
+        device = MockDevice("AA", host="192.168.1.100", port=49153)
+        registry.update([device])
+
+        registry.update([MockDevice("AA", host="192.168.1.101", port=49154,
+                                    name="Renamed")])
+
+        assert registry.devices() == [device]
+        assert device.host == "192.168.1.101"
+        assert device.port == 49154
+        assert device.name == "Renamed"
+
+    def test_old_devices_expire(self):
+        registry = discovery.DeviceRegistry(max_age=100)
+        old = MockDevice("AA")
+        new = MockDevice("BB")
+        registry.update([old], now=1000)
+        registry.update([new], now=1050)
+
+        assert registry.expire(now=1120) == [old]
+        assert registry.devices() == [new]
+
+    def test_no_expiry_without_max_age(self):
+        registry = discovery.DeviceRegistry()
+        registry.update([MockDevice("AA")], now=1)
+
+        assert registry.expire(now=1000000) == []
+        assert len(registry) == 1
+
+    def test_discover_merges_discovery_results(self):
+        registry = discovery.DeviceRegistry()
+        device = MockDevice("AA")
+
+        with mock.patch.object(discovery, "discover_devices",
+                               return_value=[device]) as discover:
+            assert registry.discover(max_devices=1) == [device]
+
+        discover.assert_called_once_with(max_devices=1)
+        assert registry.devices() == [device]
+
+    def test_renamed_device_is_updated_in_place(self):
+        registry = discovery.DeviceRegistry()
+        device = MockDevice("AA", name="Heater")
+        registry.update([device])
+        generation = registry.generation
+
+        registry.update([MockDevice("AA", name="Space heater")])
+
+        assert registry.devices() == [device]
+        assert device.name == "Space heater"
+        assert registry.generation == generation + 1
+
+    def test_generation_changes_only_when_devices_change(self):
+        registry = discovery.DeviceRegistry(max_age=100)
+        registry.update([MockDevice("AA")], now=1000)
+        generation = registry.generation
+
+        registry.update([MockDevice("AA")], now=1001)
+        registry.expire(now=1002)
+        assert registry.generation == generation
+
+        registry.update([MockDevice("AA", host="192.168.1.101")], now=1003)
+        assert registry.generation == generation + 1
+
+        registry.expire(now=2000)
+        assert registry.generation == generation + 2
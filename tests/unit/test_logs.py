@@ -0,0 +1,170 @@
+"""Tests for logs."""
+
+import io
+import json
+import logging
+import queue
+
+import pytest
+
+import logs
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_record(message, level=logging.WARNING, exc_info=None, **extra):
+    record = logging.makeLogRecord(
+        {
+            "name": "wenestmo",
+            "levelno": level,
+            "levelname": logging.getLevelName(level),
+            "msg": message,
+            "exc_info": exc_info,
+        }
+    )
+    record.__dict__.update(extra)
+    return record
+
+
+def exc_info():
+    try:
+        raise ConnectionError("unreachable")
+    except ConnectionError as e:
+        return (type(e), e, e.__traceback__)
+
+
+class TestJsonFormatter:
+    def test_fields(self):
+        line = logs.JsonFormatter().format(make_record("Hello", device="Fan"))
+        entry = json.loads(line)
+        assert entry["message"] == "Hello"
+        assert entry["level"] == "WARNING"
+        assert entry["logger"] == "wenestmo"
+        assert entry["device"] == "Fan"
+        assert "time" in entry and "thread" in entry
+        assert "exception" not in entry
+
+    def test_exception(self):
+        record = make_record("Failed", exc_info=exc_info())
+        entry = json.loads(logs.JsonFormatter().format(record))
+        assert "ConnectionError: unreachable" in entry["exception"]
+
+
+class TestConsoleFormatter:
+    def test_repeats_are_noted(self):
+        record = make_record("Timed out toggling Fan", repeated=4)
+        assert logs.ConsoleFormatter().format(record) == (
+            "Timed out toggling Fan (4 more since last logged)"
+        )
+
+
+class TestRepeatFilter:
+    def test_repeats_are_suppressed_and_counted(self):
+        clock = FakeClock()
+        repeat_filter = logs.RepeatFilter(60, clock)
+        assert repeat_filter.filter(make_record("Timed out toggling Fan"))
+        clock.now = 30
+        assert not repeat_filter.filter(make_record("Timed out toggling Fan"))
+        assert not repeat_filter.filter(make_record("Timed out toggling Fan"))
+        clock.now = 61
+        record = make_record("Timed out toggling Fan")
+        assert repeat_filter.filter(record)
+        assert record.repeated == 2
+
+    def test_different_messages_are_not_suppressed(self):
+        repeat_filter = logs.RepeatFilter(60, FakeClock())
+        assert repeat_filter.filter(make_record("Timed out toggling Fan"))
+        assert repeat_filter.filter(make_record("Timed out toggling Heater"))
+
+    def test_exception_type_is_part_of_the_key(self):
+        repeat_filter = logs.RepeatFilter(60, FakeClock())
+        assert repeat_filter.filter(make_record("Failed"))
+        assert repeat_filter.filter(make_record("Failed", exc_info=exc_info()))
+        assert not repeat_filter.filter(make_record("Failed", exc_info=exc_info()))
+
+    def test_info_is_never_suppressed(self):
+        repeat_filter = logs.RepeatFilter(60, FakeClock())
+        for _ in range(3):
+            assert repeat_filter.filter(make_record("Turning Fan on.", logging.INFO))
+
+
+class TestQueueHandler:
+    def test_full_queue_drops_records(self):
+        handler = logs.QueueHandler(queue.Queue(1))
+        handler.handle(make_record("one"))
+        handler.handle(make_record("two"))
+        assert handler.dropped == 1
+        assert handler.queue.get_nowait().getMessage() == "one"
+
+    def test_message_and_exception_are_rendered(self):
+        handler = logs.QueueHandler(queue.Queue())
+        record = make_record("Toggling %s", exc_info=exc_info())
+        record.args = ("Fan",)
+        handler.handle(record)
+        queued = handler.queue.get_nowait()
+        assert queued.getMessage() == "Toggling Fan"
+        assert queued.exc_info is None
+        assert "ConnectionError" in queued.exc_text
+
+
+@pytest.fixture
+def logger():
+    logger = logging.getLogger("test_logs")
+    level = logging.getLogger().level
+    yield logger
+    logging.getLogger().setLevel(level)
+
+
+class TestLogPipeline:
+    def test_writes_console_and_json_file(self, tmp_path, logger):
+        path = tmp_path / "wenestmo.log"
+        console = io.StringIO()
+        pipeline = logs.LogPipeline(str(path), console=console)
+        pipeline.start()
+        logger.info("Turning %s on.", "Fan", extra={"device": "Fan"})
+        try:
+            raise ValueError("bad")
+        except ValueError:
+            logger.exception("Zone failed")
+        pipeline.stop()
+
+        assert console.getvalue().splitlines()[0] == "Turning Fan on."
+        assert "ValueError: bad" in console.getvalue()
+        entries = [json.loads(line) for line in path.read_text().splitlines()]
+        assert entries[0]["message"] == "Turning Fan on."
+        assert entries[0]["device"] == "Fan"
+        assert entries[1]["level"] == "ERROR"
+        assert "ValueError: bad" in entries[1]["exception"]
+
+    def test_file_is_rotated(self, tmp_path, logger):
+        path = tmp_path / "wenestmo.log"
+        pipeline = logs.LogPipeline(str(path), max_bytes=1000, backups=2, console=None)
+        pipeline.start()
+        for count in range(100):
+            logger.info("Message %d", count)
+        pipeline.stop()
+
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            "wenestmo.log",
+            "wenestmo.log.1",
+            "wenestmo.log.2",
+        ]
+        assert path.stat().st_size <= 1000
+        last = json.loads(path.read_text().splitlines()[-1])
+        assert last["message"] == "Message 99"
+
+    def test_repeats_are_suppressed(self, logger):
+        console = io.StringIO()
+        pipeline = logs.LogPipeline(console=console, repeat_interval_s=60)
+        pipeline.start()
+        for _ in range(3):
+            logger.warning("Timed out toggling Fan")
+        pipeline.stop()
+
+        assert console.getvalue() == "Timed out toggling Fan\n"
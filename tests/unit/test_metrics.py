@@ -0,0 +1,171 @@
+"""Tests for metrics."""
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+class TestMetrics:
+    def test_counter_renders_by_label(self):
+        registry = metrics.Metrics()
+        counter = registry.counter("requests_total", "Requests.")
+        counter.inc(result="ok")
+        counter.inc(2, result="ok")
+        counter.inc(result="error")
+        assert counter.get(result="ok") == 3
+        assert registry.render() == (
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{result="error"} 1\n'
+            'requests_total{result="ok"} 3\n'
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = metrics.Metrics()
+        histogram = registry.histogram("latency_seconds", "Latency.", (0.1, 1))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value)
+        lines = registry.render().splitlines()
+        assert lines[2:] == [
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            "latency_seconds_sum 4.25",
+            "latency_seconds_count 4",
+        ]
+        assert histogram.count() == 4
+
+    def test_label_values_are_escaped(self):
+        registry = metrics.Metrics()
+        registry.gauge("errors", "Errors.").set(1, device='a "b"\n')
+        assert 'errors{device="a \\"b\\"\\n"} 1' in registry.render()
+
+    def test_collectors_run_before_render(self):
+        registry = metrics.Metrics()
+        registry.collector(lambda: registry.gauge("devices", "Devices.").set(7))
+        assert "devices 7\n" in registry.render()
+
+    def test_failing_collector_does_not_break_render(self):
+        registry = metrics.Metrics()
+        registry.counter("ticks_total", "Ticks.").inc()
+        registry.collector(lambda: 1 / 0)
+        assert "ticks_total 1\n" in registry.render()
+
+    def test_metrics_are_created_once(self):
+        registry = metrics.Metrics()
+        assert registry.counter("a", "A.") is registry.counter("a", "A.")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPhaseTimer:
+    def test_phases_are_timed(self):
+        clock = FakeClock()
+        timer = metrics.PhaseTimer(clock)
+        with timer.phase("fetch"):
+            clock.now += 2
+        with timer.phase("save"):
+            clock.now += 0.5
+        assert timer.durations == {"fetch": 2, "save": 0.5}
+        assert timer.total() == 2.5
+
+    def test_repeated_phases_add_up(self):
+        clock = FakeClock()
+        timer = metrics.PhaseTimer(clock)
+        for _ in range(3):
+            with timer.phase("humidity"):
+                clock.now += 1
+        assert timer.durations == {"humidity": 3}
+
+    def test_phase_is_timed_on_exception(self):
+        clock = FakeClock()
+        timer = metrics.PhaseTimer(clock)
+        with pytest.raises(ValueError):
+            with timer.phase("fetch"):
+                clock.now += 1
+                raise ValueError
+        assert timer.durations == {"fetch": 1}
+
+
+class TestPhaseStats:
+    def test_percentiles(self):
+        stats = metrics.PhaseStats()
+        for ms in range(1, 101):
+            stats.add({"total": ms / 1000})
+        summary = stats.summary()["total"]
+        assert summary["count"] == 100
+        assert summary["p50"] == 0.051
+        assert summary["p95"] == 0.096
+        assert summary["p99"] == 0.1
+        assert summary["max"] == 0.1
+
+    def test_window_drops_old_iterations(self):
+        stats = metrics.PhaseStats(window=2)
+        for seconds in (9, 1, 2):
+            stats.add({"total": seconds})
+        assert stats.summary()["total"]["max"] == 2
+
+    def test_format(self):
+        stats = metrics.PhaseStats()
+        stats.add({"fetch": 0.25, "total": 1})
+        lines = stats.format().splitlines()
+        assert lines[0].split()[0] == "phase"
+        assert lines[1].split() == ["fetch", "1", "250.0", "250.0", "250.0", "250.0"]
+        assert lines[2].split()[0] == "total"
+
+
+def get(server, path):
+    url = "http://127.0.0.1:{}{}".format(server.port, path)
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+@pytest.fixture
+def health():
+    return {"healthy": True, "last_iteration_age_s": 3}
+
+
+@pytest.fixture
+def server(health):
+    registry = metrics.Metrics()
+    registry.counter("iterations_total", "Iterations.").inc()
+    server = metrics.MetricsServer(
+        registry, lambda: (health["healthy"], health), 0, "127.0.0.1"
+    )
+    server.start()
+    yield server
+    server.stop()
+
+
+class TestMetricsServer:
+    def test_metrics(self, server):
+        status, body = get(server, "/metrics")
+        assert status == 200
+        assert "iterations_total 1\n" in body
+
+    def test_healthy(self, server):
+        status, body = get(server, "/healthz")
+        assert status == 200
+        assert json.loads(body)["last_iteration_age_s"] == 3
+
+    def test_unhealthy(self, server, health):
+        health["healthy"] = False
+        status, body = get(server, "/healthz")
+        assert status == 503
+        assert json.loads(body)["healthy"] is False
+
+    def test_unknown_path(self, server):
+        assert get(server, "/")[0] == 404
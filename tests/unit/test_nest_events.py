@@ -0,0 +1,93 @@
+"""Tests for nest_events."""
+
+import json
+import unittest.mock as mock
+
+import pytest
+
+import nest_events
+
+NAME = "enterprises/project/devices/thermostat"
+
+
+def get_thermostat():
+    return {
+        "name": NAME,
+        "traits": {
+            "sdm.devices.traits.ThermostatHvac": {"status": "OFF"},
+            "sdm.devices.traits.Humidity": {"ambientHumidityPercent": 40},
+        },
+    }
+
+
+def get_message(traits, name=NAME, timestamp="2020-01-01T00:00:01Z"):
+    event = {
+        "eventId": "event",
+        "timestamp": timestamp,
+        "resourceUpdate": {"name": name, "traits": traits},
+    }
+    return mock.Mock(data=json.dumps(event).encode("utf-8"))
+
+
+class TestThermostatEvents:
+    def test_event_updates_seeded_thermostat(self):
+        events = nest_events.ThermostatEvents("subscription")
+        events.seed(get_thermostat())
+        message = get_message(
+            {"sdm.devices.traits.ThermostatHvac": {"status": "HEATING"}})
+
+        events.handle_message(message)
+
+        thermostat = events.get(NAME)
+        assert thermostat["traits"]["sdm.devices.traits.ThermostatHvac"] == {
+            "status": "HEATING"}
+        assert thermostat["traits"]["sdm.devices.traits.Humidity"] == {
+            "ambientHumidityPercent": 40}
+        assert events.changed.is_set()
+        message.ack.assert_called_once()
+
+    def test_event_for_unknown_device_is_ignored(self):
+        events = nest_events.ThermostatEvents("subscription")
+
+        events.handle_message(get_message(
+            {"sdm.devices.traits.ThermostatHvac": {"status": "HEATING"}}))
+
+        assert events.get(NAME) is None
+        assert not events.changed.is_set()
+
+    def test_out_of_order_event_is_ignored(self):
+        events = nest_events.ThermostatEvents("subscription")
+        events.seed(get_thermostat())
+        events.handle_message(get_message(
+            {"sdm.devices.traits.ThermostatHvac": {"status": "HEATING"}},
+            timestamp="2020-01-01T00:00:05Z"))
+
+        events.handle_message(get_message(
+            {"sdm.devices.traits.ThermostatHvac": {"status": "OFF"}},
+            timestamp="2020-01-01T00:00:02Z"))
+
+        assert events.get(NAME)["traits"][
+            "sdm.devices.traits.ThermostatHvac"] == {"status": "HEATING"}
+
+    def test_malformed_message_is_acked(self):
+        events = nest_events.ThermostatEvents("subscription")
+        message = mock.Mock(data=b"not json")
+
+        events.handle_message(message)
+
+        message.ack.assert_called_once()
+
+    def test_get_returns_a_copy(self):
+        events = nest_events.ThermostatEvents("subscription")
+        events.seed(get_thermostat())
+
+        events.get(NAME)["traits"].clear()
+
+        assert events.get(NAME)["traits"]
+
+    def test_start_without_pubsub_raises(self):
+        events = nest_events.ThermostatEvents("subscription")
+
+        with mock.patch.object(nest_events, "pubsub_v1", None):
+            with pytest.raises(RuntimeError):
+                events.start()
@@ -0,0 +1,96 @@
+"""Tests for recorder."""
+
+import pytest
+
+import recorder
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "history.rec")
+
+
+class TestRecorder:
+    def test_records_are_returned_in_order(self, path):
+        history = recorder.Recorder(path, capacity=10)
+        history.record("temperature", 20.5, timestamp=1)
+        history.event("heater", 1, timestamp=2)
+        assert history.query() == [
+            (1, "temperature", recorder.SAMPLE, 20.5),
+            (2, "heater", recorder.EVENT, 1.0),
+        ]
+        assert len(history) == 2
+        history.close()
+
+    def test_oldest_records_are_overwritten(self, path):
+        history = recorder.Recorder(path, capacity=3)
+        for timestamp in range(5):
+            history.record("temperature", timestamp, timestamp=timestamp)
+        assert [record[0] for record in history.query()] == [2, 3, 4]
+        assert len(history) == 3
+        history.close()
+
+    def test_file_size_is_fixed(self, path):
+        history = recorder.Recorder(path, capacity=3)
+        size = len(open(path, "rb").read())
+        for timestamp in range(10):
+            history.record("temperature", timestamp, timestamp=timestamp)
+        history.close()
+        assert len(open(path, "rb").read()) == size
+
+    def test_reopen_keeps_records_and_series(self, path):
+        history = recorder.Recorder(path, capacity=3)
+        for timestamp in range(4):
+            history.record("humidity", timestamp, timestamp=timestamp)
+        history.close()
+
+        history = recorder.Recorder(path, capacity=3)
+        history.record("humidity", 4, timestamp=4)
+        assert history.series() == ["humidity"]
+        assert [record[3] for record in history.query("humidity")] == [2, 3, 4]
+        history.close()
+
+    def test_reopen_with_other_capacity_fails(self, path):
+        recorder.Recorder(path, capacity=3).close()
+        with pytest.raises(ValueError):
+            recorder.Recorder(path, capacity=4)
+
+    def test_reopen_without_capacity_uses_file_capacity(self, path):
+        recorder.Recorder(path, capacity=3).close()
+        history = recorder.Recorder(path)
+        assert history.capacity == 3
+        history.close()
+
+    def test_not_a_recorder_file(self, path):
+        with open(path, "wb") as garbage:
+            garbage.write(b"x" * 100000)
+        with pytest.raises(ValueError):
+            recorder.Recorder(path, capacity=3)
+
+    def test_query_filters(self, path):
+        history = recorder.Recorder(path, capacity=10)
+        for timestamp in range(6):
+            history.record("temperature", timestamp, timestamp=timestamp)
+            history.event("heater", timestamp % 2, timestamp=timestamp + 0.5)
+        assert [r[0] for r in history.query("temperature", start=2, end=4)] == [2, 3]
+        assert [r[0] for r in history.query(start=4.5)] == [4.5, 5, 5.5]
+        assert len(history.query(kind=recorder.EVENT)) == 5
+        assert history.query("missing") == []
+        history.close()
+
+    def test_downsample(self, path):
+        history = recorder.Recorder(path, capacity=10)
+        for timestamp, value in [(0, 1), (30, 3), (60, 10), (150, 4)]:
+            history.record("temperature", value, timestamp=timestamp)
+        assert history.downsample("temperature", 60) == [
+            (0, 2, 1, 3, 2),
+            (60, 1, 10, 10, 10),
+            (120, 1, 4, 4, 4),
+        ]
+        history.close()
+
+    def test_long_series_name_fails(self, path):
+        history = recorder.Recorder(path, capacity=3)
+        with pytest.raises(ValueError):
+            history.record("x" * 100, 1)
+        history.close()
@@ -0,0 +1,195 @@
+"""Tests for rules."""
+
+import configparser
+
+import pytest
+
+import rules
+
+
+class TestCondition:
+    @pytest.mark.parametrize(
+        "text, expected",
+        [
+            ("humidity < 38", True),
+            ("humidity >= 38", False),
+            ("hvac_status == heating", True),
+            ("hvac_status != 'HEATING'", False),
+            ("humidity < 38 and temperature > 70", False),
+            ("humidity < 38 and not temperature > 70", True),
+            ("humidity > 40 or temperature < 70", True),
+            ("(humidity > 40 or temperature < 70) and hvac_status == OFF", False),
+            ("wemo[Space heater] == on", True),
+            ("wemo[Fan] == on", False),
+            ("missing > 0", False),
+            ("hvac_status > 3", False),
+        ],
+    )
+    def test_evaluate(self, text, expected):
+        inputs = {
+            "humidity": 35,
+            "temperature": 68,
+            "hvac_status": "HEATING",
+            "wemo[Space heater]": 1,
+            "wemo[Fan]": 0,
+        }
+        assert rules.Condition(text)(inputs) is expected
+
+    def test_inputs(self):
+        condition = rules.Condition("humidity < 38 or (wemo[Fan] == off and x > 1)")
+        assert condition.inputs == {"humidity", "wemo[Fan]", "x"}
+
+    @pytest.mark.parametrize(
+        "text",
+        [
+            "",
+            "humidity <",
+            "humidity 38",
+            "(humidity < 38",
+            "humidity < 38 38",
+            "wemo[Fan] == warm",
+            "< 38",
+            "humidity < 38 and",
+        ],
+    )
+    def test_syntax_errors(self, text):
+        with pytest.raises(ValueError):
+            rules.Condition(text)
+
+
+def get_rule(**kwargs):
+    options = {"when": "humidity < 38", "until": "humidity > 42"}
+    options.update(kwargs)
+    return rules.Rule("dry", **options)
+
+
+class TestRuleEngine:
+    def test_hysteresis(self):
+        rule = get_rule()
+        engine = rules.RuleEngine([rule])
+        assert engine.evaluate({"humidity": 37}, 0) == [(rule, True)]
+        assert engine.evaluate({"humidity": 40}, 1) == []
+        assert engine.evaluate({"humidity": 43}, 2) == [(rule, False)]
+        assert engine.evaluate({"humidity": 40}, 3) == []
+
+    def test_retry_undoes_a_change(self):
+        rule = get_rule(cooldown=60)
+        engine = rules.RuleEngine([rule])
+        assert engine.evaluate({"humidity": 37}, 0) == [(rule, True)]
+        engine.retry(rule)
+        assert not engine.active
+        assert engine.evaluate({"humidity": 37}, 1) == [(rule, True)]
+        assert engine.active == {rule}
+
+    def test_without_until_releases_when_false(self):
+        rule = get_rule(until=None)
+        engine = rules.RuleEngine([rule])
+        engine.evaluate({"humidity": 37}, 0)
+        assert engine.evaluate({"humidity": 38}, 1) == [(rule, False)]
+
+    def test_cooldown_defers_change(self):
+        rule = get_rule(cooldown=60)
+        engine = rules.RuleEngine([rule])
+        engine.evaluate({"humidity": 37}, 0)
+        assert engine.evaluate({"humidity": 45}, 30) == []
+        # Deferred rules are re-evaluated even if their inputs didn't change.
+        assert engine.evaluate({"humidity": 45}, 61) == [(rule, False)]
+
+    def test_only_changed_inputs_are_evaluated(self):
+        many = [
+            rules.Rule("rule {}".format(i), "input{} > 0".format(i)) for i in range(200)
+        ]
+        engine = rules.RuleEngine(many)
+        inputs = {"input{}".format(i): 0 for i in range(200)}
+        engine.evaluate(inputs, 0)
+        assert engine.evaluated == 200
+
+        inputs["input7"] = 1
+        assert engine.evaluate(inputs, 1) == [(many[7], True)]
+        assert engine.evaluated == 201
+
+    def test_device_inputs(self):
+        engine = rules.RuleEngine([get_rule(when="wemo[Fan] == off")])
+        assert engine.device_inputs == {"wemo[Fan]"}
+
+    def test_take_over_keeps_active_rules_by_name(self):
+        old_rule = get_rule()
+        old = rules.RuleEngine([old_rule, rules.Rule("Gone", "humidity < 38")])
+        old.evaluate({"humidity": 37}, 0)
+        new_rule = get_rule(until="humidity > 45")
+        engine = rules.RuleEngine([new_rule])
+        removed = engine.take_over(old)
+        assert [rule.name for rule in removed] == ["Gone"]
+        assert engine.active == {new_rule}
+        # The active rule is released by the new Until, not re-engaged.
+        assert engine.evaluate({"humidity": 43}, 1) == []
+        assert engine.evaluate({"humidity": 46}, 2) == [(new_rule, False)]
+
+
+class TestLoadRules:
+    def test_load(self):
+        config = configparser.ConfigParser()
+        config.read_string("""
+[wemo]
+HeatingDeviceNames = []
+
+[rule Dry air]
+When = humidity < 38
+Until = humidity > 42
+Wemo = ["Humidifier"]
+FanIds = ["abc"]
+FanAction = SetSpeed 2
+Cooldown = 600
+Zone = Upstairs
+""")
+        [rule] = rules.load_rules(config)
+        assert rule.name == "Dry air"
+        assert rule.wemo == {"Humidifier"}
+        assert rule.fan_ids == {"abc"}
+        assert rule.fan_action == ("SetSpeed", 2)
+        assert rule.release_action == ("TurnOff", None)
+        assert rule.cooldown == 600
+        assert rule.zone == "Upstairs"
+
+    def test_bad_rule_is_named(self):
+        config = configparser.ConfigParser()
+        config.read_string("[rule Broken]\nWhen = humidity <\n")
+        with pytest.raises(ValueError, match="Broken"):
+            rules.load_rules(config)
+
+    @pytest.mark.parametrize(
+        "option", ['Wemo = ["Humidifier"', "FanIds = abc", "Cooldown = soon"]
+    )
+    def test_bad_option_is_named(self, option):
+        config = configparser.ConfigParser()
+        config.read_string("[rule Broken]\nWhen = humidity < 3\n" + option)
+        with pytest.raises(ValueError, match="Rule 'Broken'"):
+            rules.load_rules(config)
+
+    def test_missing_when(self):
+        config = configparser.ConfigParser()
+        config.read_string("[rule Broken]\nUntil = humidity < 3\n")
+        with pytest.raises(ValueError, match="Broken"):
+            rules.load_rules(config)
+
+
+class TestThermostatInputs:
+    def test_inputs(self):
+        thermostat = {
+            "traits": {
+                "sdm.devices.traits.Temperature": {"ambientTemperatureCelsius": 20},
+                "sdm.devices.traits.Humidity": {"ambientHumidityPercent": 40},
+                "sdm.devices.traits.ThermostatHvac": {"status": "HEATING"},
+                "sdm.devices.traits.ThermostatTemperatureSetpoint": {"heatCelsius": 25},
+                "sdm.devices.traits.ThermostatMode": {"mode": "heat"},
+            }
+        }
+        inputs = rules.thermostat_inputs(thermostat, fahrenheit=True)
+        assert inputs["temperature"] == 68
+        assert inputs["temperature_c"] == 20
+        assert inputs["heat_setpoint"] == 77
+        assert inputs["heat_gap"] == 9
+        assert inputs["humidity"] == 40
+        assert inputs["hvac_status"] == "HEATING"
+        assert inputs["sdm.devices.traits.ThermostatMode.mode"] == "HEAT"
+        assert "cool_setpoint" not in inputs
@@ -0,0 +1,109 @@
+"""Tests for simulate."""
+
+import pytest
+
+# wenestmo talks to Google through these, which the pywemo package (and so CI)
+# doesn't install; see requirements.txt.
+for module in ("googleapiclient", "httplib2", "oauth2client"):
+    pytest.importorskip(module)
+
+import recorder
+import simulate
+import wenestmo
+
+HEATING = sorted(wenestmo.settings.wemo_role_names["HEATING"])[0]
+
+
+def get_trace():
+    samples = [
+        (0, 18, "OFF"),
+        (600, 18, "HEATING"),
+        (1800, 19, "HEATING"),
+        (2400, 20, "OFF"),
+        (3600, 20, "OFF"),
+    ]
+    return {
+        "default": [
+            (
+                timestamp,
+                {
+                    "temperature_c": temperature_c,
+                    "humidity": 40,
+                    "heat_setpoint_c": 20,
+                    "hvac_status": status,
+                },
+            )
+            for timestamp, temperature_c, status in samples
+        ]
+    }
+
+
+class TestSimulate:
+    def test_heating_cycle(self):
+        report = simulate.simulate(get_trace(), speed=0)
+
+        assert report["simulated_s"] == 3600
+        assert report["devices"][HEATING]["switches"] == 2
+        # On from the first poll after 600 s until the first after 2400 s.
+        assert 1800 - 300 <= report["devices"][HEATING]["on_s"] <= 1800 + 300
+        assert report["latency_s"]["count"] == 2
+        assert report["missed_transitions"] == 0
+
+    def test_runs_are_independent(self):
+        first = simulate.simulate(get_trace(), speed=0)
+        second = simulate.simulate(get_trace(), speed=0)
+        assert first["devices"] == second["devices"]
+
+    def test_wenestmo_is_put_back(self):
+        zones, bond_client = wenestmo.zones, wenestmo.bond_client
+        simulate.simulate(get_trace(), speed=0)
+        assert wenestmo.zones is zones
+        assert wenestmo.bond_client is bond_client
+        assert wenestmo.clock is wenestmo.time.monotonic
+
+    def test_unknown_zone(self):
+        with pytest.raises(ValueError):
+            simulate.simulate({"nowhere": get_trace()["default"]}, speed=0)
+
+
+class TestLoadTrace:
+    def test_load_csv(self, tmp_path):
+        path = tmp_path / "trace.csv"
+        path.write_text(
+            "timestamp,zone,temperature_c,humidity,hvac_status,heat_setpoint_c\n"
+            "60,default,19.5,41,heating,21\n"
+            "0,default,19,40,OFF,\n"
+        )
+        assert simulate.load_csv(str(path)) == {
+            "default": [
+                (0, {"temperature_c": 19, "humidity": 40, "hvac_status": "OFF"}),
+                (
+                    60,
+                    {
+                        "temperature_c": 19.5,
+                        "humidity": 41,
+                        "heat_setpoint_c": 21,
+                        "hvac_status": "HEATING",
+                    },
+                ),
+            ]
+        }
+
+    def test_load_history(self, tmp_path):
+        path = str(tmp_path / "history.rec")
+        history = recorder.Recorder(path, capacity=100)
+        for timestamp, status in [(0, 0), (60, 1)]:
+            history.record("up/temperature_c", 20, timestamp=timestamp)
+            history.record("up/humidity", 40, timestamp=timestamp)
+            history.record("up/heat_setpoint_c", 21, timestamp=timestamp)
+            history.record("up/hvac_status", status, timestamp=timestamp)
+            history.event("wemo/heater", status, timestamp=timestamp)
+        history.close()
+
+        trace = simulate.load_history(path)
+
+        assert [sample["hvac_status"] for _, sample in trace["up"]] == [
+            "OFF",
+            "HEATING",
+        ]
+        assert trace["up"][0][1]["heat_setpoint_c"] == 21
@@ -0,0 +1,142 @@
+"""Tests for pywemo.state_engine."""
+
+import unittest.mock as mock
+
+import pywemo.state_engine as state_engine
+
+state_engine.LOG = mock.Mock()
+
+NOW = 1000000.0
+
+
+def get_mock_device(state=0):
+    device = mock.Mock()
+    device.serialnumber = "SERIAL"
+    device.get_state.return_value = state
+    return device
+
+
+def get_engine(device, subscribed=True):
+    registry = mock.Mock()
+    registry.is_subscribed.return_value = subscribed
+    engine = state_engine.StateEngine(
+        registry, quiet_period=600, min_poll_interval=30,
+        max_poll_interval=300)
+    with mock.patch.object(state_engine.time, "time", return_value=NOW):
+        engine.register(device)
+    return engine, registry
+
+
+class TestStateEngine:
+    def test_register_subscribes_to_device(self):
+        device = get_mock_device()
+        _, registry = get_engine(device)
+
+        registry.register.assert_called_once_with(device)
+        registry.on.assert_called_once()
+
+    def test_device_with_recent_events_is_not_polled(self):
+        device = get_mock_device()
+        engine, _ = get_engine(device)
+
+        delay = engine.poll(now=NOW + 60)
+
+        assert not engine.is_polling(device, NOW + 60)
+        device.get_state.assert_not_called()
+        assert delay == 300
+
+    def test_quiet_device_is_polled(self):
+        device = get_mock_device()
+        engine, _ = get_engine(device)
+
+        engine.poll(now=NOW + 601)
+
+        assert engine.is_polling(device, NOW + 601)
+        device.get_state.assert_called_with(force_update=True)
+
+    def test_lapsed_subscription_is_polled(self):
+        device = get_mock_device()
+        engine, _ = get_engine(device, subscribed=False)
+
+        engine.poll(now=NOW + 1)
+
+        device.get_state.assert_called_with(force_update=True)
+
+    def test_poll_interval_backs_off_while_state_is_unchanged(self):
+        device = get_mock_device()
+        engine, _ = get_engine(device)
+
+        now = NOW + 601
+        delays = []
+        for _ in range(5):
+            delay = engine.poll(now=now)
+            delays.append(delay)
+            now += delay
+
+        assert delays == [60, 120, 240, 300, 300]
+
+    def test_missed_event_resubscribes_and_notifies(self):
+        device = get_mock_device()
+        engine, registry = get_engine(device)
+        callback = mock.Mock()
+        engine.on(device, None, callback)
+        device.get_state.side_effect = [0, 1]
+
+        delay = engine.poll(now=NOW + 601)
+
+        assert registry.register.call_count == 2
+        callback.assert_called_once_with(device, "BinaryState", "1")
+        assert delay == 30
+
+    def test_event_returns_device_to_push_mode(self):
+        device = get_mock_device()
+        engine, registry = get_engine(device)
+        engine.poll(now=NOW + 601)
+        event_callback = registry.on.call_args[0][2]
+
+        with mock.patch.object(state_engine.time, "time",
+                               return_value=NOW + 700):
+            event_callback(device, "BinaryState", "1")
+
+        assert not engine.is_polling(device, NOW + 701)
+
+    def test_device_unregistered_during_poll_is_skipped(self):
+        device = get_mock_device()
+        engine, registry = get_engine(device, subscribed=False)
+
+        def unregister(_device):
+            engine.unregister(device)
+            return False
+
+        registry.is_subscribed.side_effect = unregister
+
+        assert engine.poll(now=NOW + 60) == 300
+        device.get_state.assert_not_called()
+
+    def test_device_unregistered_while_being_polled(self):
+        device = get_mock_device()
+        engine, _ = get_engine(device, subscribed=False)
+        device.get_state.side_effect = lambda **kwargs: engine.unregister(
+            device)
+
+        assert engine.poll(now=NOW + 601) == 300
+        assert not engine.is_polling(device, NOW + 601)
+
+    def test_polling_thread_survives_errors(self):
+        device = get_mock_device()
+        engine, _ = get_engine(device)
+        engine.min_poll_interval = 0
+        calls = []
+
+        def poll():
+            calls.append(None)
+            if len(calls) == 1:
+                raise RuntimeError("callback failed")
+            engine._exiting = True
+            return 0
+
+        engine.poll = poll
+        engine._run()
+
+        assert len(calls) == 2
+        state_engine.LOG.exception.assert_called()
@@ -0,0 +1,402 @@
+"""Tests for pywemo.subscribe."""
+
+import json
+import time
+from xml.etree import ElementTree
+import unittest.mock as mock
+
+import pytest
+from requests.structures import CaseInsensitiveDict
+
+import pywemo.subscribe as subscribe
+
+subscribe.LOG = mock.Mock()
+
+
+def get_mock_device(serialnumber="SERIAL", host="192.168.1.100"):
+    device = mock.Mock()
+    device.serialnumber = serialnumber
+    device.host = host
+    return device
+
+
+class TestCoalesce:
+    @staticmethod
+    def get_registry(device, **kwargs):
+        registry = subscribe.SubscriptionRegistry()
+        callback = mock.Mock()
+        registry.on(device, None, callback)
+        registry.coalesce(device, 10, **kwargs)
+        return registry, callback
+
+    def test_events_are_delivered_unchanged_without_coalescing(self):
+        device = get_mock_device()
+        registry = subscribe.SubscriptionRegistry()
+        callback = mock.Mock()
+        registry.on(device, None, callback)
+
+        registry.event(device, "InsightParams", "1")
+        registry.event(device, "InsightParams", "2")
+
+        assert callback.call_count == 2
+
+    def test_first_event_in_window_is_delivered_immediately(self):
+        device = get_mock_device()
+        registry, callback = self.get_registry(device)
+
+        registry.event(device, "InsightParams", "1")
+
+        callback.assert_called_once_with(device, "InsightParams", "1")
+
+    def test_burst_delivers_only_latest_value_on_flush(self):
+        device = get_mock_device()
+        registry, callback = self.get_registry(device)
+
+        registry.event(device, "InsightParams", "1")
+        registry.event(device, "InsightParams", "2")
+        registry.event(device, "InsightParams", "3")
+        assert callback.call_count == 1
+
+        registry._flush_event(device, "InsightParams")
+
+        assert callback.call_count == 2
+        callback.assert_called_with(device, "InsightParams", "3")
+
+    def test_binary_state_bypasses_coalescing(self):
+        device = get_mock_device()
+        registry, callback = self.get_registry(device)
+
+        registry.event(device, "BinaryState", "1")
+        registry.event(device, "BinaryState", "0")
+
+        assert callback.call_count == 2
+
+    def test_binary_state_can_be_coalesced(self):
+        device = get_mock_device()
+        registry, callback = self.get_registry(device, bypass=())
+
+        registry.event(device, "BinaryState", "1")
+        registry.event(device, "BinaryState", "0")
+
+        assert callback.call_count == 1
+
+    def test_type_filter_limits_coalescing_to_one_property(self):
+        device = get_mock_device()
+        registry, callback = self.get_registry(
+            device, type_filter="InsightParams")
+
+        registry.event(device, "attributeList", "a")
+        registry.event(device, "attributeList", "b")
+
+        assert callback.call_count == 2
+
+    def test_attribute_lists_are_merged(self, monkeypatch):
+        # Other tests replace cElementTree.fromstring with a mock.
+        monkeypatch.setattr(
+            subscribe.cElementTree, "fromstring", ElementTree.fromstring)
+        device = get_mock_device()
+        registry, callback = self.get_registry(device)
+        attribute = "<attribute><name>%s</name><value>%s</value></attribute>"
+
+        registry.event(device, "attributeList", attribute % ("FanMode", "1"))
+        registry.event(device, "attributeList", attribute % ("FanMode", "2"))
+        registry.event(device, "attributeList",
+                       attribute % ("DesiredHumidity", "3"))
+        registry._flush_event(device, "attributeList")
+
+        callback.assert_called_with(
+            device, "attributeList",
+            attribute % ("FanMode", "2") +
+            attribute % ("DesiredHumidity", "3"))
+
+
+class TestStateFile:
+    URL = "http://192.168.1.100:49153/upnp/event/basicevent1"
+
+    @staticmethod
+    def get_device():
+        device = get_mock_device()
+        device.EVENT_SERVICES = ("basicevent",)
+        device.services = {"basicevent": device.basicevent}
+        device.basicevent.eventSubURL = TestStateFile.URL
+        return device
+
+    @staticmethod
+    def get_registry(state_file):
+        registry = subscribe.SubscriptionRegistry(state_file=str(state_file))
+        registry._port = 8989
+        return registry
+
+    @staticmethod
+    def save_record(state_file, **kwargs):
+        record = {
+            "serial": "SERIAL",
+            "host": "192.168.1.100",
+            "sid": "uuid:saved",
+            "expiry": time.time() + 300,
+            "port": 8989,
+            "callback": "<http://192.168.1.2:8989>",
+            "url": TestStateFile.URL,
+        }
+        record.update(kwargs)
+        state_file.write_text(json.dumps([record]))
+
+    @mock.patch.object(subscribe, "get_ip_address",
+                       return_value="192.168.1.2")
+    def test_subscription_is_saved_to_state_file(self, _, tmp_path):
+        state_file = tmp_path / "subscriptions.json"
+        registry = self.get_registry(state_file)
+        response = mock.Mock(status_code=200, headers=CaseInsensitiveDict(
+            {"SID": "uuid:new", "TIMEOUT": "Second-300"}))
+
+        with mock.patch.object(subscribe.requests, "request",
+                               return_value=response):
+            registry._resubscribe(self.get_device(), "basicevent")
+
+        records = json.loads(state_file.read_text())
+        assert len(records) == 1
+        assert records[0]["sid"] == "uuid:new"
+        assert records[0]["service"] == "basicevent"
+        assert records[0]["port"] == 8989
+        assert records[0]["callback"] == "<http://192.168.1.2:8989>"
+
+    @mock.patch.object(subscribe, "get_ip_address",
+                       return_value="192.168.1.2")
+    def test_saved_subscription_is_renewed_on_register(self, _, tmp_path):
+        state_file = tmp_path / "subscriptions.json"
+        self.save_record(state_file)
+        registry = self.get_registry(state_file)
+        registry._saved_subscriptions = registry._load_state()
+
+        registry.register(self.get_device())
+
+        (event,) = registry._sched.queue
+        assert event.action == registry._resubscribe
+        assert event.argument[2] == "uuid:saved"
+
+    @mock.patch.object(subscribe, "get_ip_address",
+                       return_value="192.168.1.3")
+    def test_saved_subscription_with_old_callback_is_replaced(
+            self, _, tmp_path):
+        state_file = tmp_path / "subscriptions.json"
+        self.save_record(state_file)
+        registry = self.get_registry(state_file)
+        registry._saved_subscriptions = registry._load_state()
+
+        registry.register(self.get_device())
+
+        actions = {event.action: event.argument
+                   for event in registry._sched.queue}
+        assert actions[registry._resubscribe][2] is None
+        assert actions[registry._unsubscribe_stale][0][0]["sid"] == (
+            "uuid:saved")
+
+    @mock.patch.object(subscribe, "get_ip_address",
+                       return_value="192.168.1.2")
+    def test_renewed_subscription_survives_another_restart(self, _, tmp_path):
+        state_file = tmp_path / "subscriptions.json"
+        self.save_record(state_file)
+        response = mock.Mock(status_code=200, headers=CaseInsensitiveDict(
+            {"SID": "uuid:saved", "TIMEOUT": "Second-300"}))
+        for _restart in range(2):
+            registry = self.get_registry(state_file)
+            registry._saved_subscriptions = registry._load_state()
+
+            registry.register(self.get_device())
+
+            (event,) = registry._sched.queue
+            assert event.action == registry._resubscribe
+            assert event.argument[2] == "uuid:saved"
+            with mock.patch.object(subscribe.requests, "request",
+                                   return_value=response) as request:
+                registry._resubscribe(*event.argument)
+            assert "CALLBACK" not in request.call_args[1]["headers"]
+
+        (record,) = json.loads(state_file.read_text())
+        assert record["callback"] == "<http://192.168.1.2:8989>"
+
+    def start_registry(self, state_file, **kwargs):
+        registry = self.get_registry(state_file)
+
+        def find_port():
+            registry._port = 8989
+        with mock.patch.object(registry, "_find_port", find_port), \
+                mock.patch.object(subscribe.threading, "Thread"):
+            registry.start(**kwargs)
+        return registry
+
+    def test_unclaimed_subscriptions_are_unsubscribed(self, tmp_path):
+        state_file = tmp_path / "subscriptions.json"
+        self.save_record(state_file)
+        registry = self.start_registry(state_file, unclaimed_grace=60)
+
+        (event,) = registry._sched.queue
+        assert event.action == registry._unsubscribe_unclaimed
+        assert event.time == pytest.approx(time.time() + 60, abs=5)
+        with mock.patch.object(subscribe.requests, "request") as request:
+            registry._unsubscribe_unclaimed()
+
+        request.assert_called_once_with(
+            method="UNSUBSCRIBE", url=self.URL,
+            headers={"SID": "uuid:saved"},
+            timeout=subscribe.UNSUBSCRIBE_TIMEOUT)
+        assert json.loads(state_file.read_text()) == []
+
+    @mock.patch.object(subscribe, "get_ip_address",
+                       return_value="192.168.1.2")
+    def test_claimed_subscriptions_are_kept(self, _, tmp_path):
+        state_file = tmp_path / "subscriptions.json"
+        self.save_record(state_file)
+        registry = self.start_registry(state_file)
+        registry.register(self.get_device())
+
+        with mock.patch.object(subscribe.requests, "request") as request:
+            registry._unsubscribe_unclaimed()
+
+        request.assert_not_called()
+
+    def test_unclaimed_subscriptions_can_be_kept(self, tmp_path):
+        state_file = tmp_path / "subscriptions.json"
+        self.save_record(state_file)
+        registry = self.start_registry(state_file, unclaimed_grace=None)
+
+        assert registry._sched.empty()
+
+    def test_unreadable_state_file_is_ignored(self, tmp_path):
+        state_file = tmp_path / "subscriptions.json"
+        state_file.write_text("not json")
+        registry = self.get_registry(state_file)
+
+        assert registry._load_state() == {}
+
+
+class TestEventServices:
+    @staticmethod
+    def get_insight():
+        device = get_mock_device()
+        device.EVENT_SERVICES = ("basicevent", "insight")
+        device.services = {
+            "basicevent": mock.Mock(eventSubURL="http://host/basicevent"),
+            "insight": mock.Mock(eventSubURL="http://host/insight"),
+            "metainfo": mock.Mock(eventSubURL="http://host/metainfo"),
+        }
+        return device
+
+    @mock.patch.object(subscribe, "get_ip_address",
+                       return_value="192.168.1.2")
+    def test_each_event_service_is_subscribed_separately(self, _):
+        device = self.get_insight()
+        registry = subscribe.SubscriptionRegistry()
+        registry._port = 8989
+
+        registry.register(device)
+
+        services = sorted(event.argument[1]
+                          for event in registry._sched.queue)
+        assert services == ["basicevent", "insight"]
+
+    def test_missing_event_service_is_skipped(self):
+        device = self.get_insight()
+        del device.services["insight"]
+
+        assert subscribe.event_services(device) == ["basicevent"]
+
+    def test_subscribed_only_when_all_services_are_subscribed(self):
+        device = self.get_insight()
+        registry = subscribe.SubscriptionRegistry()
+        registry._subscriptions[("SERIAL", "basicevent")] = {
+            "expiry": time.time() + 300}
+        assert not registry.is_subscribed(device)
+
+        registry._subscriptions[("SERIAL", "insight")] = {
+            "expiry": time.time() + 300}
+        assert registry.is_subscribed(device)
+
+    def test_event_updates_device_state(self):
+        device = self.get_insight()
+        registry = subscribe.SubscriptionRegistry()
+
+        registry.event(device, "InsightParams", "1|2|3")
+
+        device.subscription_update.assert_called_once_with(
+            "InsightParams", "1|2|3")
+
+
+class TestEventRouting:
+    @staticmethod
+    def get_device(serialnumber="SERIAL", host="192.168.1.100"):
+        device = get_mock_device(serialnumber, host)
+        device.EVENT_SERVICES = ("basicevent",)
+        device.services = {"basicevent": device.basicevent}
+        return device
+
+    @staticmethod
+    def subscribe_device(registry, device, sid, old_sid=None):
+        response = mock.Mock(status_code=200, headers=CaseInsensitiveDict(
+            {"SID": sid, "TIMEOUT": "Second-300"}))
+        with mock.patch.object(subscribe.requests, "request",
+                               return_value=response):
+            registry._url_resubscribe(
+                device, "basicevent", {}, old_sid, "http://url")
+
+    def test_event_is_routed_by_sid(self):
+        registry = subscribe.SubscriptionRegistry()
+        first = self.get_device("FIRST", "10.0.0.1")
+        second = self.get_device("SECOND", "10.0.0.1")
+        self.subscribe_device(registry, first, "uuid:first")
+        self.subscribe_device(registry, second, "uuid:second")
+
+        assert registry.device_for_event("uuid:first", "10.0.0.1") is first
+        assert registry.device_for_event("uuid:second", "10.0.0.1") is second
+
+    def test_event_is_routed_by_sid_after_address_change(self):
+        registry = subscribe.SubscriptionRegistry()
+        device = self.get_device()
+        self.subscribe_device(registry, device, "uuid:1")
+
+        assert registry.device_for_event("uuid:1", "10.0.0.99") is device
+
+    @mock.patch.object(subscribe, "get_ip_address",
+                       return_value="192.168.1.2")
+    def test_event_without_known_sid_falls_back_to_host(self, _):
+        registry = subscribe.SubscriptionRegistry()
+        registry._port = 8989
+        device = self.get_device()
+        registry.register(device)
+
+        assert registry.device_for_event(None, device.host) is device
+        assert registry.device_for_event("uuid:unknown", device.host) is (
+            device)
+        assert registry.device_for_event(None, "10.0.0.99") is None
+
+    @mock.patch.object(subscribe, "get_ip_address",
+                       return_value="192.168.1.2")
+    def test_register_forgets_previous_address(self, _):
+        registry = subscribe.SubscriptionRegistry()
+        registry._port = 8989
+        device = self.get_device(host="10.0.0.1")
+        registry.register(device)
+
+        device.host = "10.0.0.2"
+        registry.register(device)
+
+        assert registry.devices == {"10.0.0.2": device}
+
+    def test_renewal_with_new_sid_replaces_old_sid(self):
+        registry = subscribe.SubscriptionRegistry()
+        device = self.get_device()
+        self.subscribe_device(registry, device, "uuid:old")
+
+        self.subscribe_device(registry, device, "uuid:new", old_sid="uuid:old")
+
+        assert registry.device_for_event("uuid:new", None) is device
+        assert registry.device_for_event("uuid:old", None) is None
+
+    def test_unregister_removes_sids(self):
+        registry = subscribe.SubscriptionRegistry()
+        device = self.get_device()
+        self.subscribe_device(registry, device, "uuid:1")
+
+        registry.unregister(device)
+
+        assert registry.device_for_event("uuid:1", None) is None
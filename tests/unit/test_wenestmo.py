@@ -0,0 +1,659 @@
+"""Tests for wenestmo."""
+
+import configparser
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import unittest.mock as mock
+
+import pytest
+
+# wenestmo talks to Google through these, which the pywemo package (and so CI)
+# doesn't install; see requirements.txt.
+for module in ("googleapiclient", "httplib2", "oauth2client"):
+    pytest.importorskip(module)
+
+import rules
+import wenestmo
+
+ZONES = """
+[zone Upstairs]
+Thermostat = Upstairs
+HeatingDeviceNames = ["Upstairs heater"]
+
+[zone Downstairs]
+Thermostat = Downstairs
+HeatingDeviceNames = ["Downstairs heater"]
+"""
+
+
+class Plug:
+    def __init__(self, name, mac):
+        self.name = name
+        self.mac = mac
+        self.state = 1
+
+    def on(self):
+        self.state = 1
+
+    def off(self):
+        self.state = 0
+
+    def get_state(self):
+        return self.state
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    # Runs wenestmo from a copy of config.ini, and puts its settings back after.
+    with open("config.ini") as original:
+        text = original.read()
+    path = tmp_path / "config.ini"
+    path.write_text(text + ZONES)
+    saved = {
+        name: getattr(wenestmo, name)
+        for name in ("settings", "config", "zones", "zone_executor")
+    }
+    monkeypatch.setattr(wenestmo, "CONFIG_FILE", str(path))
+    monkeypatch.setattr(wenestmo, "config_stamp", None)
+    assert wenestmo.reload_config()
+    yield path
+    for name, value in saved.items():
+        setattr(wenestmo, name, value)
+    wenestmo.poll_scheduler.configure(
+        wenestmo.settings.min_polling_period_s,
+        wenestmo.settings.max_polling_period_s,
+        wenestmo.settings.nest_requests_per_hour,
+    )
+
+
+def rewrite(path, old, new):
+    text = path.read_text()
+    assert old in text
+    path.write_text(text.replace(old, new))
+    # Make sure the change is seen even on a coarse-grained filesystem clock.
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def zone(name):
+    return next(zone for zone in wenestmo.zones if zone.name == name)
+
+
+class TestReloadConfig:
+    def test_unchanged_config_is_not_reloaded(self, config_file):
+        assert not wenestmo.reload_config()
+
+    def test_settings_are_swapped_in(self, config_file):
+        target = wenestmo.settings.humidity_percent_target
+        rewrite(
+            config_file,
+            "HumidityPercentTarget = {}".format(target),
+            "HumidityPercentTarget = {}".format(target + 5),
+        )
+        assert wenestmo.config_changed()
+        assert wenestmo.reload_config()
+        assert wenestmo.settings.humidity_percent_target == target + 5
+        assert not wenestmo.config_changed()
+
+    def test_zone_state_survives(self, config_file):
+        heater = Plug("Upstairs heater", "aa:01")
+        upstairs = zone("Upstairs")
+        upstairs.activated["HEATING"].add(heater)
+        upstairs.role_macs["HEATING"].add(heater.mac)
+        upstairs.restored_macs["COOLING"].add("aa:02")
+        upstairs.prev_hvac_status = "HEATING"
+        upstairs.first_iteration = False
+        upstairs.thermostat_name = "enterprises/x/devices/upstairs"
+        rewrite(config_file, '["Downstairs heater"]', '["Downstairs fan"]')
+        assert wenestmo.reload_config()
+
+        reloaded = zone("Upstairs")
+        assert reloaded is not upstairs
+        assert reloaded.activated["HEATING"] == {heater}
+        assert reloaded.role_macs["HEATING"] == {heater.mac}
+        assert reloaded.restored_macs["COOLING"] == {"aa:02"}
+        assert reloaded.prev_hvac_status == "HEATING"
+        assert not reloaded.first_iteration
+        assert reloaded.thermostat_name == "enterprises/x/devices/upstairs"
+        assert heater.state == 1
+
+    def test_changed_role_forgets_learned_macs(self, config_file):
+        zone("Upstairs").role_macs["HEATING"].add("aa:01")
+        rewrite(config_file, '["Upstairs heater"]', '["Space heater"]')
+        assert wenestmo.reload_config()
+        assert not zone("Upstairs").role_macs["HEATING"]
+
+    def test_removed_zone_turns_its_devices_off(self, config_file):
+        heater = Plug("Downstairs heater", "aa:03")
+        zone("Downstairs").activated["HEATING"].add(heater)
+        text = config_file.read_text()
+        config_file.write_text(text[: text.index("[zone Downstairs]")])
+        os.utime(config_file, ns=(0, 0))
+        assert wenestmo.reload_config()
+        assert [zone.name for zone in wenestmo.zones] == ["Upstairs"]
+        assert heater.state == 0
+
+    def test_fan_changes_reach_the_bond_listener(self, config_file, monkeypatch):
+        client = mock.Mock()
+        client.overridden.return_value = False
+        client.submit.return_value = {}
+        monkeypatch.setattr(wenestmo, "bond_client", client)
+        monkeypatch.setattr(wenestmo, "bond_listener", mock.Mock(device_ids=set()))
+        rewrite(
+            config_file,
+            'HeatingDeviceNames = ["Downstairs heater"]',
+            'HeatingDeviceNames = ["Downstairs heater"]\nFanIds = ["f1"]',
+        )
+        assert wenestmo.reload_config()
+        assert wenestmo.bond_listener.device_ids == {"f1"}
+        client.submit.assert_not_called()
+
+        text = config_file.read_text()
+        config_file.write_text(text[: text.index("[zone Downstairs]")])
+        os.utime(config_file, ns=(0, 0))
+        assert wenestmo.reload_config()
+        assert wenestmo.bond_listener.device_ids == set()
+        client.submit.assert_called_once_with({"f1"}, "TurnOff", None, {"power": 0})
+
+    def test_invalid_config_is_ignored(self, config_file):
+        zones = wenestmo.zones
+        target = wenestmo.settings.humidity_percent_target
+        rewrite(
+            config_file,
+            "HumidityPercentTarget = {}".format(target),
+            "HumidityPercentTarget = lots",
+        )
+        assert not wenestmo.reload_config()
+        assert wenestmo.settings.humidity_percent_target == target
+        assert wenestmo.zones is zones
+        # It isn't retried until the file changes again.
+        assert not wenestmo.config_changed()
+
+    def test_bad_device_list_is_invalid(self, config_file):
+        rewrite(config_file, '["Upstairs heater"]', '"Upstairs heater"')
+        assert not wenestmo.reload_config()
+
+    def test_poll_limits_are_applied(self, config_file):
+        rewrite(config_file, "MaxPollingPeriodS = 300", "MaxPollingPeriodS = 200")
+        assert wenestmo.reload_config()
+        assert wenestmo.poll_scheduler.max_period_s == 200
+        assert wenestmo.settings.healthy_iteration_age_s == 600
+
+
+class SlowPlug(Plug):
+    # A plug whose commands block until `release` is set.
+    def __init__(self, name, mac, release):
+        super().__init__(name, mac)
+        self.state = 0
+        self.release = release
+
+    def on(self):
+        self.release.wait(5)
+        super().on()
+
+
+@pytest.fixture
+def one_command_thread(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(wenestmo, "command_executor", executor)
+    yield executor
+    executor.shutdown()
+
+
+class TestCommandDeadline:
+    def test_queued_commands_are_cancelled(self, one_command_thread):
+        release = threading.Event()
+        slow = SlowPlug("Slow", "aa:01", release)
+        queued = Plug("Queued", "aa:02")
+        futures = wenestmo.submit_commands({slow: slow.on, queued: queued.off})
+        assert not wenestmo.wait_for_commands(futures, time.monotonic() + 0.1)
+        release.set()
+        one_command_thread.shutdown()
+        assert slow.state == 1
+        assert queued.state == 1
+
+    def test_late_wemo_is_activated(self, one_command_thread):
+        release = threading.Event()
+        heater = SlowPlug("Heater", "aa:03", release)
+        zone = wenestmo.Zone("Test", "", {"HEATING": ["Heater"]}, [])
+        zone.power_on_needed_wemos([heater], "HEATING", time.monotonic() + 0.1)
+        assert not zone.activated["HEATING"]
+        assert wenestmo.device_error_count.pop(heater.mac) == 1
+        release.set()
+        one_command_thread.shutdown()
+        zone.activate_late_wemos()
+        assert zone.activated["HEATING"] == {heater}
+        assert heater.mac not in wenestmo.device_error_count
+
+
+class TestRules:
+    def test_rule_devices_are_named(self):
+        rule = rules.Rule("Lamp fan", "wemo[Lamp] == on", wemo=["Fan plug", "aa:05"])
+        zone = wenestmo.Zone("Test", "", {}, [], [rule])
+        assert zone.rule_wemo_names() == {"Lamp", "Fan plug", "aa:05"}
+
+    def test_failed_rule_is_retried(self, monkeypatch):
+        lamp = Plug("Lamp", "aa:06")
+        fan = Plug("Fan plug", "aa:07")
+        fan.state = 0
+        fan.on = mock.Mock(side_effect=ConnectionError("unreachable"))
+        registry = mock.Mock()
+        registry.devices.return_value = [lamp, fan]
+        monkeypatch.setattr(wenestmo, "wemo_registry", registry)
+        rule = rules.Rule("Lamp fan", "wemo[Lamp] == on", wemo=["Fan plug"])
+        zone = wenestmo.Zone("Test", "", {}, [], [rule])
+
+        zone.apply_rules({"traits": {}})
+        assert not zone.rule_engine.active
+        assert wenestmo.device_error_count[fan.mac] == 1
+
+        fan.on = mock.Mock()
+        zone.apply_rules({"traits": {}})
+        assert zone.rule_engine.active == {rule}
+        assert fan.mac not in wenestmo.device_error_count
+
+
+class TestZoneState:
+    def test_role_macs_are_restored_for_unchanged_roles(self):
+        saved = wenestmo.Zone("Test", "", {"HEATING": ["Heater"]}, [])
+        saved.role_macs["HEATING"].add("aa:01")
+        zone = wenestmo.Zone("Test", "", {"HEATING": ["Heater"]}, [])
+        zone.restore(json.loads(json.dumps(saved.state())))
+        assert zone.role_macs["HEATING"] == {"aa:01"}
+
+    def test_role_names_are_saved_in_a_stable_order(self):
+        # Role names are sets, whose order changes from run to run.
+        zone = wenestmo.Zone("Test", "", {"HEATING": {"Radiator", "Heater"}}, [])
+        assert zone.state()["role_names"]["HEATING"] == ["Heater", "Radiator"]
+
+    def test_role_macs_are_dropped_for_renamed_roles(self):
+        saved = wenestmo.Zone("Test", "", {"HEATING": ["Heater"]}, [])
+        saved.role_macs["HEATING"].add("aa:01")
+        zone = wenestmo.Zone("Test", "", {"HEATING": ["Space heater"]}, [])
+        zone.restore(json.loads(json.dumps(saved.state())))
+        assert not zone.role_macs["HEATING"]
+
+
+class EventPlug(Plug):
+    # A plug that reports BinaryState events like a pywemo Switch.
+    def parse_basic_state(self, params):
+        return {"state": params.split("|")[0]}
+
+    def is_off(self):
+        return self.state == 0
+
+
+@pytest.fixture
+def subscriptions(monkeypatch):
+    subscriptions = mock.Mock()
+    subscriptions.is_subscribed.return_value = True
+    monkeypatch.setattr(wenestmo, "wemo_subscriptions", subscriptions)
+    monkeypatch.setattr(wenestmo, "wemo_on_times", {})
+    monkeypatch.setattr(wenestmo, "wemo_off_times", {})
+    return subscriptions
+
+
+class TestOverrides:
+    def test_off_event_after_on_is_an_override(self, subscriptions):
+        plug = EventPlug("Heater", "aa:01")
+        wenestmo.wemo_on_times[plug.mac] = time.monotonic()
+        assert not wenestmo.user_turned_off(plug)
+        wenestmo.on_wemo_state(plug, "BinaryState", "0|1492338954|0|922")
+        assert wenestmo.user_turned_off(plug)
+
+    def test_off_event_before_on_is_not_an_override(self, subscriptions):
+        plug = EventPlug("Heater", "aa:01")
+        wenestmo.on_wemo_state(plug, "BinaryState", "0")
+        wenestmo.wemo_on_times[plug.mac] = time.monotonic()
+        assert not wenestmo.user_turned_off(plug)
+
+    def test_on_and_unparseable_events_are_ignored(self, subscriptions):
+        plug = EventPlug("Heater", "aa:01")
+        wenestmo.on_wemo_state(plug, "BinaryState", "1")
+        wenestmo.on_wemo_state(plug, "BinaryState", "")
+        assert wenestmo.wemo_off_times == {}
+
+    def test_unsubscribed_device_is_polled(self, subscriptions):
+        subscriptions.is_subscribed.return_value = False
+        plug = EventPlug("Heater", "aa:01")
+        assert not wenestmo.user_turned_off(plug)
+        plug.state = 0
+        assert wenestmo.user_turned_off(plug)
+
+    def test_overridden_wemo_is_forgotten(self, subscriptions):
+        heater = EventPlug("Heater", "aa:01")
+        zone = wenestmo.Zone("Test", "", {"HEATING": ["Heater"]}, [])
+        zone.activated["HEATING"].add(heater)
+        wenestmo.wemo_on_times[heater.mac] = time.monotonic()
+        wenestmo.on_wemo_state(heater, "BinaryState", "0")
+        zone.forget_user_controlled_wemos()
+        assert not zone.activated["HEATING"]
+
+
+@pytest.fixture
+def state_file(tmp_path, monkeypatch):
+    path = tmp_path / "state.json"
+    monkeypatch.setattr(wenestmo, "STATE_FILE", str(path))
+    monkeypatch.setattr(wenestmo, "saved_state", None)
+    return path
+
+
+class TestSaveState:
+    def get_zone(self):
+        return wenestmo.Zone("Upstairs", "", {"HEATING": ["Heater"]}, [])
+
+    def test_round_trip(self, state_file, monkeypatch):
+        zone = self.get_zone()
+        heater = Plug("Heater", "aa:01")
+        zone.activated["HEATING"].add(heater)
+        zone.restored_macs["HUMIDIFYING"].add("aa:02")
+        zone.role_macs["HEATING"].add(heater.mac)
+        zone.prev_hvac_status = "HEATING"
+        zone.aux_heat_engaged = True
+        monkeypatch.setattr(wenestmo, "zones", [zone])
+        wenestmo.save_state()
+
+        restored = self.get_zone()
+        monkeypatch.setattr(wenestmo, "zones", [restored])
+        registry = mock.Mock()
+        registry.get.side_effect = {heater.mac: heater}.get
+        monkeypatch.setattr(wenestmo, "wemo_registry", registry)
+        wenestmo.load_state()
+        restored.resolve_restored_devices()
+
+        assert restored.activated["HEATING"] == {heater}
+        assert restored.restored_macs["HUMIDIFYING"] == {"aa:02"}
+        assert restored.role_macs["HEATING"] == {heater.mac}
+        assert restored.prev_hvac_status == "HEATING"
+        assert restored.aux_heat_engaged
+        assert not restored.humidifiers_engaged
+        assert not restored.first_iteration
+
+    def test_unchanged_state_is_not_rewritten(self, state_file, monkeypatch):
+        monkeypatch.setattr(wenestmo, "zones", [self.get_zone()])
+        wenestmo.save_state()
+        state_file.write_text("{}")
+        wenestmo.save_state()
+        assert state_file.read_text() == "{}"
+
+    def test_state_from_before_zones_goes_to_the_first_zone(
+        self, state_file, monkeypatch
+    ):
+        state_file.write_text(
+            json.dumps({"activated": {"HEATING": ["aa:01"]}, "prev_hvac_status": "OFF"})
+        )
+        zone = self.get_zone()
+        monkeypatch.setattr(wenestmo, "zones", [zone])
+        wenestmo.load_state()
+        assert zone.restored_macs["HEATING"] == {"aa:01"}
+        assert zone.prev_hvac_status == "OFF"
+
+    def test_missing_or_unreadable_state_is_ignored(self, state_file, monkeypatch):
+        zone = self.get_zone()
+        monkeypatch.setattr(wenestmo, "zones", [zone])
+        wenestmo.load_state()
+        state_file.write_text("not json")
+        wenestmo.load_state()
+        assert zone.first_iteration
+
+
+class TestHealth:
+    def test_fresh_iteration_is_healthy(self, monkeypatch):
+        monkeypatch.setattr(wenestmo, "last_iteration_at", 10000.0)
+        monkeypatch.setattr(wenestmo, "started_at", 0.0)
+        monkeypatch.setattr(
+            wenestmo, "age_s", lambda at: None if at is None else 1e4 - at
+        )
+        healthy, details = wenestmo.health()
+        assert healthy
+        assert details["last_iteration_age_s"] == 0
+
+
+@pytest.fixture
+def discovery(tmp_path, monkeypatch):
+    # A discovery cache in tmp_path, and a fake discovery server.
+    path = tmp_path / "sdm_discovery.json"
+    monkeypatch.setattr(wenestmo, "DISCOVERY_CACHE", str(path))
+    http = mock.Mock()
+    http.return_value.request.return_value = (
+        mock.Mock(status=200),
+        b'{"version": "new"}',
+    )
+    monkeypatch.setattr(wenestmo.httplib2, "Http", http)
+    thread = mock.Mock()
+    monkeypatch.setattr(wenestmo.threading, "Thread", thread)
+    return path, http, thread
+
+
+class TestDiscoveryDocument:
+    def write_cache(self, path, age_s):
+        path.write_text('{"version": "cached"}')
+        mtime = time.time() - age_s
+        os.utime(path, (mtime, mtime))
+
+    def test_fresh_cache_is_used_without_the_network(self, discovery):
+        path, http, thread = discovery
+        self.write_cache(path, 60)
+        assert wenestmo.get_discovery_document() == '{"version": "cached"}'
+        http.assert_not_called()
+        thread.assert_not_called()
+
+    def test_stale_cache_is_used_and_refreshed_in_the_background(self, discovery):
+        path, http, thread = discovery
+        self.write_cache(path, wenestmo.DISCOVERY_CACHE_MAX_AGE_S + 60)
+        assert wenestmo.get_discovery_document() == '{"version": "cached"}'
+        http.assert_not_called()
+        thread.return_value.start.assert_called_once()
+
+        thread.call_args[1]["target"]()
+        assert path.read_text() == '{"version": "new"}'
+
+    def test_missing_cache_is_fetched_and_saved(self, discovery, monkeypatch):
+        path, http, thread = discovery
+        replace = mock.Mock(wraps=os.replace)
+        monkeypatch.setattr(wenestmo.os, "replace", replace)
+        assert wenestmo.get_discovery_document() == '{"version": "new"}'
+        http.return_value.request.assert_called_once_with(wenestmo.DISCOVERY_URL)
+        replace.assert_called_once_with(str(path) + ".tmp", str(path))
+        assert path.read_text() == '{"version": "new"}'
+        thread.assert_not_called()
+
+    def test_failed_fetch_is_not_cached(self, discovery):
+        path, http, thread = discovery
+        http.return_value.request.return_value = (mock.Mock(status=503), b"")
+        with pytest.raises(RuntimeError):
+            wenestmo.get_discovery_document()
+        assert not path.exists()
+
+
+class TestTokenRefresher:
+    def test_refresh_latency_is_exported(self, monkeypatch):
+        refresher = wenestmo.TokenRefresher(mock.Mock())
+        monkeypatch.setattr(wenestmo, "token_refresher", refresher)
+        assert "\nwenestmo_oauth_refresh_seconds " not in wenestmo.metrics.render()
+        refresher.refresh()
+        refresher.credentials.refresh.assert_called_once()
+        assert "\nwenestmo_oauth_refresh_seconds " in wenestmo.metrics.render()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_thermostat(temperature_c, heat_c=None, humidity=None, status="OFF"):
+    traits = {
+        "sdm.devices.traits.Temperature": {"ambientTemperatureCelsius": temperature_c},
+        "sdm.devices.traits.Humidity": {
+            "ambientHumidityPercent": (
+                wenestmo.settings.humidity_percent_target
+                if humidity is None
+                else humidity
+            )
+        },
+        "sdm.devices.traits.ThermostatHvac": {"status": status},
+        "sdm.devices.traits.Info": {"customName": ""},
+    }
+    if heat_c is not None:
+        traits["sdm.devices.traits.ThermostatTemperatureSetpoint"] = {
+            "heatCelsius": heat_c
+        }
+    return {"name": "enterprises/x/devices/t", "traits": traits}
+
+
+class TestPollScheduler:
+    def get_scheduler(self, requests_per_hour=60):
+        clock = FakeClock()
+        return wenestmo.PollScheduler(30, 300, requests_per_hour, clock), clock
+
+    def test_backs_off_while_idle(self):
+        scheduler, _ = self.get_scheduler()
+        idle = make_thermostat(20, heat_c=15)
+        delays = []
+        for _ in range(8):
+            scheduler.update([idle], False)
+            delays.append(scheduler.next_delay())
+        assert delays[:3] == [45, 67.5, 101.25]
+        assert delays[-1] == 300
+
+    def test_polls_fast_near_a_setpoint(self):
+        scheduler, _ = self.get_scheduler()
+        for _ in range(5):
+            scheduler.update([make_thermostat(20, heat_c=15)], False)
+        scheduler.update([make_thermostat(20, heat_c=20.3)], False)
+        assert scheduler.next_delay() == 30
+
+    def test_polls_fast_near_the_humidity_band(self):
+        scheduler, _ = self.get_scheduler()
+        humidity = (
+            wenestmo.settings.humidity_percent_target
+            - wenestmo.settings.humidity_percent_threshold
+        )
+        scheduler.update([make_thermostat(20, humidity=humidity)], False)
+        assert scheduler.next_delay() == 30
+
+    def test_polls_fast_after_an_hvac_change(self):
+        scheduler, clock = self.get_scheduler()
+        idle = make_thermostat(20, heat_c=15)
+        scheduler.update([idle], True)
+        assert scheduler.next_delay() == 30
+        clock.now += wenestmo.RECENT_HVAC_CHANGE_S
+        scheduler.update([idle], False)
+        assert scheduler.next_delay() == 45
+
+    def test_budget_limits_the_rate(self):
+        scheduler, clock = self.get_scheduler(requests_per_hour=12)
+        # The burst allowance is spent without waiting.
+        for _ in range(scheduler.max_tokens):
+            assert scheduler.next_delay() == 30
+            scheduler.spend()
+        # Then one request every 300 s, even though a transition is likely.
+        assert scheduler.next_delay() == 300
+        clock.now += 100
+        assert scheduler.next_delay() == pytest.approx(200)
+
+    def test_budget_refills_up_to_the_burst(self):
+        scheduler, clock = self.get_scheduler()
+        for _ in range(scheduler.max_tokens):
+            scheduler.spend()
+        clock.now += 24 * 3600
+        scheduler.spend()
+        assert scheduler.tokens == scheduler.max_tokens - 1
+
+    def test_configure_clamps_the_period(self):
+        scheduler, _ = self.get_scheduler()
+        for _ in range(8):
+            scheduler.update([make_thermostat(20, heat_c=15)], False)
+        scheduler.configure(10, 120, 60)
+        assert scheduler.next_delay() == 120
+
+
+def named_thermostat(device_id, custom_name="", room=""):
+    thermostat = make_thermostat(20)
+    thermostat["name"] = "enterprises/x/devices/" + device_id
+    thermostat["traits"]["sdm.devices.traits.Info"]["customName"] = custom_name
+    thermostat["parentRelations"] = [
+        {"parent": "enterprises/x/structures/s/rooms/r", "displayName": room}
+    ]
+    return thermostat
+
+
+class TestZones:
+    SETTINGS = wenestmo.settings._replace(
+        wemo_role_names={"HEATING": {"Heater"}}, bond_fan_ids={"f1"}, rules=[]
+    )
+
+    def read_zones(self, text):
+        config = configparser.ConfigParser()
+        config.read_string(text)
+        return wenestmo.read_zones(config, self.SETTINGS)
+
+    @pytest.mark.parametrize(
+        "selector",
+        ["", "Hallway", "Upstairs", "upstairs-id", "enterprises/x/devices/upstairs-id"],
+    )
+    def test_thermostat_matches(self, selector):
+        thermostat = named_thermostat("upstairs-id", "Hallway", "Upstairs")
+        assert wenestmo.thermostat_matches(thermostat, selector)
+
+    def test_thermostat_does_not_match(self):
+        thermostat = named_thermostat("upstairs-id", "Hallway", "Upstairs")
+        assert not wenestmo.thermostat_matches(thermostat, "Downstairs")
+
+    def test_zones_are_read_from_sections(self):
+        upstairs, downstairs = self.read_zones("""
+[zone Upstairs]
+Thermostat = Hallway
+HeatingDeviceNames = ["Upstairs heater"]
+FanIds = ["f2"]
+
+[zone Downstairs]
+HumidifierNames = ["Humidifier"]
+""")
+        assert upstairs.name == "Upstairs"
+        assert upstairs.thermostat == "Hallway"
+        assert upstairs.role_names["HEATING"] == {"Upstairs heater"}
+        assert upstairs.fan_ids == {"f2"}
+        assert downstairs.thermostat == ""
+        assert downstairs.role_names["HUMIDIFYING"] == {"Humidifier"}
+        assert downstairs.role_names["HEATING"] == set()
+
+    def test_default_zone_without_sections(self):
+        (zone,) = self.read_zones("[wemo]\n")
+        assert zone.name == "default"
+        assert zone.role_names == {"HEATING": {"Heater"}}
+        assert zone.fan_ids == {"f1"}
+
+    def test_duplicate_zone_names_are_invalid(self):
+        with pytest.raises(ValueError):
+            self.read_zones("[zone Upstairs]\n[zone  Upstairs]\n")
+
+    def test_zone_finds_and_remembers_its_thermostat(self):
+        downstairs = named_thermostat("downstairs-id", room="Downstairs")
+        upstairs = named_thermostat("upstairs-id", room="Upstairs")
+        zone = wenestmo.Zone("Upstairs", "Upstairs", {}, [])
+        assert zone.find_thermostat([downstairs, upstairs]) is upstairs
+        assert zone.thermostat_name == upstairs["name"]
+        # Found by its device name from then on, even if the room is renamed.
+        upstairs["parentRelations"][0]["displayName"] = "Attic"
+        assert zone.find_thermostat([downstairs, upstairs]) is upstairs
+
+    def test_zone_without_a_matching_thermostat(self):
+        zone = wenestmo.Zone("Attic", "Attic", {}, [])
+        assert zone.find_thermostat([named_thermostat("upstairs-id")]) is None
+
+
+class TestPhaseStatsSignal:
+    def test_handler_takes_no_locks(self, monkeypatch):
+        # The signal can land while the main thread holds these.
+        requests = wenestmo.queue.SimpleQueue()
+        monkeypatch.setattr(wenestmo, "phase_stats_requests", requests)
+        with wenestmo.phase_stats._lock:
+            wenestmo.request_phase_stats(wenestmo.signal.SIGUSR1, None)
+        assert requests.get_nowait() is None
@@ -1,47 +1,241 @@
 import configparser
 import datetime
 import json
+import logging
+import os
+import queue
+import signal
+import threading
 import time
-import traceback
-from collections import Counter, deque
-from random import random
-import requests
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import httplib2
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import run_flow
 
 import pywemo
+from bond import BondClient, BondPushListener, expected_state
+from logs import LogPipeline
+from metrics import Metrics, MetricsServer, PhaseStats, PhaseTimer
+from nest_events import ThermostatEvents
+from recorder import Recorder
+from rules import RuleEngine, load_rules, thermostat_inputs
 
 STORAGE = Storage("credentials.storage")
+# The SDM API discovery document is cached here, so starting up doesn't need a
+# round trip to Google's discovery service.
+DISCOVERY_CACHE = "sdm_discovery.json"
+DISCOVERY_CACHE_MAX_AGE_S = 7 * 24 * 60 * 60
+DISCOVERY_URL = (
+    "https://smartdevicemanagement.googleapis.com/$discovery/rest?version=v1"
+)
 
-config = configparser.ConfigParser()
-config.read("config.ini")
+CONFIG_FILE = "config.ini"
 
-# Console output will show the temperature in F or C.
-FAHRENHEIT = config.getboolean("DEFAULT", "Fahrenheit")
-POLLING_PERIOD_S = config.getint("DEFAULT", "PollingPeriodS")
-aux_heat_thresh = config.getint("DEFAULT", "AuxHeatThreshold")
-AUX_HEAT_THRESHOLD_C = aux_heat_thresh * 5 / 9.0 if FAHRENHEIT else aux_heat_thresh
-HUMIDITY_PERCENT_TARGET = config.getint("DEFAULT", "HumidityPercentTarget")
-HUMIDITY_PERCENT_THRESHOLD = config.getint("DEFAULT", "HumidityPercentThreshold")
 
-GOOGLE_ENTERPRISE = config["google"]["Enterprise"]
-GOOGLE_CLIENT_SECRET = config["google"]["ClientSecretFile"]
-GOOGLE_SCOPE = "https://www.googleapis.com/auth/sdm.service"
+def file_stamp(path):
+    # Changes whenever the file is rewritten. None if it can't be read.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
 
-WEMO_HEATING_DEVICE_NAMES = set(json.loads(config.get("wemo", "HeatingDeviceNames")))
-WEMO_COOLING_DEVICE_NAMES = set(json.loads(config.get("wemo", "CoolingDeviceNames")))
-WEMO_AUXILLIARY_HEATING_DEVICE_NAMES = set(
-    json.loads(config.get("wemo", "AuxiliaryHeatingDeviceNames"))
+
+def config_names(config, section, option):
+    # A JSON list of device names or MACs. A missing option is an empty list.
+    names = json.loads(config.get(section, option, fallback="[]"))
+    if not isinstance(names, list) or not all(isinstance(x, str) for x in names):
+        raise ValueError("{} in [{}] must be a list of names".format(option, section))
+    return set(names)
+
+
+# The settings that can change while wenestmo runs. They are compiled into one
+# Settings and published by assigning `settings`, so a reload swaps them all at
+# once and every reader sees either the old set or the new one.
+Settings = namedtuple(
+    "Settings",
+    [
+        # Console output will show the temperature in F or C.
+        "fahrenheit",
+        # How often wemo discovery runs while it is still finding devices.
+        "polling_period_s",
+        "min_polling_period_s",
+        "max_polling_period_s",
+        "nest_requests_per_hour",
+        "aux_heat_threshold_c",
+        "humidity_percent_target",
+        "humidity_percent_threshold",
+        "google_enterprise",
+        # Role -> device names (or MAC addresses) for the default zone.
+        "wemo_role_names",
+        "bond_fan_ids",
+        # Device commands for a transition are sent concurrently. The transition
+        # stops waiting for commands after this long; stragglers count as
+        # failures.
+        "transition_deadline_s",
+        "max_retries",
+        # /healthz fails once this long passes without a successful iteration.
+        "healthy_iteration_age_s",
+        # An iteration slower than this logs its phase breakdown.
+        "slow_iteration_s",
+        # Extra behaviour declared as [rule <name>] sections; see rules.py.
+        "rules",
+    ],
 )
-WEMO_HUMIDIFIER_DEVICE_NAMES = set(json.loads(config.get("wemo", "HumidifierNames")))
 
+
+def compile_settings(config):
+    # Reads the settings that can change while wenestmo runs. Returns a
+    # Settings, or raises ValueError, KeyError or configparser.Error if the
+    # config is invalid.
+    fahrenheit = config.getboolean("DEFAULT", "Fahrenheit")
+    aux_heat_thresh = config.getint("DEFAULT", "AuxHeatThreshold")
+    min_polling_period_s = config.getint("DEFAULT", "MinPollingPeriodS", fallback=30)
+    max_polling_period_s = config.getint("DEFAULT", "MaxPollingPeriodS", fallback=300)
+    requests_per_hour = config.getint("google", "RequestsPerHour", fallback=120)
+    if not 0 < min_polling_period_s <= max_polling_period_s:
+        raise ValueError("MinPollingPeriodS must be between 0 and MaxPollingPeriodS")
+    if requests_per_hour <= 0:
+        raise ValueError("RequestsPerHour must be positive")
+    return Settings(
+        fahrenheit=fahrenheit,
+        polling_period_s=config.getint("DEFAULT", "PollingPeriodS"),
+        min_polling_period_s=min_polling_period_s,
+        max_polling_period_s=max_polling_period_s,
+        nest_requests_per_hour=requests_per_hour,
+        aux_heat_threshold_c=(
+            aux_heat_thresh * 5 / 9.0 if fahrenheit else aux_heat_thresh
+        ),
+        humidity_percent_target=config.getint("DEFAULT", "HumidityPercentTarget"),
+        humidity_percent_threshold=config.getint("DEFAULT", "HumidityPercentThreshold"),
+        google_enterprise=config["google"]["Enterprise"],
+        # Without any [zone ...] sections, these make up the single default
+        # zone.
+        wemo_role_names={
+            "HEATING": config_names(config, "wemo", "HeatingDeviceNames"),
+            "COOLING": config_names(config, "wemo", "CoolingDeviceNames"),
+            "AUX_HEATING": config_names(config, "wemo", "AuxiliaryHeatingDeviceNames"),
+            "HUMIDIFYING": config_names(config, "wemo", "HumidifierNames"),
+        },
+        bond_fan_ids=config_names(config, "bond", "FanIds"),
+        transition_deadline_s=config.getint(
+            "DEFAULT", "TransitionDeadlineS", fallback=30
+        ),
+        max_retries=config.getint("wemo", "MaxPowerOffRetries"),
+        healthy_iteration_age_s=3 * max_polling_period_s,
+        slow_iteration_s=config.getfloat("DEFAULT", "SlowIterationS", fallback=10),
+        rules=load_rules(config),
+    )
+
+
+# The stamp is taken first, so a write during the read is seen as a change.
+config_stamp = file_stamp(CONFIG_FILE)
+config = configparser.ConfigParser()
+config.read(CONFIG_FILE)
+# Replaced as a whole when config.ini changes; see reload_config.
+settings = compile_settings(config)
+
+# These are only read at startup.
+GOOGLE_PUBSUB_SUBSCRIPTION = config.get("google", "PubsubSubscription", fallback="")
+GOOGLE_CLIENT_SECRET = config["google"]["ClientSecretFile"]
+GOOGLE_SCOPE = "https://www.googleapis.com/auth/sdm.service"
 BOND_IP = config.get("bond", "HubIp")
 BOND_TOKEN = config.get("bond", "Token")
-BOND_FAN_IDS = set(json.loads(config.get("bond", "FanIds")))
+
+command_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="command")
+
+# Temperature, humidity, HVAC status and device switching are kept in a
+# fixed-size binary history file. An empty HistoryFile turns this off.
+HISTORY_FILE = config.get("DEFAULT", "HistoryFile", fallback="wenestmo_history.rec")
+HISTORY_RECORDS = config.getint("DEFAULT", "HistoryRecords", fallback=500000)
+HVAC_STATUS_CODES = {"OFF": 0, "HEATING": 1, "COOLING": 2}
+history = None
+
+# Diagnostics go through a queue to the console and to a rotated file of JSON
+# lines, written on a background thread; see logs.py. An empty LogFile logs to
+# the console only.
+LOG = logging.getLogger("wenestmo")
+LOG_FILE = config.get("DEFAULT", "LogFile", fallback="wenestmo.log")
+LOG_MAX_BYTES = config.getint("DEFAULT", "LogMaxBytes", fallback=1024 * 1024)
+LOG_BACKUPS = config.getint("DEFAULT", "LogBackups", fallback=3)
+LOG_REPEAT_INTERVAL_S = config.getint("DEFAULT", "LogRepeatIntervalS", fallback=300)
+log_pipeline = None
+
+# Time source for rule cooldowns. simulate.py swaps in its simulated clock.
+clock = time.monotonic
+
+# /metrics (Prometheus) and /healthz are served on this port and address. 0
+# turns them off.
+METRICS_PORT = config.getint("DEFAULT", "MetricsPort", fallback=0)
+METRICS_HOST = config.get("DEFAULT", "MetricsHost", fallback="127.0.0.1")
+metrics = Metrics()
+iteration_seconds = metrics.histogram(
+    "wenestmo_iteration_seconds", "Control iteration duration by phase."
+)
+# Phase timings of recent iterations, for percentiles. An iteration slower than
+# settings.slow_iteration_s logs its breakdown; SIGUSR1 prints the percentiles.
+PHASE_WINDOW = config.getint("DEFAULT", "PhaseTimingWindow", fallback=500)
+phase_stats = PhaseStats(PHASE_WINDOW)
+iterations_total = metrics.counter(
+    "wenestmo_iterations_total", "Control iterations by result."
+)
+command_seconds = metrics.histogram(
+    "wenestmo_command_seconds", "Device command latency by device kind."
+)
+command_errors_total = metrics.counter(
+    "wenestmo_command_errors_total",
+    "Device commands that failed or timed out, by device kind and reason.",
+)
+nest_requests_total = metrics.counter(
+    "wenestmo_nest_requests_total", "Nest device list requests by result."
+)
+started_at = time.monotonic()
+# Monotonic times of the last successful iteration and Nest read.
+last_iteration_at = None
+last_nest_read_at = None
+
+
+def start_logging():
+    global log_pipeline
+    try:
+        log_pipeline = LogPipeline(
+            LOG_FILE,
+            max_bytes=LOG_MAX_BYTES,
+            backups=LOG_BACKUPS,
+            repeat_interval_s=LOG_REPEAT_INTERVAL_S,
+        )
+    except OSError:
+        log_pipeline = LogPipeline(repeat_interval_s=LOG_REPEAT_INTERVAL_S)
+        log_pipeline.start()
+        LOG.exception("Unable to open %s, logging to the console only:", LOG_FILE)
+        return
+    log_pipeline.start()
+
+
+def open_history():
+    global history
+    if not HISTORY_FILE:
+        return
+    try:
+        history = Recorder(HISTORY_FILE, HISTORY_RECORDS)
+    except (OSError, ValueError):
+        LOG.exception("Unable to open the history file, not recording:")
+
+
+def record_history(series, value, event=False):
+    if history is None:
+        return
+    try:
+        if event:
+            history.event(series, value)
+        else:
+            history.record(series, value)
+    except ValueError as e:
+        LOG.warning("Unable to record %s: %s", series, e)
 
 
 def authorize_credentials():
@@ -57,31 +251,152 @@ def authorize_credentials():
     return credentials
 
 
+def fetch_discovery_document():
+    # Downloads the discovery document and saves it to the cache.
+    response, content = httplib2.Http(timeout=30).request(DISCOVERY_URL)
+    if response.status != 200:
+        raise RuntimeError(
+            "Discovery document request failed: HTTP {}".format(response.status)
+        )
+    document = content.decode("utf-8")
+    json.loads(document)  # Don't cache anything that isn't valid JSON.
+    with open(DISCOVERY_CACHE + ".tmp", "w") as cache:
+        cache.write(document)
+    os.replace(DISCOVERY_CACHE + ".tmp", DISCOVERY_CACHE)
+    return document
+
+
+def refresh_discovery_document():
+    try:
+        fetch_discovery_document()
+    except:
+        LOG.exception("Unable to refresh the Nest discovery document:")
+
+
+def get_discovery_document():
+    # Returns the cached discovery document. A stale cache is still used, and
+    # refreshed in the background. Only the very first run has to download it.
+    try:
+        with open(DISCOVERY_CACHE) as cache:
+            document = cache.read()
+        age_s = time.time() - os.path.getmtime(DISCOVERY_CACHE)
+    except OSError:
+        return fetch_discovery_document()
+    if age_s > DISCOVERY_CACHE_MAX_AGE_S:
+        threading.Thread(
+            target=refresh_discovery_document, name="Nest discovery", daemon=True
+        ).start()
+    return document
+
+
+# The OAuth access token is refreshed in the background this long before it
+# expires, so thermostat requests never wait on a token refresh.
+TOKEN_REFRESH_MARGIN_S = 5 * 60
+# Used when the token has no expiry time. Google tokens last an hour.
+TOKEN_LIFETIME_S = 60 * 60
+TOKEN_RETRY_S = 60
+
+
+class TokenRefresher:
+    """Refreshes OAuth credentials on a background thread before they expire.
+
+    The credentials object is shared with the SDM client's authorized http.
+    oauth2client serializes refreshes through the credential store's lock, and
+    the client still refreshes on a 401 if this thread ever falls behind."""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.refreshed_at = None
+        self.refresh_latency_s = None
+        self.refresh_failures = 0
+
+    def refresh(self):
+        # Only ever called from one thread at a time: once before start(), then
+        # by run().
+        start = time.monotonic()
+        self.credentials.refresh(httplib2.Http(timeout=30))
+        self.refreshed_at = time.monotonic()
+        self.refresh_latency_s = self.refreshed_at - start
+
+    def token_age_s(self):
+        # Seconds since the last refresh by this thread, or None.
+        if self.refreshed_at is None:
+            return None
+        return time.monotonic() - self.refreshed_at
+
+    def seconds_until_refresh(self):
+        expiry = self.credentials.token_expiry
+        if expiry is not None:
+            # oauth2client stores naive UTC datetimes.
+            remaining_s = (expiry - datetime.datetime.utcnow()).total_seconds()
+        elif self.refreshed_at is not None:
+            remaining_s = TOKEN_LIFETIME_S - self.token_age_s()
+        else:
+            remaining_s = 0
+        return remaining_s - TOKEN_REFRESH_MARGIN_S
+
+    def run(self):
+        while True:
+            time.sleep(max(self.seconds_until_refresh(), 0))
+            try:
+                self.refresh()
+            except:
+                self.refresh_failures += 1
+                LOG.exception("OAuth token refresh exception:")
+                time.sleep(TOKEN_RETRY_S)
+
+    def start(self):
+        threading.Thread(target=self.run, name="OAuth refresh", daemon=True).start()
+
+
 service = None
+token_refresher = None
 
 
 def nest_client():
-    global service
+    global service, token_refresher
     if service is None:
         credentials = authorize_credentials()
         http = credentials.authorize(httplib2.Http())
-        service = build(
-            serviceName="smartdevicemanagement.googleapis.com",
-            version="v1",
-            http=http,
-            discoveryServiceUrl="https://{api}/$discovery/rest?version={apiVersion}",
-        )
+        token_refresher = TokenRefresher(credentials)
+        if credentials.access_token_expired:
+            # Refresh now, rather than inside the first thermostat request.
+            token_refresher.refresh()
+        token_refresher.start()
+        service = build_from_document(get_discovery_document(), http=http)
     return service
 
 
+def start_nest_client():
+    # Builds the client (and refreshes the OAuth token) in the background, so
+    # it overlaps with WeMo discovery at startup.
+    def build_client():
+        try:
+            nest_client()
+        except:
+            LOG.exception("Unable to create the Nest client:")
+
+    thread = threading.Thread(target=build_client, name="Nest client", daemon=True)
+    thread.start()
+    return thread
+
+
 def get_nest_devices():
-    devices = (
-        nest_client()
-        .enterprises()
-        .devices()
-        .list(parent="enterprises/" + GOOGLE_ENTERPRISE)
-        .execute()
-    )
+    global last_nest_read_at
+    poll_scheduler.spend()
+    try:
+        devices = (
+            nest_client()
+            .enterprises()
+            .devices()
+            .list(parent="enterprises/" + settings.google_enterprise)
+            .execute()
+        )
+    except:
+        nest_requests_total.inc(result="error")
+        raise
+    nest_requests_total.inc(result="ok")
+    last_nest_read_at = time.monotonic()
     return devices["devices"]
 
 
@@ -90,137 +405,213 @@ def get_thermostats():
     return [x for x in devices if x["type"] == "sdm.devices.types.THERMOSTAT"]
 
 
-def get_nest_device(name):
-    return nest_client().enterprises().devices().get(name=name).execute()
+def thermostat_matches(thermostat, selector):
+    # A zone names its thermostat by its custom name, its room, or its device
+    # name or ID. An empty selector matches any thermostat.
+    if not selector:
+        return True
+    names = {
+        thermostat["name"],
+        thermostat["name"].split("/")[-1],
+        thermostat["traits"].get("sdm.devices.traits.Info", {}).get("customName"),
+    }
+    names.update(
+        relation.get("displayName")
+        for relation in thermostat.get("parentRelations", [])
+    )
+    return selector in names
+
 
+# This tells how long to remember a wemo device that isn't showing
+# up in discovery any more, in case it intermittently fails to appear.
+WEMO_MAX_AGE_S = 6 * 60 * 60
+wemo_registry = pywemo.DeviceRegistry(max_age=WEMO_MAX_AGE_S)
+# Discovery runs in the background, once per polling period for the first
+# few attempts. After that it refreshes much less frequently and relies
+# on the registry.
+WEMO_FAST_DISCOVERY_COUNT = 10
+WEMO_REFRESH_PERIOD_S = 40 * 60
+# How long the first control iteration waits for the first discovery.
+WEMO_DISCOVERY_STARTUP_TIMEOUT_S = 60
+wemo_discovery_done = threading.Event()
+# Monotonic time of the last discovery that completed.
+wemo_discovered_at = None
 
-thermostat_name = None
 
+def refresh_wemo_devices():
+    global wemo_discovered_at
+    try:
+        for device in wemo_registry.discover():
+            LOG.info("New wemo discovered: %s", device.name)
+    except:
+        LOG.exception("Wemo discovery exception:")
+        return
+    wemo_discovered_at = time.monotonic()
+    wemo_discovery_done.set()
 
-def get_first_thermostat():
-    global thermostat_name
-    if thermostat_name is not None:
-        try:
-            return get_nest_device(thermostat_name)
-        except Exception as e:
-            # Thermostat has changed?
-            print("Unable to read thermostat {}: {}".format(thermostat_name, e))
-            thermostat_name = None
-    # First time, or the old thermostat is offline
-    if thermostat_name is None:
-        thermostat_name = get_thermostats()[0]["name"]
-        print("New thermostat discovered: {}".format(thermostat_name))
-    return get_nest_device(thermostat_name)
-
-
-# This tells how far back to remember a wemo device that isn't showing
-# up in discovery any more.
-WEMO_DISCOVERY_HISTORY_LEN = 10
-wemo_discovery_history = deque(maxlen=WEMO_DISCOVERY_HISTORY_LEN)
-# Once the discovery history is full, it refreshes much less frequently
-# (controlled by the refresh probability) and relies on the cached results.
-WEMO_REFRESH_PROB = 0.05
+
+def wemo_discovery_loop():
+    discovery_count = 0
+    while True:
+        refresh_wemo_devices()
+        discovery_count += 1
+        if discovery_count < WEMO_FAST_DISCOVERY_COUNT:
+            time.sleep(settings.polling_period_s)
+        else:
+            time.sleep(WEMO_REFRESH_PERIOD_S)
+
+
+def start_wemo_discovery():
+    threading.Thread(
+        target=wemo_discovery_loop, name="Wemo discovery", daemon=True
+    ).start()
+    if not wemo_discovery_done.wait(WEMO_DISCOVERY_STARTUP_TIMEOUT_S):
+        LOG.warning("Wemo discovery is taking a while, continuing without it.")
 
 
 def get_wemo_devices():
-    # Merges the last few discovery attempts, in case some wemos
-    # intermittently fail to appear.
-    if (
-        len(wemo_discovery_history) < WEMO_DISCOVERY_HISTORY_LEN
-        or random() < WEMO_REFRESH_PROB
-    ):
-        try:
-            wemo_discovery_history.appendleft(pywemo.discover_devices())
-        except:
-            print("Wemo discovery exception:")
-            traceback.print_exc()
-    # Merge and filter out duplicates by MAC address
-    devices = set()
-    macs = set()
-    for discovery in wemo_discovery_history:
-        for device in discovery:
-            if device.mac not in macs:
-                macs.add(device.mac)
-                devices.add(device)
-    return devices
+    # Returns a snapshot of the registry. Never touches the network.
+    return set(wemo_registry.devices())
+
+
+def command_kind(key):
+    # Bond fans are keyed by their ID, wemos by the device.
+    return "bond" if isinstance(key, str) else "wemo"
+
+
+def time_commands(futures):
+    # Records the latency and errors of a dict of future -> key as each
+    # command finishes. Returns the dict.
+    start = time.monotonic()
+
+    def finished(future):
+        if future.cancelled():
+            return
+        kind = command_kind(futures[future])
+        command_seconds.observe(time.monotonic() - start, kind=kind)
+        if future.exception() is not None:
+            command_errors_total.inc(kind=kind, reason="error")
+
+    for future in list(futures):
+        future.add_done_callback(finished)
+    return futures
+
+
+def submit_commands(commands):
+    # Starts a dict of key -> callable on the command threads. Returns a dict
+    # of future -> key for wait_for_commands.
+    return time_commands(
+        {command_executor.submit(command): key for key, command in commands.items()}
+    )
+
+
+def wait_for_commands(futures, deadline, on_late=None):
+    # Waits until the commands finish or the deadline (a time.monotonic()
+    # value) passes. Returns the keys of the commands that succeeded.
+    # Commands still queued at the deadline are cancelled, so a stale command
+    # can't land after a newer one. Commands already running can't be stopped;
+    # if one of those succeeds later, on_late(key) is called from its thread.
+    done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+    succeeded = set()
+    for future in done:
+        key = futures[future]
+        error = future.exception()
+        if error is None:
+            succeeded.add(key)
+        else:
+            LOG.error("Unable to toggle %s", getattr(key, "name", key), exc_info=error)
+    for future in not_done:
+        key = futures[future]
+        command_errors_total.inc(kind=command_kind(key), reason="timeout")
+        if future.cancel():
+            LOG.warning("Timed out toggling %s, cancelled", getattr(key, "name", key))
+            continue
+        LOG.warning("Timed out toggling %s", getattr(key, "name", key))
+        if on_late is not None:
+
+            def finished_late(future, key=key):
+                if future.exception() is None:
+                    on_late(key)
+
+            future.add_done_callback(finished_late)
+    return succeeded
+
+
+def run_commands(commands):
+    deadline = time.monotonic() + settings.transition_deadline_s
+    return wait_for_commands(submit_commands(commands), deadline)
 
 
 device_error_count = Counter()
-MAX_RETRIES = config.getint("wemo", "MaxPowerOffRetries")
 
 
-def reset_wemo_devices(device_set, skipping=None):
-    """Turns as set of wemos off, and removes them from the set if successful.
+def reset_wemo_devices(*device_sets, skipping=None):
+    """Turns sets of wemos off, and removes them from their set if successful.
     Devices specified by 'skipping' are not turned off, although they are
-    still removed from the set."""
+    still removed from the sets."""
 
-    if skipping:
-        device_set.difference_update(skipping)
+    for device_set in device_sets:
+        if skipping:
+            device_set.difference_update(skipping)
+    devices = set().union(*device_sets)
+    for device in devices:
+        LOG.info("Turning %s off.", device.name)
+    succeeded = run_commands({device: device.off for device in devices})
     toggled_successfully = set()
-    for device in device_set:
-        try:
-            print("Turning {} off.".format(device.name))
-            device.off()
+    for device in devices:
+        if device in succeeded:
+            toggled_successfully.add(device)
+            record_history("wemo/" + device.name, 0, event=True)
+            continue
+        device_error_count[device.mac] += 1
+        if device_error_count[device.mac] > settings.max_retries:
+            LOG.warning(
+                "Giving up on %s after %d retries.", device.name, settings.max_retries
+            )
             toggled_successfully.add(device)
-        except:
-            print("Unable to toggle {}".format(device.name))
-            traceback.print_exc()
-            device_error_count[device.mac] += 1
-            if device_error_count[device.mac] > MAX_RETRIES:
-                print(
-                    "Giving up on {} after {} retries.".format(device.name, MAX_RETRIES)
-                )
-                toggled_successfully.add(device)
     for device in toggled_successfully:
-        device_set.discard(device)
-        del device_error_count[device.mac]
+        for device_set in device_sets:
+            device_set.discard(device)
+        device_error_count.pop(device.mac, None)
 
 
-activated_heating_devices = set()
-activated_cooling_devices = set()
-activated_humidifier_devices = set()
+bond_client = BondClient(BOND_IP, BOND_TOKEN, timeout=settings.transition_deadline_s)
+# Keeps the fan state cache live from the hub's UDP pushes, so changes made with
+# a remote or the Bond app are seen without polling the hub.
+bond_listener = None
 
 
-def power_off_unneeded_wemos(hvac_status):
-    # Turns off wemos that aren't needed in the current state.
-    # Should not mess with devices that were manually toggled, since it acts only
-    # on devices that this script turned on.
-    if hvac_status == "COOLING":
-        reset_wemo_devices(
-            activated_heating_devices, skipping=activated_humidifier_devices
-        )
-    elif hvac_status == "HEATING":
-        reset_wemo_devices(
-            activated_cooling_devices, skipping=activated_humidifier_devices
-        )
-    else:
-        reset_wemo_devices(
-            activated_heating_devices, skipping=activated_humidifier_devices
-        )
-        reset_wemo_devices(
-            activated_cooling_devices, skipping=activated_humidifier_devices
-        )
+def start_bond_listener(fan_ids):
+    # Listens for pushes about fan_ids. If already listening, just switches to
+    # the new fans, as when config.ini is reloaded.
+    global bond_listener
+    if bond_listener is not None:
+        bond_listener.device_ids = set(fan_ids)
+        return
+    if not fan_ids:
+        return
+    bond_listener = BondPushListener(bond_client, fan_ids)
+    try:
+        bond_listener.start()
+    except OSError:
+        LOG.exception("Unable to listen for Bond state pushes:")
 
 
-def power_on_needed_wemo(device, hvac_status):
-    # powers on a wemo and adds it to an active set so we can remember
-    # to turn if off later when HVAC status changes.
-    print("Turning {} on for {}.".format(device.name, hvac_status))
-    try:
-        device.on()
-        if hvac_status == "COOLING":
-            activated_cooling_devices.add(device)
-            activated_heating_devices.discard(device)
-        elif hvac_status == "HEATING":
-            activated_heating_devices.add(device)
-            activated_cooling_devices.discard(device)
-        elif hvac_status == "HUMIDIFYING":
-            activated_humidifier_devices.add(device)
-        else:
-            print("Unexpected hvac status to enable a wemo: {}".format(hvac_status))
-    except:
-        print("Wemo powering exception:")
-        traceback.print_exc()
+def submit_bond_fans(fan_ids, hvac_status):
+    # Sets fans concurrently. Fans already in the wanted state are skipped, and
+    # fans turned off or changed by hand aren't turned off again.
+    # Returns a dict of future -> fan ID for wait_for_commands.
+    if hvac_status == "COOLING":
+        action, argument, expected = "SetSpeed", 1, {"power": 1, "speed": 1}
+        fans = fan_ids
+    else:
+        action, argument, expected = "TurnOff", None, {"power": 0}
+        fans = {fan for fan in fan_ids if not bond_client.overridden(fan)}
+    for fan in fan_ids - fans:
+        LOG.info("Fan %s was changed by hand, leaving it alone.", fan)
+    if fans:
+        LOG.info("Sending %s to fans %s.", action, ", ".join(sorted(fans)))
+    return time_commands(bond_client.submit(fans, action, argument, expected))
 
 
 def aux_heat_is_needed(thermostat):
@@ -228,160 +619,1120 @@ def aux_heat_is_needed(thermostat):
     temperature_c = thermostat["traits"]["sdm.devices.traits.Temperature"][
         "ambientTemperatureCelsius"
     ]
-    # The temperature that the heater is "set" to.
-    heat_temperature_c = thermostat["traits"][
-        "sdm.devices.traits.ThermostatTemperatureSetpoint"
-    ]["heatCelsius"]
+    # The temperature that the heater is "set" to. Missing in cool-only mode.
+    heat_temperature_c = (
+        thermostat["traits"]
+        .get("sdm.devices.traits.ThermostatTemperatureSetpoint", {})
+        .get("heatCelsius")
+    )
     hvac_status = thermostat["traits"]["sdm.devices.traits.ThermostatHvac"]["status"]
     return (
         hvac_status == "HEATING"
-        and heat_temperature_c - temperature_c > AUX_HEAT_THRESHOLD_C
+        and heat_temperature_c is not None
+        and heat_temperature_c - temperature_c > settings.aux_heat_threshold_c
     )
 
 
-def forget_user_controlled_wemos(all_wemos):
-    # If code turned a switch on but the user manually turned it off,
-    # then forget about turning it off by code later. The user has taken
-    # responsibility.
-    global activated_heating_devices
-    global activated_cooling_devices
-    global activated_humidifier_devices
-    activated_wemos = (
-        activated_heating_devices
-        | activated_cooling_devices
-        | activated_humidifier_devices
-    )
-    user_toggled = set()
+# Managed wemos are subscribed to UPnP events, so a user switching one off is
+# seen as soon as it happens rather than by polling every device each loop.
+WEMO_SUBSCRIPTION_STATE = "wemo_subscriptions.json"
+wemo_subscriptions = None
+wemo_subscribed = {}
+wemo_subscribed_generation = None
+# Monotonic times of the last "on" command from this script and the last "off"
+# event from each device, by MAC. An off event newer than our on command means
+# the user took over.
+wemo_on_times = {}
+wemo_off_times = {}
 
-    for device in activated_wemos:
-        if device.is_off():
-            user_toggled.add(device)
 
-    # As a second pass, also check for user-toggled devices by mac address.
-    # This might be important if a wemo device's name is changed.
-    activated_mac_to_wemo = {x.mac: x for x in activated_wemos}
-    for device in all_wemos:
-        if device.mac in activated_mac_to_wemo and device.is_off():
-            user_toggled.add(activated_mac_to_wemo[device.mac])
+def start_wemo_subscriptions():
+    global wemo_subscriptions
+    registry = pywemo.SubscriptionRegistry(state_file=WEMO_SUBSCRIPTION_STATE)
+    try:
+        registry.start()
+    except pywemo.subscribe.SubscriptionRegistryFailed:
+        LOG.exception("Wemo event subscriptions unavailable, polling for overrides:")
+        return
+    wemo_subscriptions = registry
+
+
+def on_wemo_state(device, type_, value):
+    # Runs on the subscription thread.
+    try:
+        state = int(device.parse_basic_state(value).get("state"))
+    except (TypeError, ValueError):
+        return
+    if state == 0:
+        wemo_off_times[device.mac] = time.monotonic()
 
-    activated_heating_devices -= user_toggled
-    activated_cooling_devices -= user_toggled
-    activated_humidifier_devices -= user_toggled
 
+def wemos_by_name():
+    # Maps the names and MACs of discovered wemos to the devices.
+    by_name = {}
+    for device in wemo_registry.devices():
+        by_name[device.name] = by_name[device.mac] = device
+    return by_name
 
-def print_temp(thermostat):
+
+def subscribe_wemo_devices(devices):
+    # (Re)registers managed devices whenever the registry changes. Devices that
+    # moved to a new address are registered again so events keep flowing.
+    global wemo_subscribed_generation
+    if wemo_subscriptions is None:
+        return
+    if wemo_registry.generation == wemo_subscribed_generation:
+        return
+    for device in devices:
+        address = (device.host, device.port)
+        if wemo_subscribed.get(device.mac) == address:
+            continue
+        if device.mac not in wemo_subscribed:
+            wemo_subscriptions.on(device, "BinaryState", on_wemo_state)
+        wemo_subscriptions.register(device)
+        wemo_subscribed[device.mac] = address
+    wemo_subscribed_generation = wemo_registry.generation
+
+
+def user_turned_off(device):
+    if wemo_subscriptions is None or not wemo_subscriptions.is_subscribed(device):
+        return device.is_off()
+    off_time = wemo_off_times.get(device.mac)
+    return off_time is not None and off_time > wemo_on_times.get(device.mac, 0)
+
+
+def print_temp(thermostat, label):
     # Actual room temperature.
     temperature_c = thermostat["traits"]["sdm.devices.traits.Temperature"][
         "ambientTemperatureCelsius"
     ]
-    if FAHRENHEIT:
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    if settings.fahrenheit:
         temperature_f = (temperature_c * 9 / 5.0) + 32
-        print(
-            "{} temperature: {:.1f} degrees F".format(
-                start.strftime("%Y-%m-%d %H:%M"), temperature_f
+        LOG.info("%s%s temperature: %.1f degrees F", label, now, temperature_f)
+    else:
+        LOG.info("%s%s temperature: %.1f degrees C", label, now, temperature_c)
+
+
+class Zone:
+    """One thermostat and the devices it controls.
+
+    Each zone keeps its own record of which devices it turned on, so zones
+    switch their devices independently of each other. A device should only be
+    listed in one zone."""
+
+    def __init__(self, name, thermostat, role_names, fan_ids, rules=()):
+        self.name = name
+        # Custom name, room name, or device name of the thermostat. Empty means
+        # the first thermostat found.
+        self.thermostat = thermostat
+        self.thermostat_name = None
+        self.role_names = role_names
+        self.fan_ids = set(fan_ids)
+        # Once a name matches a device, its MAC is remembered for that role, so
+        # renaming a plug in the WeMo app doesn't drop it from the role.
+        self.role_macs = defaultdict(set)
+        self.roles = {role: [] for role in role_names}
+        self.roles_generation = None
+        self.activated = {"HEATING": set(), "COOLING": set(), "HUMIDIFYING": set()}
+        # Devices are saved by MAC. Restored MACs wait here until discovery
+        # finds them.
+        self.restored_macs = {role: set() for role in self.activated}
+        # Normally we don't take control of already-running devices since we
+        # don't want to override user intent. But on first launch without saved
+        # state, we do. This prevents devices from getting orphaned on if the
+        # script is restarted.
+        self.first_iteration = True
+        self.prev_hvac_status = None
+        self.aux_heat_engaged = False
+        self.humidifiers_engaged = False
+        # (device, hvac status, time) of wemos whose command finished after
+        # the deadline. Filled from the command threads.
+        self.late_activations = deque()
+        self.rule_engine = RuleEngine(
+            rule for rule in rules if rule.zone in (None, self.name)
+        )
+
+    def take_over(self, previous):
+        # Carries the control state of this zone over from the Zone it replaces
+        # when config.ini is reloaded, so devices it turned on are still turned
+        # off later. Returns the active rules that no longer exist.
+        for role, devices in previous.activated.items():
+            self.activated[role] |= devices
+            self.restored_macs[role] |= previous.restored_macs[role]
+        self.first_iteration = previous.first_iteration
+        self.prev_hvac_status = previous.prev_hvac_status
+        self.aux_heat_engaged = previous.aux_heat_engaged
+        self.humidifiers_engaged = previous.humidifiers_engaged
+        self.late_activations = previous.late_activations
+        if self.thermostat == previous.thermostat:
+            self.thermostat_name = previous.thermostat_name
+        # MACs learned for a role are kept only if its names didn't change, so
+        # a device taken out of a role leaves it.
+        for role, names in self.role_names.items():
+            if names == previous.role_names.get(role):
+                self.role_macs[role] = set(previous.role_macs[role])
+        return self.rule_engine.take_over(previous.rule_engine)
+
+    def label(self):
+        # Prefix for console output. Blank with a single zone.
+        return "[{}] ".format(self.name) if len(zones) > 1 else ""
+
+    def find_thermostat(self, thermostats):
+        # Picks this zone's thermostat out of a devices().list() result.
+        if self.thermostat_name is not None:
+            for thermostat in thermostats:
+                if thermostat["name"] == self.thermostat_name:
+                    return thermostat
+            LOG.warning(
+                "%sThermostat %s is missing.", self.label(), self.thermostat_name
             )
+            self.thermostat_name = None
+        for thermostat in thermostats:
+            if thermostat_matches(thermostat, self.thermostat):
+                self.thermostat_name = thermostat["name"]
+                LOG.info(
+                    "%sNew thermostat discovered: %s",
+                    self.label(),
+                    self.thermostat_name,
+                )
+                return thermostat
+        LOG.warning("%sNo thermostat matches %r.", self.label(), self.thermostat)
+        return None
+
+    def get_roles(self):
+        # Returns a dict of role -> list of devices. Only rebuilt when the
+        # registry has changed since the last call.
+        generation = wemo_registry.generation
+        if generation != self.roles_generation:
+            devices = wemo_registry.devices()
+            by_mac = {device.mac: device for device in devices}
+            roles = {}
+            for role, names in self.role_names.items():
+                for device in devices:
+                    if device.name in names or device.mac in names:
+                        self.role_macs[role].add(device.mac)
+                roles[role] = [
+                    by_mac[mac] for mac in self.role_macs[role] if mac in by_mac
+                ]
+            self.roles = roles
+            self.roles_generation = generation
+        return self.roles
+
+    def resolve_restored_devices(self):
+        # Moves restored MACs into the activated sets once their devices are known.
+        for role, devices in self.activated.items():
+            for mac in list(self.restored_macs[role]):
+                device = wemo_registry.get(mac)
+                if device is not None:
+                    devices.add(device)
+                    self.restored_macs[role].discard(mac)
+
+    def power_off_unneeded_wemos(self, hvac_status):
+        # Turns off wemos that aren't needed in the current state.
+        # Should not mess with devices that were manually toggled, since it acts
+        # only on devices that this script turned on.
+        heating = self.activated["HEATING"]
+        cooling = self.activated["COOLING"]
+        humidifying = self.activated["HUMIDIFYING"]
+        if hvac_status == "COOLING":
+            reset_wemo_devices(heating, skipping=humidifying)
+        elif hvac_status == "HEATING":
+            reset_wemo_devices(cooling, skipping=humidifying)
+        else:
+            reset_wemo_devices(heating, cooling, skipping=humidifying)
+
+    def power_on_needed_wemos(self, devices, hvac_status, deadline=None):
+        # powers on wemos and adds them to an active set so we can remember
+        # to turn them off later when HVAC status changes.
+        if deadline is None:
+            deadline = time.monotonic() + settings.transition_deadline_s
+        for device in devices:
+            LOG.info("%sTurning %s on for %s.", self.label(), device.name, hvac_status)
+        succeeded = wait_for_commands(
+            submit_commands({device: device.on for device in devices}),
+            deadline,
+            on_late=lambda device: self.late_activations.append(
+                (device, hvac_status, time.monotonic())
+            ),
         )
-    else:
-        print(
-            "{} temperature: {:.1f} degrees C".format(
-                start.strftime("%Y-%m-%d %H:%M"), temperature_c
+        for device in devices:
+            if device not in succeeded:
+                device_error_count[device.mac] += 1
+                continue
+            self.activate(device, hvac_status, time.monotonic())
+
+    def activate(self, device, hvac_status, on_time):
+        # Records that a wemo was turned on for hvac_status.
+        device_error_count.pop(device.mac, None)
+        wemo_on_times[device.mac] = on_time
+        record_history("wemo/" + device.name, 1, event=True)
+        if hvac_status == "COOLING":
+            self.activated["COOLING"].add(device)
+            self.activated["HEATING"].discard(device)
+        elif hvac_status == "HEATING":
+            self.activated["HEATING"].add(device)
+            self.activated["COOLING"].discard(device)
+        elif hvac_status == "HUMIDIFYING":
+            self.activated["HUMIDIFYING"].add(device)
+        else:
+            LOG.error("Unexpected hvac status to enable a wemo: %s", hvac_status)
+
+    def activate_late_wemos(self):
+        # Wemos that turned on after their deadline are recorded as activated
+        # now, so they're turned off again if they're no longer needed.
+        while self.late_activations:
+            device, hvac_status, on_time = self.late_activations.popleft()
+            LOG.info("%s%s turned on late.", self.label(), device.name)
+            self.activate(device, hvac_status, on_time)
+
+    def forget_user_controlled_wemos(self):
+        # If code turned a switch on but the user manually turned it off,
+        # then forget about turning it off by code later. The user has taken
+        # responsibility.
+        activated_wemos = set().union(*self.activated.values())
+        user_toggled = {device for device in activated_wemos if user_turned_off(device)}
+        for device in user_toggled:
+            LOG.info(
+                "%s%s was turned off by hand, leaving it alone.",
+                self.label(),
+                device.name,
             )
+        for devices in self.activated.values():
+            devices -= user_toggled
+
+    def record_thermostat(self, thermostat):
+        traits = thermostat["traits"]
+        prefix = self.name + "/"
+        record_history(
+            prefix + "temperature_c",
+            traits["sdm.devices.traits.Temperature"]["ambientTemperatureCelsius"],
         )
+        record_history(
+            prefix + "humidity",
+            traits["sdm.devices.traits.Humidity"]["ambientHumidityPercent"],
+        )
+        setpoints = traits.get("sdm.devices.traits.ThermostatTemperatureSetpoint", {})
+        for key, series in (
+            ("heatCelsius", "heat_setpoint_c"),
+            ("coolCelsius", "cool_setpoint_c"),
+        ):
+            if key in setpoints:
+                record_history(prefix + series, setpoints[key])
+        # Recorded last, so a replay knows the rest of the sample is complete.
+        status = traits["sdm.devices.traits.ThermostatHvac"]["status"]
+        record_history(prefix + "hvac_status", HVAC_STATUS_CODES.get(status, -1))
 
+    def step(self, thermostat, timer=None):
+        # Detect when the HVAC status changes to heating, cooling, or neither.
+        # Toggle Wemo switches accordingly. Returns True if the HVAC status
+        # changed. Each phase is timed with `timer`, if given.
+        # Remember that some switches may be for both heating and cooling.
+        timer = timer or PhaseTimer()
+        try:
+            roles = self.get_roles()
+            print_temp(thermostat, self.label())
+            hvac_status = thermostat["traits"]["sdm.devices.traits.ThermostatHvac"][
+                "status"
+            ]
+            hvac_changed = hvac_status != self.prev_hvac_status
+            self.record_thermostat(thermostat)
 
-# Normally we don't take control of already-running devices since we don't want to override user
-# intent. But on first launch, we do. This prevents devices from getting orphaned on if the script
-# is restarted.
-first_iteration = True
-prev_hvac_status = None
-aux_heat_engaged = False
-humidifiers_engaged = False
-while True:
-    # Detect when the HVAC status changes to heating, cooling, or neither.
-    # Toggle Wemo switches accordingly.
-    # Remember that some switches may be for both heating and cooling.
-    start = datetime.datetime.now()
-    try:
-        wemos = get_wemo_devices()
-        thermostat = get_first_thermostat()
-        print_temp(thermostat)
-        hvac_status = thermostat["traits"]["sdm.devices.traits.ThermostatHvac"][
-            "status"
-        ]
+            with timer.phase("overrides"):
+                self.activate_late_wemos()
+                self.forget_user_controlled_wemos()
+
+            with timer.phase("transitions"):
+                if hvac_changed:
+                    # hvac status has changed. flick some switches.
+                    self.aux_heat_engaged = False
+                    deadline = time.monotonic() + settings.transition_deadline_s
+                    fan_commands = submit_bond_fans(self.fan_ids, hvac_status)
+                    if hvac_status in ("COOLING", "HEATING"):
+                        self.power_on_needed_wemos(
+                            roles[hvac_status], hvac_status, deadline
+                        )
+                    fans_set = wait_for_commands(fan_commands, deadline)
+                    for fan in fan_commands.values():
+                        if fan in fans_set:
+                            device_error_count.pop(fan, None)
+                            record_history(
+                                "bond/" + fan, int(hvac_status == "COOLING"), event=True
+                            )
+                        else:
+                            device_error_count[fan] += 1
 
-        forget_user_controlled_wemos(wemos)
-
-        if hvac_status != prev_hvac_status:
-            # hvac status has changed. flick some switches.
-            aux_heat_engaged = False
-            for wemo in wemos:
-                if hvac_status == "COOLING" and wemo.name in WEMO_COOLING_DEVICE_NAMES:
-                    power_on_needed_wemo(wemo, hvac_status)
-                elif (
-                    hvac_status == "HEATING" and wemo.name in WEMO_HEATING_DEVICE_NAMES
-                ):
-                    power_on_needed_wemo(wemo, hvac_status)
-            for fan in BOND_FAN_IDS:
-                address_template = "http://{}/v2/devices/{}/actions/{}"
-                if hvac_status == "COOLING":
-                    response = requests.put(
-                        address_template.format(BOND_IP, fan, "SetSpeed"),
-                        data='{"argument": 1}',
-                        headers={"BOND-Token": BOND_TOKEN},
+            with timer.phase("humidity"):
+                # Humidifiers can kick on or off independent of the hvac
+                humidity = thermostat["traits"]["sdm.devices.traits.Humidity"][
+                    "ambientHumidityPercent"
+                ]
+                # One snapshot, so a reload can't pair an old target with a new
+                # threshold.
+                current = settings
+                target = current.humidity_percent_target
+                threshold = current.humidity_percent_threshold
+                if not self.humidifiers_engaged and humidity < target - threshold:
+                    self.humidifiers_engaged = True
+                    # dummy hvac status, but our method understands it anyway.
+                    self.power_on_needed_wemos(
+                        [
+                            wemo
+                            for wemo in roles["HUMIDIFYING"]
+                            if wemo.is_off() or self.first_iteration
+                        ],
+                        "HUMIDIFYING",
                     )
-                    print(
-                        "Turned on fan {}. Response: {}".format(fan, response.content)
+                elif humidity > target + threshold:
+                    self.humidifiers_engaged = False
+                    reset_wemo_devices(
+                        self.activated["HUMIDIFYING"],
+                        skipping=self.activated["COOLING"] | self.activated["HEATING"],
                     )
-                else:
-                    response = requests.put(
-                        address_template.format(BOND_IP, fan, "TurnOff"),
-                        data="{}",
-                        headers={"BOND-Token": BOND_TOKEN},
+
+            with timer.phase("aux_heat"):
+                # Auxiliary heat can kick on in the middle of a cycle, but only once
+                # per cycle.
+                if aux_heat_is_needed(thermostat) and not self.aux_heat_engaged:
+                    self.aux_heat_engaged = True
+                    # aux heat includes stuff like little space heaters. If you turned
+                    # one on manually, I want to leave it out of automatic control so
+                    # you can have your room as toasty as you like. Hence the
+                    # "is_off()" check before starting automatic control here.
+                    self.power_on_needed_wemos(
+                        [
+                            wemo
+                            for wemo in roles["AUX_HEATING"]
+                            if wemo.is_off() or self.first_iteration
+                        ],
+                        hvac_status,
                     )
-                    print(
-                        "Turned off fan {}. Response: {}".format(fan, response.content)
+            with timer.phase("power_off"):
+                self.power_off_unneeded_wemos(hvac_status)
+            with timer.phase("rules"):
+                self.apply_rules(thermostat)
+            self.prev_hvac_status = hvac_status
+            return hvac_changed
+        finally:
+            self.first_iteration = False
+
+    def apply_rules(self, thermostat):
+        # Runs the config-declared rules. Only rules whose inputs changed are
+        # re-evaluated, so this is cheap when nothing is happening.
+        if not self.rule_engine.rules:
+            return
+        by_name = wemos_by_name()
+        inputs = thermostat_inputs(thermostat, settings.fahrenheit)
+        for name in self.rule_engine.device_inputs:
+            device = by_name.get(name[len("wemo[") : -1])
+            if device is not None:
+                # Kept current by its subscription, so this doesn't block.
+                try:
+                    inputs[name] = device.get_state()
+                except Exception:
+                    LOG.warning(
+                        "%sUnable to read %s for rules.",
+                        self.label(),
+                        device.name,
+                        exc_info=True,
                     )
+        for rule, active in self.rule_engine.evaluate(inputs, clock()):
+            if not self.switch_rule(rule, active, by_name):
+                self.rule_engine.retry(rule)
+
+    def switch_rule(self, rule, active, by_name):
+        # Switches a rule's devices on or off. by_name maps WeMo names and MACs
+        # to devices. Returns False if some device failed and the switch should
+        # be retried.
+        LOG.info(
+            "%sRule %s %s.",
+            self.label(),
+            rule.name,
+            "engaged" if active else "released",
+        )
+        record_history("rule/" + rule.name, int(active), event=True)
+        deadline = time.monotonic() + settings.transition_deadline_s
+        action, argument = rule.fan_action if active else rule.release_action
+        futures = time_commands(
+            bond_client.submit(
+                rule.fan_ids, action, argument, expected_state(action, argument)
+            )
+        )
+        devices = [by_name[name] for name in rule.wemo if name in by_name]
+        futures.update(
+            submit_commands(
+                {device: device.on if active else device.off for device in devices}
+            )
+        )
+        succeeded = wait_for_commands(futures, deadline)
+        failed = []
+        for key in futures.values():
+            # Fans are keyed by ID, wemos by MAC.
+            error_key = key if command_kind(key) == "bond" else key.mac
+            if key in succeeded:
+                device_error_count.pop(error_key, None)
+            else:
+                device_error_count[error_key] += 1
+                failed.append(error_key)
+        if not failed:
+            return True
+        if any(device_error_count[key] > settings.max_retries for key in failed):
+            LOG.warning(
+                "%sGiving up on rule %s after %d retries.",
+                self.label(),
+                rule.name,
+                settings.max_retries,
+            )
+            for key in failed:
+                device_error_count.pop(key, None)
+            return True
+        return False
+
+    def rule_wemo_names(self):
+        # Names and MACs of the wemos this zone's rules read or switch.
+        names = {name[len("wemo[") : -1] for name in self.rule_engine.device_inputs}
+        for rule in self.rule_engine.rules:
+            names.update(rule.wemo)
+        return names
+
+    def release_rules(self, rules):
+        by_name = wemos_by_name()
+        for rule in rules:
+            self.switch_rule(rule, False, by_name)
+
+    def state(self):
+        return {
+            "activated": {
+                role: sorted(
+                    {device.mac for device in devices} | self.restored_macs[role]
+                )
+                for role, devices in self.activated.items()
+            },
+            "prev_hvac_status": self.prev_hvac_status,
+            "aux_heat_engaged": self.aux_heat_engaged,
+            "humidifiers_engaged": self.humidifiers_engaged,
+            "role_macs": {role: sorted(macs) for role, macs in self.role_macs.items()},
+            "role_names": {
+                role: sorted(names) for role, names in self.role_names.items()
+            },
+        }
+
+    def restore(self, state):
+        for role, macs in state.get("activated", {}).items():
+            if role in self.restored_macs:
+                self.restored_macs[role].update(macs)
+        # As in take_over, learned MACs are kept only for roles whose names are
+        # unchanged since the state was saved.
+        saved_names = state.get("role_names", {})
+        for role, macs in state.get("role_macs", {}).items():
+            if sorted(self.role_names.get(role, ())) == saved_names.get(role):
+                self.role_macs[role].update(macs)
+        self.first_iteration = False
+        self.prev_hvac_status = state.get("prev_hvac_status")
+        self.aux_heat_engaged = state.get("aux_heat_engaged", False)
+        self.humidifiers_engaged = state.get("humidifiers_engaged", False)
 
-        # Humidifiers can kick on or off independent of the hvac
-        humidity = thermostat["traits"]["sdm.devices.traits.Humidity"][
-            "ambientHumidityPercent"
+
+def read_zones(config, settings):
+    # Each [zone <name>] section maps one thermostat to its own devices. Without
+    # any, the [wemo] and [bond] lists make up a single zone for the first
+    # thermostat.
+    zones = []
+    for section in config.sections():
+        if not section.startswith("zone "):
+            continue
+        name = section[len("zone ") :].strip()
+        if name in {zone.name for zone in zones}:
+            raise ValueError("Zone {!r} is defined twice".format(name))
+        zones.append(
+            Zone(
+                name,
+                config.get(section, "Thermostat", fallback=""),
+                {
+                    "HEATING": config_names(config, section, "HeatingDeviceNames"),
+                    "COOLING": config_names(config, section, "CoolingDeviceNames"),
+                    "AUX_HEATING": config_names(
+                        config, section, "AuxiliaryHeatingDeviceNames"
+                    ),
+                    "HUMIDIFYING": config_names(config, section, "HumidifierNames"),
+                },
+                config_names(config, section, "FanIds"),
+                settings.rules,
+            )
+        )
+    if not zones:
+        zones.append(
+            Zone(
+                "default",
+                "",
+                settings.wemo_role_names,
+                settings.bond_fan_ids,
+                settings.rules,
+            )
+        )
+    return zones
+
+
+zones = read_zones(config, settings)
+zone_executor = ThreadPoolExecutor(max_workers=len(zones), thread_name_prefix="zone")
+
+
+# The thermostat is polled quickly when the HVAC is likely to change state soon.
+# These tell how close counts as "soon".
+NEAR_SETPOINT_C = 0.5
+NEAR_HUMIDITY_PERCENT = 1
+RECENT_HVAC_CHANGE_S = 10 * 60
+
+
+class PollScheduler:
+    """Picks the delay before the next thermostat poll.
+
+    Polls at the minimum period when a transition is likely, and backs off
+    towards the maximum period while nothing is happening. A request budget
+    (a token bucket refilled at requests_per_hour) caps the rate either way."""
+
+    def __init__(
+        self, min_period_s, max_period_s, requests_per_hour, clock=time.monotonic
+    ):
+        # clock is swapped for a simulated one by simulate.py.
+        self.clock = clock
+        self.min_period_s = min_period_s
+        self.max_period_s = max_period_s
+        self.period_s = min_period_s
+        self.seconds_per_request = 3600.0 / requests_per_hour
+        # Allow a short burst, e.g. a few polls in a row after a restart.
+        self.max_tokens = 5
+        self.tokens = self.max_tokens
+        self.refilled_at = self.clock()
+        self.hvac_changed_at = None
+
+    def configure(self, min_period_s, max_period_s, requests_per_hour):
+        # Applies new limits from a reloaded config.
+        self._refill()
+        self.min_period_s = min_period_s
+        self.max_period_s = max_period_s
+        self.period_s = min(max(self.period_s, min_period_s), max_period_s)
+        self.seconds_per_request = 3600.0 / requests_per_hour
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.max_tokens,
+            self.tokens + (now - self.refilled_at) / self.seconds_per_request,
+        )
+        self.refilled_at = now
+
+    def spend(self):
+        # Records one SDM API request against the budget.
+        self._refill()
+        self.tokens -= 1
+
+    def transition_likely(self, thermostat):
+        traits = thermostat["traits"]
+        temperature_c = traits["sdm.devices.traits.Temperature"][
+            "ambientTemperatureCelsius"
         ]
-        if (
-            not humidifiers_engaged
-            and humidity < HUMIDITY_PERCENT_TARGET - HUMIDITY_PERCENT_THRESHOLD
+        setpoints = traits.get("sdm.devices.traits.ThermostatTemperatureSetpoint", {})
+        for key in ("heatCelsius", "coolCelsius"):
+            if (
+                key in setpoints
+                and abs(setpoints[key] - temperature_c) <= NEAR_SETPOINT_C
+            ):
+                return True
+        # Aux heat kicks in when the gap to the heat setpoint crosses a threshold.
+        if "heatCelsius" in setpoints:
+            gap_c = setpoints["heatCelsius"] - temperature_c
+            if abs(gap_c - settings.aux_heat_threshold_c) <= NEAR_SETPOINT_C:
+                return True
+        humidity = traits["sdm.devices.traits.Humidity"]["ambientHumidityPercent"]
+        current = settings
+        for bound in (
+            current.humidity_percent_target - current.humidity_percent_threshold,
+            current.humidity_percent_target + current.humidity_percent_threshold,
         ):
-            humidifiers_engaged = True
-            for wemo in wemos:
-                if wemo.name in WEMO_HUMIDIFIER_DEVICE_NAMES and (
-                    wemo.is_off() or first_iteration
-                ):
-                    # dummy hvac status, but our method understands it anyway.
-                    power_on_needed_wemo(wemo, "HUMIDIFYING")
-        elif humidity > HUMIDITY_PERCENT_TARGET + HUMIDITY_PERCENT_THRESHOLD:
-            humidifiers_engaged = False
-            reset_wemo_devices(
-                activated_humidifier_devices,
-                skipping=activated_cooling_devices | activated_heating_devices,
-            )
+            if abs(humidity - bound) <= NEAR_HUMIDITY_PERCENT:
+                return True
+        return (
+            self.hvac_changed_at is not None
+            and self.clock() - self.hvac_changed_at < RECENT_HVAC_CHANGE_S
+        )
 
-        # Auxiliary heat can kick on in the middle of a cycle, but only once per cycle.
-        if aux_heat_is_needed(thermostat) and not aux_heat_engaged:
-            aux_heat_engaged = True
-            # aux heat includes stuff like little space heaters. If you turned one on
-            # manually, I want to leave it out of automatic control so you can have
-            # your room as toasty as you like. Hence the "is_off()" check before
-            # starting automatic control here.
-            for wemo in wemos:
-                if wemo.name in WEMO_AUXILLIARY_HEATING_DEVICE_NAMES and (
-                    wemo.is_off() or first_iteration
-                ):
-                    power_on_needed_wemo(wemo, hvac_status)
-        power_off_unneeded_wemos(hvac_status)
-        prev_hvac_status = hvac_status
+    def update(self, thermostats, hvac_changed):
+        # Call once per successful poll, with every zone's thermostat.
+        if hvac_changed:
+            self.hvac_changed_at = self.clock()
+        if any(self.transition_likely(thermostat) for thermostat in thermostats):
+            self.period_s = self.min_period_s
+        else:
+            self.period_s = min(self.period_s * 1.5, self.max_period_s)
+
+    def next_delay(self):
+        # Seconds from now until the next poll, respecting the budget.
+        self._refill()
+        budget_delay = (1 - self.tokens) * self.seconds_per_request
+        return max(self.period_s, budget_delay)
+
+
+poll_scheduler = PollScheduler(
+    settings.min_polling_period_s,
+    settings.max_polling_period_s,
+    settings.nest_requests_per_hour,
+)
+
+
+nest_events = None
+
+
+def start_nest_events():
+    # Optionally listen for thermostat changes over Pub/Sub, so the control
+    # logic can run as soon as the HVAC changes. Polling stays on as a fallback.
+    if not GOOGLE_PUBSUB_SUBSCRIPTION:
+        return None
+    events = ThermostatEvents(GOOGLE_PUBSUB_SUBSCRIPTION)
+    try:
+        events.start()
     except:
-        print("Top-level exception:")
-        traceback.print_exc()
-        first_iteration = False
-    first_iteration = False
-    iteration_s = (datetime.datetime.now() - start).total_seconds()
-    time.sleep(max(POLLING_PERIOD_S - iteration_s, 5))
\ No newline at end of file
+        LOG.exception("Unable to listen for Nest events, polling only:")
+        return None
+    LOG.info("Listening for Nest events on %s", GOOGLE_PUBSUB_SUBSCRIPTION)
+    return events
+
+
+def get_zone_thermostats(woke_for_event):
+    # Returns a dict of zone -> thermostat (None if not found), read with a
+    # single devices().list() request. After a Pub/Sub event, the event-updated
+    # copies are used instead of spending a request, if every zone has one.
+    if woke_for_event and nest_events is not None:
+        thermostats = {
+            zone: nest_events.get(zone.thermostat_name)
+            for zone in zones
+            if zone.thermostat_name is not None
+        }
+        if len(thermostats) == len(zones) and all(thermostats.values()):
+            return thermostats
+    thermostats = get_thermostats()
+    if nest_events is not None:
+        for thermostat in thermostats:
+            nest_events.seed(thermostat)
+    return {zone: zone.find_thermostat(thermostats) for zone in zones}
+
+
+def run_zones(thermostats, timer=None):
+    # Steps every zone that has a thermostat, concurrently. Returns True if any
+    # zone's HVAC status changed. The zones' phase times add up in `timer`.
+    futures = {
+        zone_executor.submit(zone.step, thermostat, timer): zone
+        for zone, thermostat in thermostats.items()
+        if thermostat is not None
+    }
+    hvac_changed = False
+    for future, zone in futures.items():
+        try:
+            hvac_changed |= future.result()
+        except:
+            LOG.exception("Exception in zone %s:", zone.name)
+    return hvac_changed
+
+
+def wait_for_next_iteration(delay_s):
+    # Sleeps until the next poll is due, waking early for a Nest event or a
+    # change to config.ini. Returns True if woken by a Nest event.
+    deadline = time.monotonic() + delay_s
+    while not config_changed():
+        remaining_s = deadline - time.monotonic()
+        if remaining_s <= 0:
+            return False
+        wait_s = min(remaining_s, CONFIG_CHECK_S)
+        if nest_events is None:
+            time.sleep(wait_s)
+        elif nest_events.changed.wait(wait_s):
+            nest_events.changed.clear()
+            return True
+    return False
+
+
+# config.ini is checked for changes every CONFIG_CHECK_S while waiting for the
+# next poll. A changed config is validated and swapped in between iterations;
+# an invalid one is logged and ignored. These options only take effect on
+# restart.
+CONFIG_CHECK_S = 5
+RESTART_OPTIONS = (
+    ("google", "ClientSecretFile"),
+    ("google", "PubsubSubscription"),
+    ("bond", "HubIp"),
+    ("bond", "Token"),
+    ("DEFAULT", "HistoryFile"),
+    ("DEFAULT", "HistoryRecords"),
+    ("DEFAULT", "MetricsPort"),
+    ("DEFAULT", "MetricsHost"),
+    ("DEFAULT", "PhaseTimingWindow"),
+    ("DEFAULT", "LogFile"),
+    ("DEFAULT", "LogMaxBytes"),
+    ("DEFAULT", "LogBackups"),
+    ("DEFAULT", "LogRepeatIntervalS"),
+)
+config_reloads_total = metrics.counter(
+    "wenestmo_config_reloads_total", "config.ini reloads by result."
+)
+
+
+def config_changed():
+    return file_stamp(CONFIG_FILE) != config_stamp
+
+
+def reload_config():
+    # Swaps in config.ini if it changed. Discovered devices, subscriptions and
+    # each zone's record of the devices it turned on carry over. Returns True
+    # if a new config was applied.
+    global config, config_stamp, settings, zones, zone_executor
+    global wemo_subscribed_generation
+    if not config_changed():
+        return False
+    config_stamp = file_stamp(CONFIG_FILE)
+    new_config = configparser.ConfigParser()
+    try:
+        if not new_config.read(CONFIG_FILE):
+            raise ValueError("{} is missing".format(CONFIG_FILE))
+        new_settings = compile_settings(new_config)
+        new_zones = read_zones(new_config, new_settings)
+    except (configparser.Error, KeyError, ValueError):
+        config_reloads_total.inc(result="invalid")
+        LOG.exception("Ignoring invalid %s, keeping the running config:", CONFIG_FILE)
+        return False
+    for section, option in RESTART_OPTIONS:
+        if new_config.get(section, option, fallback=None) != config.get(
+            section, option, fallback=None
+        ):
+            LOG.warning("%s changes take effect on restart.", option)
+    settings = new_settings
+    config = new_config
+    poll_scheduler.configure(
+        settings.min_polling_period_s,
+        settings.max_polling_period_s,
+        settings.nest_requests_per_hour,
+    )
+    previous = {zone.name: zone for zone in zones}
+    previous_fan_ids = set().union(*(zone.fan_ids for zone in zones))
+    zones = new_zones
+    for zone in zones:
+        if zone.name in previous:
+            zone.release_rules(zone.take_over(previous.pop(zone.name)))
+    for zone in previous.values():
+        LOG.info("Zone %s was removed, turning its devices off.", zone.name)
+        zone.release_rules(zone.rule_engine.active)
+        reset_wemo_devices(*zone.activated.values())
+    fan_ids = set().union(*(zone.fan_ids for zone in zones))
+    if previous_fan_ids - fan_ids:
+        # Fans no zone controls any more are turned off, like removed zones'
+        # wemos.
+        wait_for_commands(
+            submit_bond_fans(previous_fan_ids - fan_ids, "OFF"),
+            time.monotonic() + settings.transition_deadline_s,
+        )
+    start_bond_listener(fan_ids)
+    # Roles and rules may name devices that aren't subscribed yet.
+    wemo_subscribed_generation = None
+    # Sized for the new zones. The old pool is idle between iterations.
+    zone_executor.shutdown(wait=False)
+    zone_executor = ThreadPoolExecutor(
+        max_workers=len(zones), thread_name_prefix="zone"
+    )
+    config_reloads_total.inc(result="ok")
+    LOG.info("Reloaded %s.", CONFIG_FILE)
+    return True
+
+
+def record_phases(durations):
+    phase_stats.add(durations)
+    for phase, seconds in durations.items():
+        iteration_seconds.observe(seconds, phase=phase)
+    if durations["total"] > settings.slow_iteration_s:
+        phases_s = {phase: round(seconds, 3) for phase, seconds in durations.items()}
+        LOG.warning(
+            "Slow iteration: %.1f s, over the %.1f s budget (%s)",
+            durations["total"],
+            settings.slow_iteration_s,
+            ", ".join(
+                "{} {:.1f} s".format(phase, seconds)
+                for phase, seconds in sorted(phases_s.items(), key=lambda x: -x[1])
+                if phase != "total"
+            ),
+            extra={
+                "event": "slow_iteration",
+                "budget_s": settings.slow_iteration_s,
+                "phases_s": phases_s,
+            },
+        )
+
+
+def log_phase_stats():
+    LOG.info(
+        "Iteration phase timings over the last %d iterations:\n%s",
+        PHASE_WINDOW,
+        phase_stats.format(),
+    )
+
+
+# SimpleQueue.put is reentrant, unlike anything that takes a lock.
+phase_stats_requests = queue.SimpleQueue()
+
+
+def request_phase_stats(*args):
+    # SIGUSR1 handler. It runs on the main thread between any two bytecodes,
+    # possibly while that thread holds the phase stats or logging locks, so it
+    # only queues a request. phase_stats_loop does the logging.
+    phase_stats_requests.put(None)
+
+
+def phase_stats_loop():
+    while True:
+        phase_stats_requests.get()
+        log_phase_stats()
+
+
+def install_phase_stats_signal():
+    if hasattr(signal, "SIGUSR1"):
+        threading.Thread(
+            target=phase_stats_loop, name="Phase stats", daemon=True
+        ).start()
+        signal.signal(signal.SIGUSR1, request_phase_stats)
+
+
+# Controller state is saved here after every iteration that changes it, so a
+# restart picks up where it left off instead of re-toggling devices.
+STATE_FILE = "wenestmo_state.json"
+saved_state = None
+
+
+def save_state():
+    global saved_state
+    state = {"zones": {zone.name: zone.state() for zone in zones}}
+    if state == saved_state:
+        return
+    try:
+        with open(STATE_FILE + ".tmp", "w") as state_file:
+            json.dump(state, state_file, indent=1)
+        os.replace(STATE_FILE + ".tmp", STATE_FILE)
+        saved_state = state
+    except OSError:
+        LOG.exception("Unable to save controller state:")
+
+
+def load_state():
+    # Restores each zone from the saved controller state, if there is any.
+    try:
+        with open(STATE_FILE) as state_file:
+            state = json.load(state_file)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError):
+        LOG.exception("Ignoring unreadable controller state:")
+        return
+    # State saved before zones existed belongs to the first zone.
+    zone_states = state.get("zones", {zones[0].name: state})
+    for zone in zones:
+        if zone.name in zone_states:
+            zone.restore(zone_states[zone.name])
+    LOG.info("Restored controller state from %s", STATE_FILE)
+
+
+class Controller:
+    """Runs the control loop: reads every zone's thermostat and steps the zones.
+
+    The thermostat source and the poll scheduler are passed in, so simulate.py
+    can drive the same logic from a recorded trace without a Nest or real
+    plugs."""
+
+    def __init__(self, read_thermostats, scheduler, persist=True):
+        # read_thermostats(woke_for_event) returns a dict of zone -> thermostat.
+        self.read_thermostats = read_thermostats
+        self.scheduler = scheduler
+        self.persist = persist
+
+    def run_once(self, woke_for_event=False):
+        # One control iteration. Returns the thermostats it acted on.
+        global last_iteration_at
+        timer = PhaseTimer()
+        with timer.phase("discovery"):
+            managed_wemos = set()
+            by_name = wemos_by_name()
+            for zone in zones:
+                zone.resolve_restored_devices()
+                for devices in zone.get_roles().values():
+                    managed_wemos.update(devices)
+                managed_wemos.update(
+                    by_name[name] for name in zone.rule_wemo_names() if name in by_name
+                )
+            subscribe_wemo_devices(managed_wemos)
+        with timer.phase("thermostats"):
+            thermostats = self.read_thermostats(woke_for_event)
+        # The zones phase is wall time; the zones' own phases (overrides,
+        # transitions, ...) are summed over zones running in parallel.
+        with timer.phase("zones"):
+            hvac_changed = run_zones(thermostats, timer)
+        self.scheduler.update(
+            [thermostat for thermostat in thermostats.values() if thermostat],
+            hvac_changed,
+        )
+        if self.persist:
+            with timer.phase("save"):
+                save_state()
+        timer.add("total", timer.total())
+        record_phases(timer.durations)
+        last_iteration_at = time.monotonic()
+        return thermostats
+
+    def run(self):
+        woke_for_event = False
+        while True:
+            start = time.monotonic()
+            try:
+                reload_config()
+                self.run_once(woke_for_event)
+                iterations_total.inc(result="ok")
+            except:
+                iterations_total.inc(result="error")
+                LOG.exception("Top-level exception:")
+            iteration_s = time.monotonic() - start
+            woke_for_event = wait_for_next_iteration(
+                max(self.scheduler.next_delay() - iteration_s, 5)
+            )
+
+
+def age_s(monotonic_time):
+    if monotonic_time is None:
+        return None
+    return round(time.monotonic() - monotonic_time, 1)
+
+
+@metrics.collector
+def collect_device_metrics():
+    # Refreshes the gauges that are cheaper to read at scrape time.
+    errors = metrics.gauge(
+        "wenestmo_device_errors", "Consecutive failed commands by device."
+    )
+    errors.clear()
+    for device, count in list(device_error_count.items()):
+        errors.set(count, device=device)
+    metrics.gauge("wenestmo_wemo_devices", "WeMo devices in the registry.").set(
+        len(wemo_registry.devices())
+    )
+    for name, help, monotonic_time in (
+        (
+            "wenestmo_wemo_discovery_age_seconds",
+            "Seconds since the last WeMo discovery completed.",
+            wemo_discovered_at,
+        ),
+        (
+            "wenestmo_last_iteration_age_seconds",
+            "Seconds since the last successful control iteration.",
+            last_iteration_at,
+        ),
+        (
+            "wenestmo_nest_read_age_seconds",
+            "Seconds since the last successful Nest read.",
+            last_nest_read_at,
+        ),
+    ):
+        gauge = metrics.gauge(name, help)
+        gauge.clear()
+        if monotonic_time is not None:
+            gauge.set(time.monotonic() - monotonic_time)
+    bond_push = metrics.gauge(
+        "wenestmo_bond_push_connected", "1 if the Bond push listener is alive."
+    )
+    bond_push.set(int(bond_client.push_connected()))
+    if log_pipeline is not None:
+        metrics.gauge(
+            "wenestmo_log_records_dropped", "Log records dropped on a full queue."
+        ).set(log_pipeline.dropped)
+    if token_refresher is not None:
+        metrics.gauge(
+            "wenestmo_oauth_refresh_failures", "Failed OAuth token refreshes."
+        ).set(token_refresher.refresh_failures)
+        token_age = metrics.gauge(
+            "wenestmo_oauth_token_age_seconds", "Seconds since the token refresh."
+        )
+        token_age.clear()
+        if token_refresher.token_age_s() is not None:
+            token_age.set(token_refresher.token_age_s())
+        refresh_latency = metrics.gauge(
+            "wenestmo_oauth_refresh_seconds", "Duration of the last token refresh."
+        )
+        refresh_latency.clear()
+        if token_refresher.refresh_latency_s is not None:
+            refresh_latency.set(token_refresher.refresh_latency_s)
+
+
+def health():
+    # Returns (healthy, details) for /healthz. Healthy means an iteration
+    # succeeded recently, or the controller is still starting up.
+    max_age_s = settings.healthy_iteration_age_s
+    iteration_age_s = age_s(last_iteration_at)
+    healthy = (
+        age_s(started_at) if iteration_age_s is None else iteration_age_s
+    ) < max_age_s
+    fan_ids = set().union(*(zone.fan_ids for zone in zones))
+    nest_age_s = age_s(last_nest_read_at)
+    details = {
+        "healthy": healthy,
+        "last_iteration_age_s": iteration_age_s,
+        "nest": {
+            "reachable": nest_age_s is not None and nest_age_s < max_age_s,
+            "last_read_age_s": nest_age_s,
+        },
+        "wemo": {
+            "devices": len(wemo_registry.devices()),
+            "discovery_age_s": age_s(wemo_discovered_at),
+            "failing": sorted(set(device_error_count) - fan_ids),
+        },
+    }
+    if fan_ids:
+        failing_fans = sorted(fan_ids & set(device_error_count))
+        details["bond"] = {
+            "reachable": bond_client.push_connected() or not failing_fans,
+            "push_connected": bond_client.push_connected(),
+            "failing": failing_fans,
+        }
+    return healthy, details
+
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    try:
+        server = MetricsServer(metrics, health, METRICS_PORT, METRICS_HOST)
+    except OSError:
+        LOG.exception("Unable to serve metrics on port %d:", METRICS_PORT)
+        return None
+    server.start()
+    LOG.info(
+        "Serving /metrics and /healthz on %s port %d",
+        METRICS_HOST or "all interfaces",
+        server.port,
+    )
+    return server
+
+
+def main():
+    global nest_events
+    start_logging()
+    try:
+        load_state()
+        open_history()
+        start_metrics_server()
+        install_phase_stats_signal()
+        nest_client_thread = start_nest_client()
+        start_wemo_subscriptions()
+        start_wemo_discovery()
+        start_bond_listener(set().union(*(zone.fan_ids for zone in zones)))
+        nest_events = start_nest_events()
+        nest_client_thread.join()
+        Controller(get_zone_thermostats, poll_scheduler).run()
+    finally:
+        # Writes out anything still queued.
+        log_pipeline.stop()
+
+
+if __name__ == "__main__":
+    main()